@@ -1,4 +1,8 @@
 import datetime
+from contextlib import contextmanager
+from contextvars import ContextVar
+from copy import copy
+
 import pandas as pd
 from django.apps import apps as django_apps
 from django.core.management.base import CommandError
@@ -8,6 +12,30 @@ from django.utils import timezone
 from edc_base.model_mixins import ListModelMixin
 from io import BytesIO
 
+from .choice_catalog import choice_catalog
+from .encryption import CiphertextPassthrough
+from .inline_flattener import InlineFlattener
+from .m2m_encoder import ManyToManyEncoder
+
+# Export context of the admin export running in the current thread
+current_export_context = ContextVar('current_export_context', default=None)
+
+
+class ExportContext:
+    """ State of one admin export call: the bulk loaded lookups shared by its
+        rows and whether the object id column is kept. The context is set for
+        the thread running the export, see `AdminExportHelper.export_scope`,
+        so exports of the same model admin running concurrently do not share
+        it.
+    """
+
+    def __init__(self, m2m_encoder=None, inline_flattener=None,
+                 ciphertext_passthrough=None, keep_pk=False):
+        self.m2m_encoder = m2m_encoder
+        self.inline_flattener = inline_flattener
+        self.ciphertext_passthrough = ciphertext_passthrough
+        self.keep_pk = keep_pk
+
 
 class AdminExportHelper:
     """ Flourish export methods to be re-used in the export model admin mixin.
@@ -24,6 +52,53 @@ class AdminExportHelper:
     action_item_fields = ['action_identifier', 'tracking_identifier',
                           'related_tracking_identifier', 'parent_tracking_identifier']
 
+    @property
+    def export_context(self):
+        """ Return the context of the export running in the current thread.
+        """
+        return current_export_context.get() or ExportContext()
+
+    @contextmanager
+    def export_context_scope(self, context=None):
+        token = current_export_context.set(context)
+        try:
+            yield context
+        finally:
+            current_export_context.reset(token)
+
+    @contextmanager
+    def export_scope(self, queryset=None):
+        """ Share bulk loaded lookups across the rows of one export run and
+            release them when the export finishes.
+            @param queryset: queryset being exported, many to many selections are
+                   read for its objects and inline rows are prefetched for chunks
+                   of its objects, as are the ciphertext secrets of a queryset
+                   prepared for ciphertext passthrough.
+            @return: the `ExportContext` of the export
+        """
+        context = copy(self.export_context)
+        context.m2m_encoder = ManyToManyEncoder()
+        if queryset is not None:
+            context.m2m_encoder.bind(queryset)
+            context.inline_flattener = InlineFlattener()
+            context.inline_flattener.bind(queryset)
+            passthrough = CiphertextPassthrough()
+            if passthrough.is_prepared(queryset):
+                passthrough.bind(queryset)
+                context.ciphertext_passthrough = passthrough
+        with self.export_context_scope(context):
+            yield context
+
+    @contextmanager
+    def primary_key_scope(self):
+        """ Keep the id column of the exported rows, so the rows of an export
+            can be matched to their objects.
+        """
+        context = copy(self.export_context)
+        context.keep_pk = True
+        with self.export_context_scope(context):
+            yield context
+
     @property
     def get_model_fields(self):
         return [field for field in self.model._meta.get_fields()
@@ -39,6 +114,13 @@ class AdminExportHelper:
             @return: complete data indicating responses for the m2m field.
         """
         m2m_data = {}
+        m2m_encoder = self.export_context.m2m_encoder
+        if m2m_encoder:
+            for choice, selected in m2m_encoder.encode(field, obj.pk):
+                field_name = f'{choice}__{inline_count}' if inline_count else choice
+                m2m_data[field_name] = selected
+            return m2m_data
+
         model_cls = field.related_model
         choices = self.m2m_list_data(model_cls)
         key_manager = getattr(obj, field.name)
@@ -54,9 +136,7 @@ class AdminExportHelper:
         return m2m_data
 
     def m2m_list_data(self, model_cls=None):
-        qs = model_cls.objects.order_by(
-            'created').values_list('short_name', flat=True)
-        return list(qs)
+        return choice_catalog.short_names(model_cls)
 
     def inline_data_dict(self, obj, field):
         """ Retrieves all inline responses provided for parent model, and flattens
@@ -66,12 +146,17 @@ class AdminExportHelper:
             @return: flattened data retrieved from the inline model instances.
         """
         data = {}
-        related_field_name = getattr(obj, f'{field.related_name}', None)
-        key_manager = getattr(obj, f'{field.name}_set', related_field_name)
         field_id = field.field.attname
         exclude_fields = self.exclude_fields + [field_id,]
-        if key_manager:
-            inline_values = key_manager.all()
+        inline_values = None
+        inline_flattener = self.export_context.inline_flattener
+        if inline_flattener:
+            inline_values = inline_flattener.children(obj, field)
+        if inline_values is None:
+            related_field_name = getattr(obj, f'{field.related_name}', None)
+            key_manager = getattr(obj, f'{field.name}_set', related_field_name)
+            inline_values = key_manager.all() if key_manager else []
+        if inline_values:
             for _count, obj in enumerate(inline_values):
                 inline_data = obj.__dict__
                 inline_data = {f'{key}__{_count}': value for key,
@@ -140,13 +225,31 @@ class AdminExportHelper:
         return data
 
     def remove_exclude_fields(self, data={}):
+        data = self.restore_ciphertext(data)
+        keep_pk = self.export_context.keep_pk
         for e_field in self.exclude_fields:
+            if keep_pk and e_field == 'id':
+                continue
             try:
                 del data[e_field]
             except KeyError:
                 pass
         return data
 
+    def restore_ciphertext(self, data={}):
+        """ Replace raw encrypted column values, annotated on querysets prepared
+            for ciphertext passthrough, with the stored ciphertext.
+            @param data: dictionary for model data
+            @return: a copy of data with ciphertext under the encrypted field names,
+                    or data if it has no raw encrypted column values
+        """
+        passthrough = (self.export_context.ciphertext_passthrough
+                       or CiphertextPassthrough())
+        raw_columns = [key for key in data if key.startswith(passthrough.alias_prefix)]
+        if not raw_columns or not hasattr(self, 'model'):
+            return data
+        return passthrough.restore(data, self.model)
+
     def get_export_filename(self, app_label=None, export_type=None):
         date_str = datetime.datetime.now().strftime('%Y-%m-%d')
         if hasattr(self, 'model') and self.model is not None:
@@ -15,6 +15,17 @@ class AppConfig(DjangoAppConfig):
     caregiver_path = settings.MEDIA_ROOT + export_date + '/caregiver/'
     child_path = settings.MEDIA_ROOT + export_date + '/child/'
     non_crf_path = settings.MEDIA_ROOT + export_date + '/non_crf/'
+    # Worker processes exporting models in parallel, 1 exports in sequence
+    export_processes = getattr(settings, 'FLOURISH_EXPORT_PROCESSES', 1)
+    # Export only the rows changed since the last export, see DeltaExport
+    incremental_exports = getattr(settings, 'FLOURISH_EXPORT_INCREMENTAL', False)
+    # Rows per admin export job, models with more rows are exported in pk range chunks
+    export_chunk_size = getattr(settings, 'FLOURISH_EXPORT_CHUNK_SIZE', 50000)
+    # Rows per admin export job of a model, by label_lower
+    export_chunk_sizes = getattr(settings, 'FLOURISH_EXPORT_CHUNK_SIZES', {})
+
+    def ready(self):
+        from .signals import list_model_on_post_save  # noqa
 
 
 class EdcBaseAppConfig(BaseEdcBaseAppConfig):
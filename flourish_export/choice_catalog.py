@@ -0,0 +1,97 @@
+import threading
+import time
+
+from django.apps import apps as django_apps
+from django.db.models import Count, Max
+from edc_base.model_mixins import ListModelMixin
+
+
+class ChoiceCatalog:
+    """Process wide catalog of the choices of the list models.
+
+    The choices of a list model are read once, on first use, and shared by
+    the CRF and admin exports and the metadata export of the process. The
+    version of a list model is read from its table, the number of objects
+    and the last modified, so a change saved by any process, web, RQ,
+    Celery or export pool worker, is seen by every other. The catalog
+    checks the version at most every `check_interval` seconds and reads
+    the list model again once it changed. A save or delete in the process
+    drops the list model from its catalog right away, see `signals`. Call
+    `warm_up` on worker startup to read every list model up front.
+    """
+
+    def __init__(self, check_interval=1):
+        self.check_interval = check_interval
+        self._entries = {}
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def version(self, list_model_cls=None):
+        """Return the (count, last modified) of the list model objects.
+        """
+        version = list_model_cls.objects.order_by().aggregate(
+            count=Count('pk'), modified=Max('modified'))
+        return version['count'], version['modified']
+
+    def entry(self, list_model_cls=None):
+        """Return the (version, rows, short names) entry of the list model,
+        read again if its version changed.
+        """
+        entry = self._entries.get(list_model_cls)
+        now = time.monotonic()
+        if (entry is not None
+                and now - self._checked.get(list_model_cls, 0) < self.check_interval):
+            return entry
+        # Read the version first, rows changed after it was read are read again
+        version = self.version(list_model_cls)
+        if entry is None or entry[0] != version:
+            rows = list(list_model_cls.objects.values_list('short_name', 'name', 'created'))
+            short_names = [short_name for short_name, _, _ in
+                           sorted(rows, key=lambda row: row[2])]
+            entry = (version, rows, short_names)
+        with self._lock:
+            self._entries[list_model_cls] = entry
+            self._checked[list_model_cls] = now
+        return entry
+
+    def rows(self, list_model_cls=None):
+        """Return the (short_name, name, created) rows of the list model in
+        the model ordering.
+        """
+        return self.entry(list_model_cls)[1]
+
+    def choices(self, list_model_cls=None):
+        """Return the (short_name, name) choices of the list model in the
+        model ordering.
+        """
+        return [(short_name, name) for short_name, name, _ in self.rows(list_model_cls)]
+
+    def short_names(self, list_model_cls=None):
+        """Return the short names of the list model ordered by created.
+        """
+        return self.entry(list_model_cls)[2]
+
+    def invalidate(self, list_model_cls=None):
+        """Drop the list model, or every list model, from the catalog of
+        the process.
+        """
+        with self._lock:
+            if list_model_cls is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(list_model_cls, None)
+
+    def warm_up(self, app_labels=None):
+        """Read the choices of every list model, or of the list models of the
+        app labels, and return the number of list models read.
+        """
+        list_models = [
+            model_cls for model_cls in django_apps.get_models()
+            if issubclass(model_cls, ListModelMixin)
+            and (not app_labels or model_cls._meta.app_label in app_labels)]
+        for model_cls in list_models:
+            self.rows(model_cls)
+        return len(list_models)
+
+
+choice_catalog = ChoiceCatalog()
@@ -0,0 +1,92 @@
+import os
+import shutil
+
+import pandas as pd
+from django.apps import apps as django_apps
+
+from .parallel_export import estimated_rows
+
+
+def chunk_size(label_lower=None):
+    """Return the number of rows exported per chunk of a model, the model
+    setting in FLOURISH_EXPORT_CHUNK_SIZES or FLOURISH_EXPORT_CHUNK_SIZE.
+    """
+    app_config = django_apps.get_app_config('flourish_export')
+    return app_config.export_chunk_sizes.get(label_lower, app_config.export_chunk_size)
+
+
+def pk_ranges(queryset=None, size=None):
+    """Return the (start, end) primary key ranges splitting the queryset
+    into chunks of `size` rows, from the estimated table rows, or a single
+    open range for a table that fits in one chunk. A range holds the pks
+    from start, inclusive, up to end; the first starts and the last ends
+    open so rows added later still fall in a range.
+    """
+    model_cls = queryset.model
+    if not size or estimated_rows(model_cls._meta.label_lower) <= size:
+        return [(None, None)]
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    bounds = [None]
+    while True:
+        start = bounds[-1]
+        chunk = pks if start is None else pks.filter(pk__gte=start)
+        end = chunk[size:size + 1].first()
+        if end is None:
+            break
+        bounds.append(end)
+    return list(zip(bounds, bounds[1:] + [None]))
+
+
+def range_queryset(queryset=None, start=None, end=None):
+    """Return the queryset objects in a primary key range, ordered by pk.
+    """
+    if start is not None:
+        queryset = queryset.filter(pk__gte=start)
+    if end is not None:
+        queryset = queryset.filter(pk__lt=end)
+    return queryset.order_by('pk')
+
+
+def concatenate_parts(part_files=None, path=None):
+    """Concatenate the csv part files, in order, into the csv file under a
+    single header. Parts exported with other columns, an inline or list
+    choice the other parts do not have, are aligned to the union of the
+    columns in first seen order. Raises FileNotFoundError if a part file
+    is missing.
+    """
+    missing = [part for part in part_files if not os.path.exists(part)]
+    if missing:
+        raise FileNotFoundError(f'Missing export parts: {", ".join(missing)}')
+    headers = {}
+    for part in part_files:
+        headers[part] = list(pd.read_csv(part, nrows=0).columns)
+    columns = list(dict.fromkeys(c for header in headers.values() for c in header))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.part', 'w', newline='') as out:
+        pd.DataFrame(columns=columns).to_csv(out, index=False)
+        for part, header in headers.items():
+            if header == columns:
+                with open(part, newline='') as f:
+                    f.readline()
+                    shutil.copyfileobj(f, out)
+            else:
+                df = pd.read_csv(part, dtype=str, keep_default_na=False)
+                df.reindex(columns=columns, fill_value='').to_csv(
+                    out, index=False, header=False)
+    os.replace(f'{path}.part', path)
+    return path
+
+
+def planned_ranges(manifest=None, model_cls=None):
+    """Return the pk ranges of a model export, planned once per export and
+    kept in its manifest so a retried export writes the same parts.
+    """
+    label_lower = model_cls._meta.label_lower
+    plan = manifest.entry(f'{label_lower}.plan')
+    if plan:
+        return [tuple(pk_range) for pk_range in plan['ranges']]
+    ranges = [
+        tuple(None if pk is None else str(pk) for pk in pk_range)
+        for pk_range in pk_ranges(model_cls.objects.all(), chunk_size(label_lower))]
+    manifest.write(f'{label_lower}.plan', status='planned', ranges=ranges)
+    return ranges
@@ -0,0 +1,68 @@
+from collections import OrderedDict
+
+
+class CryptorCache:
+    """Export scoped, size bounded LRU cache in front of the field cryptors.
+
+    Entries are keyed by the cryptor's algorithm and mode plus the
+    plaintext, so fields sharing a cryptor configuration share entries.
+    django_crypto_fields derives the value hash deterministically and any
+    stored cipher decrypts back to the plaintext, so re-using a ciphertext
+    within an export is safe. Clear the cache when the export finishes.
+    """
+
+    def __init__(self, maxsize=50000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._cache = OrderedDict()
+
+    def cache_key(self, field_cryptor=None, value=None):
+        return (field_cryptor.algorithm, field_cryptor.mode,
+                type(value), str(value))
+
+    def encrypt(self, field_cryptor=None, value=None):
+        """Return the ciphertext for the value, encrypting it only if it
+        is not already cached.
+        """
+        if value is None:
+            return field_cryptor.encrypt(value)
+        key = self.cache_key(field_cryptor, value)
+        try:
+            ciphertext = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            ciphertext = field_cryptor.encrypt(value)
+            self._cache[key] = ciphertext
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        return ciphertext
+
+    def evict(self, field_cryptor=None, value=None):
+        """Remove a single cached value.
+        """
+        self._cache.pop(self.cache_key(field_cryptor, value), None)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return round(self.hits / lookups, 4) if lookups else 0.0
+
+    @property
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hit_rate,
+                'size': len(self._cache)}
+
+    def clear(self):
+        self._cache.clear()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
@@ -0,0 +1,164 @@
+import csv
+import os
+from collections import defaultdict
+
+import pandas as pd
+
+
+class StreamingCsvWriter:
+    """Write export rows to a CSV file in fixed size batches.
+
+    Rows are appended as they are produced and every `batch_size` rows are
+    formatted into a data frame, see `ExportMethods.export_frame`, with
+    the `rename` columns renamed, and appended to the file. The header is
+    written when the file is opened, from the planned `columns`, or from
+    the first batch when there is no plan. Only one batch is held in
+    memory.
+
+    The file matches the one written from a single data frame of all the
+    rows: columns in first seen order across the rows, and integer columns
+    with a float or a missing value written as floats. A batch with a
+    column the header does not have is written with the column appended.
+    If on close the written columns or number types differ from those of
+    a single data frame, the file is rewritten once, a batch at a time,
+    with the columns in first seen order and the float columns cast. A
+    column cast to float that later has a value other than a number is not
+    restored.
+    """
+
+    numeric_types = frozenset([int, float])
+
+    def __init__(self, path=None, export_methods=None, model_cls=None, exclude=None,
+                 columns=None, batch_size=5000, rename=None):
+        self.path = path
+        self.export_methods = export_methods
+        self.model_cls = model_cls
+        self.exclude = exclude
+        self.rename = rename
+        self.batch_size = batch_size
+        self.rows = 0
+        self.rewritten = False
+        self._batch = []
+        self._written = list(columns or [])
+        self._header = list(self._written)
+        self._seen = {}
+        self._types = defaultdict(set)
+        self._values = defaultdict(int)
+        self._uncast = set()
+        self._tmp_path = f'{path}.part'
+        self._file = open(self._tmp_path, 'w', encoding='utf-8', newline='')
+        if self._written:
+            self.write_header(self._written)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(self._tmp_path)
+
+    def write_header(self, columns=None):
+        pd.DataFrame(columns=columns).to_csv(self._file, index=False)
+
+    def append(self, row=None):
+        self._batch.append(row)
+        self.rows += 1
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def extend(self, rows=None):
+        for row in rows:
+            self.append(row)
+
+    def flush(self):
+        """Format the buffered rows and append them to the file.
+        """
+        if not self._batch:
+            return
+        df = self.export_methods.export_frame(
+            self._batch, self.model_cls, self.exclude, dtype=object, rename=self.rename)
+        self._batch = []
+        for column in df.columns:
+            values = df[column].dropna()
+            self._seen.setdefault(column, None)
+            self._types[column].update(map(type, values))
+            self._values[column] += len(values)
+        if not self._header:
+            self._header = list(df.columns)
+            self._written = list(df.columns)
+            self.write_header(self._header)
+        else:
+            self._written += [column for column in df.columns if column not in self._written]
+        float_columns = self.float_columns()
+        for column in df.columns:
+            if column in float_columns:
+                df[column] = df[column].astype(float)
+            elif int in self._types[column]:
+                self._uncast.add(column)
+        df.reindex(columns=self._written).to_csv(self._file, header=False, index=False)
+
+    @property
+    def header(self):
+        return list(self._seen) if self.rows else self._written
+
+    def float_columns(self):
+        """Return the integer columns a single data frame of the rows so far
+        would hold as floats, columns of numbers with a float or a missing
+        value.
+        """
+        return [column for column, types in self._types.items()
+                if int in types and types <= self.numeric_types
+                and (float in types or self._values[column] < self.rows)]
+
+    def needs_rewrite(self):
+        return self.rows and (
+            self._header != self.header
+            or self._uncast.intersection(self.float_columns()))
+
+    def written_batches(self):
+        """Yield the written rows a batch at a time as data frames of the
+        written columns, rows written before a column was added lack it.
+        """
+        with open(self._tmp_path, encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            next(reader)
+            rows = []
+            for row in reader:
+                rows.append(row + [''] * (len(self._written) - len(row)))
+                if len(rows) >= self.batch_size:
+                    yield pd.DataFrame(rows, columns=self._written, dtype=object)
+                    rows = []
+            if rows:
+                yield pd.DataFrame(rows, columns=self._written, dtype=object)
+
+    def rewrite(self):
+        """Rewrite the file with the columns in first seen order and the
+        float columns cast.
+        """
+        header, float_columns = self.header, self.float_columns()
+        rewrite_path = f'{self.path}.rewrite'
+        with open(rewrite_path, 'w', encoding='utf-8', newline='') as f:
+            pd.DataFrame(columns=header).to_csv(f, index=False)
+            for df in self.written_batches():
+                df = df.reindex(columns=header)
+                for column in float_columns:
+                    values = df[column]
+                    df[column] = pd.to_numeric(values.mask(values == '')).astype(float)
+                df.to_csv(f, header=False, index=False)
+        os.replace(rewrite_path, self._tmp_path)
+        self.rewritten = True
+
+    def close(self):
+        """Finish the CSV file and return the number of rows written.
+        """
+        self.flush()
+        if not self._header:
+            self.write_header([])
+        self._file.close()
+        if self.needs_rewrite():
+            self.rewrite()
+        os.replace(self._tmp_path, self.path)
+        return self.rows
@@ -0,0 +1,169 @@
+import datetime
+import re
+from functools import lru_cache
+
+import pandas as pd
+from django.db import models
+from pytz import timezone
+
+export_timezone = timezone('Africa/Gaborone')
+date_format = '%m/%d/%Y'
+time_format = '%H:%M:%S.%f'
+
+
+@lru_cache(maxsize=None)
+def split_column_names(column):
+    """Return the (date, time) column names a datetime column is split into.
+    """
+    if 'datetime' in column:
+        time_column = re.sub('datetime', 'time', column)
+    else:
+        time_column = column + '_time'
+    return re.sub('time', '', column), time_column
+
+
+@lru_cache(maxsize=None)
+def model_date_columns(model_cls):
+    """Return the attribute names of the datetime and the date fields of a
+    model class.
+    """
+    datetime_columns, date_columns = set(), set()
+    for field in model_cls._meta.concrete_fields:
+        if isinstance(field, models.DateTimeField):
+            datetime_columns.add(field.attname)
+        elif isinstance(field, models.DateField):
+            date_columns.add(field.attname)
+    return frozenset(datetime_columns), frozenset(date_columns)
+
+
+class DateColumnFormatter:
+    """Format the date columns of an export data frame once per frame.
+
+    Datetime columns are converted to the export timezone and split into
+    a `m/d/Y` date column and a time column, date columns are formatted as
+    `m/d/Y`. Columns are named and ordered as when each row dictionary is
+    formatted with `ExportMethods.fix_date_format`, including rows where
+    a datetime value is missing and the original column is kept.
+    """
+
+    DATETIME = 'datetime'
+    DATE = 'date'
+
+    def column_kinds(self, df=None, model_cls=None):
+        """Return a dictionary of column: kind for the date columns of the
+        frame, from the model fields and the values of any other column.
+        """
+        datetime_columns, date_columns = (
+            model_date_columns(model_cls) if model_cls else (frozenset(), frozenset()))
+        kinds = {}
+        for column in df.columns:
+            series = df[column]
+            if pd.api.types.is_datetime64_any_dtype(series):
+                kinds[column] = self.DATETIME
+                continue
+            value = self.first_value(series)
+            if isinstance(value, datetime.datetime):
+                kinds[column] = self.DATETIME
+            elif isinstance(value, datetime.date):
+                kinds[column] = self.DATE
+            elif value is None and column in datetime_columns:
+                kinds[column] = self.DATETIME
+            elif value is None and column in date_columns:
+                kinds[column] = self.DATE
+        return kinds
+
+    def first_value(self, series):
+        index = series.first_valid_index()
+        return None if index is None else series[index]
+
+    def format(self, df=None, model_cls=None, rows=None):
+        """Return a new frame with the date columns formatted. The row
+        dictionaries the frame was built from, if given, set the column
+        order, see `row_column_order`.
+        """
+        kinds = self.column_kinds(df, model_cls)
+        if not kinds:
+            return df
+        datetime_columns = [c for c, kind in kinds.items() if kind == self.DATETIME]
+        missing = df[datetime_columns].isna()
+
+        columns = {}
+        for column in df.columns:
+            kind = kinds.get(column)
+            if kind == self.DATETIME:
+                date_column, time_column = split_column_names(column)
+                dates, times = self.split_datetimes(df[column])
+                columns[date_column] = dates
+                columns[time_column] = times
+                if missing[column].any() and column not in (date_column, time_column):
+                    columns[column] = pd.Series(None, index=df.index, dtype=object)
+            elif kind == self.DATE:
+                columns[column] = self.format_dates(df[column])
+            else:
+                columns[column] = df[column]
+        formatted = pd.DataFrame(columns, index=df.index)
+        if rows is not None:
+            return formatted[self.row_column_order(rows, kinds)]
+        return formatted[self.column_order(df, kinds, missing)]
+
+    def row_column_order(self, rows=None, kinds=None):
+        """Return the columns in first seen order across the rows, as each
+        row has its own keys, with the date and time columns in place of a
+        datetime column for the rows with a datetime value.
+        """
+        datetime_columns = [c for c, kind in kinds.items() if kind == self.DATETIME]
+        order, seen = {}, set()
+        for row in rows:
+            signature = (tuple(row), tuple(
+                isinstance(row.get(c), datetime.datetime) for c in datetime_columns))
+            if signature in seen:
+                continue
+            seen.add(signature)
+            for column, value in row.items():
+                if (kinds.get(column) == self.DATETIME
+                        and isinstance(value, datetime.datetime)):
+                    for name in split_column_names(column):
+                        order.setdefault(name, None)
+                else:
+                    order.setdefault(column, None)
+        return list(order)
+
+    def column_order(self, df=None, kinds=None, missing=None):
+        """Return the columns in first seen order across the rows, where a
+        row with a missing datetime keeps the original column in place of
+        the date and time columns.
+        """
+        if not len(missing.columns):
+            return list(df.columns)
+        order = {}
+        for _, pattern in missing.drop_duplicates().iterrows():
+            for column in df.columns:
+                if kinds.get(column) == self.DATETIME and not pattern[column]:
+                    for name in split_column_names(column):
+                        order.setdefault(name, None)
+                else:
+                    order.setdefault(column, None)
+        return list(order)
+
+    def to_local(self, series):
+        return pd.to_datetime(series, utc=True).dt.tz_convert(export_timezone)
+
+    def split_datetimes(self, series):
+        """Return the date and time strings for a datetime column.
+        """
+        try:
+            local = self.to_local(series)
+        except (OverflowError, TypeError, ValueError):
+            local = series.map(
+                lambda v: None if pd.isna(v) else v.astimezone(export_timezone))
+            return (local.map(lambda v: None if v is None else v.strftime(date_format)),
+                    local.map(lambda v: None if v is None else v.time().strftime(
+                        time_format)))
+        return local.dt.strftime(date_format), local.dt.strftime(time_format)
+
+    def format_dates(self, series):
+        try:
+            return pd.to_datetime(series).dt.strftime(date_format)
+        except (OverflowError, TypeError, ValueError):
+            return series.map(
+                lambda v: v.strftime(date_format) if isinstance(v, datetime.date) else v)
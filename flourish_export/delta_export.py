@@ -0,0 +1,221 @@
+import os
+import pickle
+import shutil
+
+import pandas as pd
+from django.conf import settings
+from django.db.models import Exists, OuterRef, Q
+from django.utils.text import slugify
+
+from .choice_catalog import choice_catalog
+from .models import ExportFile
+
+
+def has_modified(model_cls=None):
+    return any(f.name == 'modified' for f in model_cls._meta.concrete_fields)
+
+
+def choices_signature(model_cls=None):
+    """Return the list model choices of the many to many fields of a model
+    and of its inline models, the choice columns of its export rows.
+    """
+    models = [model_cls] + [relation.related_model
+                            for relation in model_cls._meta.related_objects
+                            if relation.one_to_many]
+    return tuple(
+        (field.related_model._meta.label_lower,
+         tuple(choice_catalog.short_names(field.related_model)))
+        for model in models for field in model._meta.many_to_many)
+
+
+class DeltaExport:
+    """Keep the export files of a description up to date from the rows
+    changed since the last successful export with the same description.
+
+    The watermark is the start of that export. A file is exported from
+    the rows of its queryset modified after the watermark, or whose
+    related `lookups` or inline rows were, merged by primary key into the
+    snapshot of the rows the previous export saved for the file. Rows no
+    longer in the queryset ids are dropped. Each export saves the merged
+    snapshot of every file it writes under its own export identifier; a
+    file without a snapshot of the previous export, or whose snapshot was
+    saved with other list model choices, see `choices_signature`, is
+    exported in full. Snapshots are read and saved a chunk at a time, so
+    only the changed rows and the ids are held in memory.
+    """
+
+    def __init__(self, description=None, export_identifier=None, snapshot_path=None):
+        self.description = description
+        self.export_identifier = export_identifier
+        self.snapshot_path = snapshot_path or os.path.join(
+            settings.MEDIA_ROOT, 'export_snapshots', slugify(description))
+        previous = ExportFile.objects.filter(
+            description=description, download_complete=True).exclude(
+                export_identifier=export_identifier).order_by('datetime_started').last()
+        self.previous_identifier = previous.export_identifier if previous else None
+        self.watermark = previous.datetime_started if previous else None
+        self.prune()
+
+    def prune(self):
+        """Remove the snapshots of exports other than the previous and the
+        current one.
+        """
+        if not os.path.isdir(self.snapshot_path):
+            return
+        keep = {self.previous_identifier, self.export_identifier}
+        for name in os.listdir(self.snapshot_path):
+            if name not in keep:
+                shutil.rmtree(os.path.join(self.snapshot_path, name), ignore_errors=True)
+
+    def snapshot_file(self, key=None, export_identifier=None):
+        return os.path.join(self.snapshot_path, export_identifier, f'{key}.snapshot')
+
+    def load(self, key=None, signature=None):
+        """Return the `Snapshot` the previous export saved for the file with
+        the same signature, or None if the file has to be exported in full.
+        """
+        if not self.previous_identifier:
+            return None
+        path = self.snapshot_file(key, self.previous_identifier)
+        if not os.path.exists(path):
+            return None
+        snapshot = Snapshot(path)
+        return snapshot if snapshot.signature == signature else None
+
+    def writer(self, key=None, signature=None, columns=None):
+        """Return the `SnapshotWriter` saving the snapshot of the file.
+        """
+        return SnapshotWriter(
+            self.snapshot_file(key, self.export_identifier), signature, columns)
+
+    def changed(self, queryset=None, lookups=None):
+        """Return the queryset objects modified after the watermark, or
+        whose objects across the `lookups` or inline objects were.
+        """
+        condition = Q(modified__gt=self.watermark)
+        for lookup in lookups or []:
+            condition |= Q(**{f'{lookup}__modified__gt': self.watermark})
+        for relation in queryset.model._meta.related_objects:
+            if not relation.one_to_many or not has_modified(relation.related_model):
+                continue
+            condition |= Exists(relation.related_model._default_manager.filter(
+                **{relation.field.name: OuterRef('pk'),
+                   'modified__gt': self.watermark}))
+        return queryset.filter(condition)
+
+    def ids(self, queryset=None):
+        return set(queryset.order_by().values_list('pk', flat=True))
+
+    def merge(self, snapshot=None, changed=None, ids=None):
+        """Yield the (pk, row) pairs of the snapshot updated with the changed
+        rows, new rows added after the snapshot rows, less the rows not in
+        the ids.
+        """
+        merged = set()
+        for pk, row in snapshot or []:
+            if pk in ids:
+                merged.add(pk)
+                yield pk, changed.get(pk, row)
+        for pk, row in changed.items():
+            if pk not in merged:
+                yield pk, row
+
+    def frame_columns(self, snapshot=None, changed=None):
+        """Return the union of the snapshot and changed rows columns.
+        """
+        columns = list(snapshot.columns) if snapshot is not None else []
+        return columns + [column for column in changed.columns if column not in columns]
+
+    def merge_frames(self, snapshot=None, changed=None, ids=None):
+        """Yield the data frames, indexed by pk, of the snapshot updated with
+        the changed rows as `merge` does, a snapshot chunk at a time, with
+        the columns of `frame_columns`.
+        """
+        if snapshot is None:
+            yield changed
+            return
+        columns = self.frame_columns(snapshot, changed)
+        seen = set()
+        for chunk in snapshot.chunks():
+            seen.update(chunk.index)
+            chunk = chunk[chunk.index.isin(ids)]
+            replaced = chunk.index.intersection(changed.index)
+            if len(replaced):
+                chunk = pd.concat(
+                    [chunk.drop(index=replaced), changed.loc[replaced]]).loc[chunk.index]
+            yield chunk.reindex(columns=columns).fillna('')
+        added = [pk for pk in changed.index if pk not in seen]
+        yield changed.loc[added].reindex(columns=columns).fillna('')
+
+
+class Snapshot:
+    """The rows an export saved for a file, read back a chunk at a time.
+
+    Iterating a snapshot of rows yields the (pk, row) pairs, `chunks`
+    yields the saved chunks, lists of pairs or data frames.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.signature, self.columns = pickle.load(f)
+
+    def chunks(self):
+        with open(self.path, 'rb') as f:
+            pickle.load(f)
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
+
+
+class SnapshotWriter:
+    """Save the rows of a file to its snapshot a chunk at a time, as (pk,
+    row) pairs appended `chunk_size` at a time or as data frames. The
+    snapshot replaces any saved one when the writer closes, an export
+    that fails leaves no snapshot.
+    """
+
+    def __init__(self, path=None, signature=None, columns=None, chunk_size=5000):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._chunk = []
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(f'{path}.part', 'wb')
+        self.dump((signature, columns))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            os.remove(f'{self.path}.part')
+
+    def dump(self, value=None):
+        pickle.dump(value, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def append(self, pk=None, row=None):
+        self._chunk.append((pk, row))
+        if len(self._chunk) >= self.chunk_size:
+            self.flush()
+
+    def append_frame(self, frame=None):
+        self.dump(frame)
+
+    def flush(self):
+        if self._chunk:
+            self.dump(self._chunk)
+            self._chunk = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+        os.replace(f'{self.path}.part', self.path)
@@ -0,0 +1,168 @@
+from functools import lru_cache
+
+from django.db.models import ExpressionWrapper, F, TextField
+from django_crypto_fields.constants import CIPHER_PREFIX, ENCODING
+from django_crypto_fields.fields import (
+    EncryptedCharField, EncryptedDecimalField, EncryptedIntegerField,
+    EncryptedTextField, FirstnameField, IdentityField, LastnameField)
+
+encrypted_fields = [
+    EncryptedCharField, EncryptedDecimalField, EncryptedIntegerField,
+    EncryptedTextField, FirstnameField, IdentityField, LastnameField]
+
+
+@lru_cache(maxsize=None)
+def encryption_plan(model_cls):
+    """Return a dictionary of attribute name: field cryptor for the
+    encrypted fields of a model class, built once per process.
+    """
+    return {f.name: f.field_cryptor for f in model_cls._meta.get_fields()
+            if type(f) in encrypted_fields}
+
+
+@lru_cache(maxsize=None)
+def field_order(model_cls):
+    """Return the attribute names of the concrete fields of a model class
+    in the order they are loaded onto an instance.
+    """
+    return tuple(f.attname for f in model_cls._meta.concrete_fields)
+
+
+class CiphertextPassthrough:
+    """Read encrypted columns as the stored value and write them out as
+    ciphertext without decrypting and re-encrypting them.
+
+    The encrypted columns store the prefixed value hash; the cipher is
+    fetched from the crypt store and appended the same way
+    `FieldCryptor.encrypt` builds its ciphertext. The secrets are read a
+    chunk of rows at a time, one query per encrypted column, for rows
+    passed through `rows` or rows of a queryset bound with `bind`. A
+    value outside the loaded chunk fetches its own secret.
+    """
+
+    alias_prefix = '_ciphertext_'
+
+    def __init__(self, chunk_size=2000):
+        self.chunk_size = chunk_size
+        self.reset()
+
+    def alias(self, name):
+        return f'{self.alias_prefix}{name}'
+
+    def prepare(self, queryset=None):
+        """Defer the encrypted columns of the queryset model, so they are not
+        decrypted on load, and annotate their raw stored values instead.
+        """
+        plan = encryption_plan(queryset.model)
+        if not plan:
+            return queryset
+        raw_columns = {
+            self.alias(name): ExpressionWrapper(F(name), output_field=TextField())
+            for name in plan}
+        return queryset.defer(*plan).annotate(**raw_columns)
+
+    def is_prepared(self, queryset=None):
+        return any(name.startswith(self.alias_prefix) for name in queryset.query.annotations)
+
+    def bind(self, queryset=None):
+        """Bind to a prepared queryset iterated by the caller. A row whose
+        secrets are not loaded loads those of the chunk of the queryset pks
+        from its position, read once, in the queryset ordering.
+        """
+        self.reset(queryset)
+        return queryset
+
+    def rows(self, rows=None, model_cls=None):
+        """Yield the row dictionaries of `model_cls`, loading the secrets of
+        each chunk of rows before the rows are yielded.
+        """
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.chunk_size:
+                self.load_secrets(chunk, model_cls)
+                yield from chunk
+                chunk = []
+        if chunk:
+            self.load_secrets(chunk, model_cls)
+            yield from chunk
+
+    def load_secrets(self, rows=None, model_cls=None):
+        """Replace the loaded secrets with those of the stored values of the
+        rows, read with one query per encrypted column.
+        """
+        self.secrets = {}
+        for name, field_cryptor in encryption_plan(model_cls).items():
+            alias = self.alias(name)
+            values = {row[alias] for row in rows if row.get(alias)}
+            if values:
+                self.secrets.update(self.fetch_secrets(field_cryptor, values))
+
+    def fetch_secrets(self, field_cryptor=None, hashes_with_prefix=None):
+        """Return a dictionary of hash with prefix: secret of the stored
+        values of a column.
+        """
+        hashes = {field_cryptor.get_hash(value).decode(ENCODING): value
+                  for value in hashes_with_prefix}
+        secrets = field_cryptor.cipher_model.objects.filter(
+            hash__in=list(hashes), algorithm=field_cryptor.algorithm,
+            mode=field_cryptor.mode).values_list('hash', 'secret')
+        self.queries += 1
+        return {hashes[hash_value]: bytes(secret) for hash_value, secret in secrets}
+
+    def load_position(self, pk=None):
+        """Load the secrets of the chunk of the bound queryset pks from the
+        row, or return False if the row is not in the bound queryset.
+        """
+        if self._queryset is None:
+            return False
+        if self._pks is None:
+            self._pks = list(self._queryset.values_list('pk', flat=True))
+            self._positions = {pk: position for position, pk in enumerate(self._pks)}
+        position = self._positions.get(pk)
+        if position is None:
+            return False
+        model_cls = self._queryset.model
+        chunk = self.prepare(model_cls._default_manager.filter(
+            pk__in=self._pks[position:position + self.chunk_size]))
+        self.load_secrets(
+            chunk.values(*[self.alias(name) for name in encryption_plan(model_cls)]),
+            model_cls)
+        return True
+
+    def ciphertext(self, field_cryptor=None, hash_with_prefix=None):
+        if not hash_with_prefix:
+            return hash_with_prefix
+        secret = self.secrets.get(hash_with_prefix)
+        if secret is None:
+            secret = bytes(field_cryptor.fetch_secret(hash_with_prefix))
+        return (hash_with_prefix.encode(ENCODING)
+                + CIPHER_PREFIX.encode(ENCODING) + secret)
+
+    def restore(self, obj_dict=None, model_cls=None):
+        """Return a copy of the row with raw stored values replaced by
+        ciphertext under the field name, keeping the model field order.
+        """
+        plan = encryption_plan(model_cls)
+        if self._queryset is not None and any(
+                obj_dict.get(self.alias(name)) not in self.secrets
+                for name in plan if obj_dict.get(self.alias(name))):
+            self.load_position(obj_dict.get(model_cls._meta.pk.attname))
+        restored = {}
+        for name in field_order(model_cls):
+            alias = self.alias(name)
+            if alias in obj_dict:
+                restored[name] = self.ciphertext(plan[name], obj_dict[alias])
+            elif name in obj_dict:
+                restored[name] = obj_dict[name]
+        for key, value in obj_dict.items():
+            if key not in restored and not key.startswith(self.alias_prefix):
+                restored[key] = value
+        return restored
+
+    def reset(self, queryset=None):
+        self._queryset = queryset
+        self._pks = None
+        self._positions = {}
+        self.secrets = {}
+        self.queries = 0
@@ -0,0 +1,23 @@
+from functools import lru_cache
+
+from .export_model_lists import exclude_fields, exclude_inline_fields, exclude_m2m_fields
+
+# Columns only excluded from rows merged with a many to many value
+m2m_exclusions = frozenset(exclude_m2m_fields) - frozenset(exclude_fields)
+
+
+@lru_cache(maxsize=None)
+def export_exclusions(exclude=None):
+    """Return the columns excluded from an export file, with an extra
+    excluded column if given.
+    """
+    return frozenset(exclude_fields).union([exclude] if exclude else [])
+
+
+@lru_cache(maxsize=None)
+def inline_exclusions(model_cls):
+    """Return the columns excluded from the inline columns of a model class,
+    including the foreign keys of its inline models to the model.
+    """
+    return frozenset(exclude_inline_fields).union(
+        relation.field.attname for relation in model_cls._meta.related_objects)
@@ -1,207 +1,321 @@
 import datetime
 import os
+from contextlib import ExitStack
+from functools import lru_cache
 from django.apps import apps as django_apps
 
-import pandas as pd
 
 from .export_methods import ExportMethods
-from .export_model_lists import exclude_fields
+from .delta_export import choices_signature
+from .exclusions import export_exclusions
+from .inline_merge import InlineMerge
+from .m2m_explode import ManyToManyExplode
+from .row_projection import RowProjection
+
+
+@lru_cache(maxsize=None)
+def numeric_field_names(model_cls):
+    """Return a dictionary of field name: numeric representation of the
+    field, defined on the help text, for the fields of a model class.
+    """
+    field_names = {}
+    for field in model_cls._meta.get_fields():
+        help_text = getattr(field, 'help_text', '')
+        if bool(help_text) and any(char.isdigit() for char in help_text):
+            field_names[field.name] = help_text.replace('(', '').replace(')', '')
+    return field_names
 
 
 class ExportDataMixin:
 
-    def __init__(self, export_path=None):
+    # Inline many to many fields exported as the list of selected names
+    inline_m2m_fields = {'childprehospitalizationinline': ['reason_hospitalized']}
+
+    def __init__(self, export_path=None, export_methods_cls=None,
+                 ciphertext_passthrough=False):
         self.export_path = export_path or django_apps.get_app_config(
             'flourish_export').caregiver_path
         if not os.path.exists(self.export_path):
             os.makedirs(self.export_path)
-        self.export_methods_cls = ExportMethods()
+        if (export_methods_cls and ciphertext_passthrough
+                and not export_methods_cls.ciphertext_passthrough):
+            raise ValueError(
+                'ciphertext_passthrough is set on the export methods, not with '
+                'an export_methods_cls.')
+        self.export_methods_cls = export_methods_cls or ExportMethods(
+            ciphertext_passthrough=ciphertext_passthrough)
 
-    def export_crfs(self, crf_list=None, crf_data_dict=None, study=None):
-        """Export crf data.
+    def export_crfs(self, crf_list=None, crf_data_dict=None, study=None, delta=None):
+        """Export crf data. With a `DeltaExport` the single CRF files are
+        merged from the rows changed since the last export, see
+        `construct_crf_delta`.
         """
         for crf_name in crf_list:
-            crf_data = []
-            file_name = crf_name
             if isinstance(crf_name, dict):
-                for f_name, crf_names in crf_name.items():
-                    file_name = f_name
-                    self.combine_crf_data(
-                        crf_data, crf_data_dict, crf_names, study)
+                file_name = list(crf_name)[-1]
+                model_cls = self.get_model_cls(study, crf_name[file_name][0])
+                crf_names = [name for names in crf_name.values() for name in names]
             else:
-                self.construct_crf_data(
-                    crf_data, crf_data_dict, crf_name, study)
+                file_name = crf_name
+                model_cls = self.get_model_cls(study, crf_name)
+                crf_names = [crf_name]
 
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
             fname = study + '_' + file_name + '_' + timestamp + '.csv'
             final_path = self.export_path + fname
-            df_crf = pd.DataFrame(crf_data)
-            df_crf.to_csv(final_path, encoding='utf-8', index=False)
+            columns = self.plan_crf_columns(crf_names, study)
+            with self.export_methods_cls.csv_writer(
+                    final_path, model_cls, export_exclusions(), columns,
+                    self.numeric_columns(crf_names, study)) as crf_data:
+                if isinstance(crf_name, dict):
+                    for crf_names in crf_name.values():
+                        self.combine_crf_data(
+                            crf_data, crf_data_dict, crf_names, study)
+                elif delta is not None:
+                    self.construct_crf_delta(
+                        crf_data, crf_data_dict, crf_name, study, delta)
+                else:
+                    self.construct_crf_data(
+                        crf_data, crf_data_dict, crf_name, study)
 
     def construct_crf_data(
             self, crf_data=[], crf_data_dict={}, crf_name=None, study=None):
         crf_cls = self.get_model_cls(study, crf_name)
-        objs = crf_cls.objects.all()
+        objs = self.crf_queryset(crf_cls, study)
+        parent_rows = self.export_methods_cls.inline_flattener.rows(
+            self.crf_projection(crf_cls, study).dicts(objs), crf_cls)
         count = 0
-        for crf_obj in objs:
-            data = self.format_export_data(crf_obj, crf_data_dict, crf_cls)
+        for crf_row in parent_rows:
+            data = self.format_export_data(crf_row, crf_data_dict, crf_cls)
             crf_data.append(data)
             count += 1
 
+    def construct_crf_delta(
+            self, crf_data=[], crf_data_dict={}, crf_name=None, study=None, delta=None):
+        """Merge the rows of the CRF objects changed since the last export,
+        including changes to their visit, appointment or inlines, into the
+        snapshot of the last export and add the merged rows. The study status
+        and registered subject values of the snapshot rows are read again,
+        the snapshot is only used with the same list model choices.
+        """
+        crf_cls = self.get_model_cls(study, crf_name)
+        objs = self.crf_queryset(crf_cls, study)
+        key = f'{study}.{crf_name}'
+        signature = choices_signature(crf_cls)
+        snapshot = delta.load(key, signature)
+        changed_objs = objs
+        if snapshot is not None:
+            visit_attr = self.visit_attr(study)
+            changed_objs = delta.changed(objs, [visit_attr, f'{visit_attr}__appointment'])
+            offstudy = self.export_methods_cls.offstudy_identifiers(self.is_caregiver(study))
+        parent_rows = self.export_methods_cls.inline_flattener.rows(
+            self.crf_projection(crf_cls, study).dicts(changed_objs), crf_cls)
+        pk = crf_cls._meta.pk.attname
+        changed = {}
+        for crf_row in parent_rows:
+            row_pk = crf_row[pk]
+            changed[row_pk] = self.format_export_data(crf_row, crf_data_dict, crf_cls)
+        with delta.writer(key, signature) as saved:
+            for row_pk, row in delta.merge(snapshot, changed, delta.ids(objs)):
+                if row_pk not in changed:
+                    self.export_methods_cls.refresh_subject_data(
+                        row, self.is_caregiver(study), offstudy)
+                saved.append(row_pk, row)
+                crf_data.append(row)
+
     def get_model_cls(self, app_name, crf_name):
         return django_apps.get_model(app_name, crf_name)
 
+    def is_caregiver(self, study=None):
+        return study == 'flourish_caregiver'
+
+    def visit_attr(self, study=None):
+        return 'maternal_visit' if self.is_caregiver(study) else 'child_visit'
+
+    def crf_queryset(self, crf_cls=None, study=None):
+        """Return the CRF queryset used for the export, joined to the visit
+        and its appointment and annotated with the on/off study status of
+        the visit subject, so each row is read with a single query.
+        """
+        visit_attr = self.visit_attr(study)
+        queryset = crf_cls.objects.select_related(f'{visit_attr}__appointment')
+        queryset = self.export_methods_cls.prepare_queryset(queryset)
+        return self.export_methods_cls.annotate_onstudy(
+            queryset=queryset,
+            visit_attr=visit_attr,
+            is_caregiver=self.is_caregiver(study))
+
+    def crf_projection(self, crf_cls=None, study=None):
+        """Return the row projection of the CRF export, keeping the visit
+        foreign key and reading the visit and appointment values the CRF
+        rows are extended with across the joins.
+        """
+        visit_attr = self.visit_attr(study)
+        return RowProjection(
+            crf_cls,
+            exclude=export_exclusions(),
+            keys=[f'{visit_attr}_id'],
+            lookups=self.export_methods_cls.visit_lookups(visit_attr),
+            passthrough=self.export_methods_cls.ciphertext_passthrough)
+
+    def crf_template(self, crf_cls=None, study=None):
+        """Return the planned row template of the CRF, see
+        `ExportSchemaPlanner.crf_template`.
+        """
+        template = self.export_methods_cls.schema_planner.crf_template(
+            model_cls=crf_cls,
+            queryset=self.crf_queryset(crf_cls, study),
+            visit_attr=self.visit_attr(study),
+            is_caregiver=self.is_caregiver(study),
+            columns=self.crf_projection(crf_cls, study).model_columns)
+        if 'cbcl' in crf_cls._meta.model_name:
+            template = self.change_var_to_numeric(template, crf_cls)
+        return template
+
+    def plan_crf_columns(self, crf_names=None, study=None, template=None):
+        """Return the planned columns of a CRF export file, combining the
+        CRF sections of a combined export in order and adding any other
+        columns the rows are merged with.
+        """
+        crf_template = {}
+        for crf_name in crf_names:
+            crf_template.update(
+                self.crf_template(self.get_model_cls(study, crf_name), study))
+        crf_template.update(template or {})
+        return self.export_methods_cls.schema_planner.columns(
+            crf_template, export_exclusions())
+
     def remove_exclude_fields(self, data={}):
-        for e_field in exclude_fields:
-            try:
-                del data[e_field]
-            except KeyError:
-                pass
+        for e_field in export_exclusions().intersection(data):
+            del data[e_field]
         return data
 
     def format_export_data(self, crf_obj=None, crf_data_dict={}, model_cls=None):
-        temp_data = crf_data_dict(crf_obj=crf_obj)
-        data = self.export_methods_cls.fix_date_format(obj_dict=temp_data)
-        data = self.remove_exclude_fields(data)
-        if model_cls and 'cbcl' in model_cls._meta.model_name:
-            data = self.change_var_to_numeric(data, model_cls)
-        return data
+        """Return the export row for the crf obj, a model instance or a
+        projected row dictionary. Dates are formatted, numeric columns
+        renamed and excluded fields removed once per data frame, see
+        `export_frame` and `numeric_columns`.
+        """
+        return crf_data_dict(crf_obj=crf_obj, model_cls=model_cls)
 
     def combine_crf_data(
             self, crf_data=[], crf_data_dict={}, crf_list=[], study=None):
-        """ Combine the data from multiple common forms. Example CBCL crfs with 4 sections
+        """ Combine the data from multiple common forms. Example CBCL crfs with 4 sections.
+            Each of the other sections is read once and joined to the rows of the first
+            section by visit, updating the row in section order.
         """
+        visit_id = f'{self.visit_attr(study)}_id'
+        sections = [self.section_data(crf_data_dict, crf_name, study, visit_id)
+                    for crf_name in crf_list[1:]]
         initial_crf_cls = self.get_model_cls(study, crf_list[0])
-        objs = initial_crf_cls.objects.all()
-        for crf_obj in objs:
-            data = self.format_export_data(crf_obj, crf_data_dict, initial_crf_cls)
-
-            visit = getattr(crf_obj, 'visit', None)
-            visit_attr = crf_obj.visit_model_attr()
-            for crf_name in crf_list[1:]:
-                crf_cls = self.get_model_cls(study, crf_name)
-                try:
-                    obj = crf_cls.objects.get(**{f'{visit_attr}': visit})
-                except crf_cls.DoesNotExist:
-                    continue
-                else:
-                    combine_data = self.format_export_data(obj, crf_data_dict, crf_cls)
+        objs = self.crf_queryset(initial_crf_cls, study)
+        parent_rows = self.export_methods_cls.inline_flattener.rows(
+            self.crf_projection(initial_crf_cls, study).dicts(objs), initial_crf_cls)
+        for crf_row in parent_rows:
+            data = self.format_export_data(crf_row, crf_data_dict, initial_crf_cls)
+
+            for section in sections:
+                combine_data = section.get(crf_row[visit_id])
+                if combine_data is not None:
                     data.update(combine_data)
             crf_data.append(data)
 
+    def section_data(self, crf_data_dict={}, crf_name=None, study=None, visit_id=None):
+        """Return a dictionary of visit id: export row for a section of a
+        combined CRF, keeping the first row of a visit.
+        """
+        crf_cls = self.get_model_cls(study, crf_name)
+        objs = self.crf_queryset(crf_cls, study)
+        parent_rows = self.export_methods_cls.inline_flattener.rows(
+            self.crf_projection(crf_cls, study).dicts(objs), crf_cls)
+        section = {}
+        for crf_row in parent_rows:
+            if crf_row[visit_id] not in section:
+                section[crf_row[visit_id]] = self.format_export_data(
+                    crf_row, crf_data_dict, crf_cls)
+        return section
+
+    def numeric_columns(self, crf_names=None, study=None):
+        """Return a dictionary of field name: numeric representation of the
+        field of the CBCL CRFs, the columns renamed by the export file
+        writer. Renamed columns keep the position of their field.
+        """
+        columns = {}
+        for crf_name in crf_names:
+            crf_cls = self.get_model_cls(study, crf_name)
+            if 'cbcl' in crf_cls._meta.model_name:
+                columns.update(numeric_field_names(crf_cls))
+        return columns
+
     def change_var_to_numeric(self, data={}, model_cls=None):
         """ Replace data dictionary key with numeric representation of the field,
-            defined on the help text. NOTE: method was defined based off cbcl forms.
+            defined on the help text, keeping the key position. NOTE: method was
+            defined based off cbcl forms.
             @param data: dictionary for model data
             @param model_cls: class model
             @return: updated data with numeric representation for the fields
         """
-        model_fields = model_cls._meta.get_fields()
-        for field in model_fields:
-            numeric_text = None
-            is_digit = any(char.isdigit() for char in field.help_text)
-            if bool(field.help_text) and is_digit:
-                numeric_text = field.help_text.replace('(', '')
-                numeric_text = numeric_text.replace(')', '')
-                try:
-                    data[numeric_text] = data.pop(field.name)
-                except KeyError:
-                    continue
-        return data
+        numeric_names = numeric_field_names(model_cls)
+        return {numeric_names.get(key, key): value for key, value in data.items()}
 
     def export_inline_crfs(self, inlines_dict=None, crf_data_dict=None, study=None):
         """Export Inline data.
+
+        The rows of each CRF are read and computed once and merged with the
+        rows of each of its inlines, a file per inline.
         """
         for crf_name, inline_n_field in inlines_dict.items():
             inline, filed_n = inline_n_field
-            for inl in inline:
-
-                inline_cls = django_apps.get_model(study, inl)
-                inline_objs = inline_cls.objects.all()
-                crf_cls = django_apps.get_model(study, crf_name)
-                count = 0
-                mergered_data = []
-                crf_objs = crf_cls.objects.all()
-                for crf_obj in crf_objs:
-                    inline_objs = inline_cls.objects.filter(**{filed_n: crf_obj.id})
-                    if inline_objs:
-                        for inline_obj in inline_objs:
-
-                            in_data = inline_obj.__dict__
-
-                            if inl == 'childprehospitalizationinline':
-                                in_data['reason_hospitalized'] = list(
-                                    inline_obj.reason_hospitalized.values_list(
-                                        'name', flat=True))
-                            else:
-                                del in_data['_state']
-
-                            crfdata = crf_data_dict(crf_obj)
-
-                            # Merged inline and CRF data
-                            data = self.export_methods_cls.fix_date_format(
-                                {**crfdata, **in_data})
-                            for e_fields in exclude_fields:
-                                try:
-                                    del data[e_fields]
-                                except KeyError:
-                                    pass
-                            mergered_data.append(data)
-                            count += 1
-                    else:
-                        crfdata = self.export_methods_cls.fix_date_format(
-                            crf_data_dict(crf_obj))
-                        for e_fields in exclude_fields:
-                            try:
-                                del crfdata[e_fields]
-                            except KeyError:
-                                pass
-                        mergered_data.append(crfdata)
-                        count += 1
-                timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-                fname = study + '_' + crf_name + '_' + 'merged' '_' + inl + '_' + timestamp + '.csv'
-                final_path = self.export_path + fname
-                df_crf_inline = pd.DataFrame(mergered_data)
-                df_crf_inline.to_csv(final_path, encoding='utf-8', index=False)
+            crf_cls = django_apps.get_model(study, crf_name)
+            crf_pk = crf_cls._meta.pk.attname
+            timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+            with ExitStack() as stack:
+                merges = []
+                for inl in inline:
+                    inline_cls = django_apps.get_model(study, inl)
+                    m2m_fields = self.inline_m2m_fields.get(inl)
+                    fname = f'{study}_{crf_name}_merged_{inl}_{timestamp}.csv'
+                    final_path = self.export_path + fname
+                    inline_template = self.export_methods_cls.schema_planner.model_template(
+                        inline_cls)
+                    inline_template.update(dict.fromkeys(m2m_fields or []))
+                    columns = self.plan_crf_columns([crf_name], study, inline_template)
+                    mergered_data = stack.enter_context(self.export_methods_cls.csv_writer(
+                        final_path, crf_cls, export_exclusions(), columns))
+                    inline_merge = InlineMerge(
+                        inline_cls, filed_n, export_exclusions(), m2m_fields)
+                    merges.append((inline_merge, mergered_data))
+
+                crf_objs = self.crf_queryset(crf_cls, study)
+                parent_rows = self.export_methods_cls.inline_flattener.rows(
+                    self.crf_projection(crf_cls, study).dicts(crf_objs), crf_cls)
+                for inline_merge, _ in merges:
+                    parent_rows = inline_merge.parents(parent_rows, crf_pk)
+                for crf_obj in parent_rows:
+                    crfdata = crf_data_dict(crf_obj, model_cls=crf_cls)
+
+                    # Merged inline and CRF data
+                    for inline_merge, mergered_data in merges:
+                        mergered_data.extend(inline_merge.rows(crf_obj[crf_pk], crfdata))
 
     def generate_m2m_crf(self, m2m_class=None, crf_data_dict=None, study=None,):
 
         for crf_infor in m2m_class:
             crf_name, mm_field, _ = crf_infor
             crf_cls = django_apps.get_model(study, crf_name)
-            count = 0
-            mergered_data = []
-            crf_objs = crf_cls.objects.all()
-            for crf_obj in crf_objs:
-                mm_objs = getattr(crf_obj, mm_field).all()
-                if mm_objs:
-                    for mm_obj in mm_objs:
-                        mm_data = {mm_field: mm_obj.short_name}
-
-                        crfdata = crf_data_dict(crf_obj=crf_obj)
-
-                        # Merged many to many and CRF data
-                        data = self.export_methods_cls.fix_date_format({**crfdata, **mm_data})
-                        for e_fields in exclude_fields:
-                            try:
-                                del data[e_fields]
-                            except KeyError:
-                                pass
-                        mergered_data.append(data)
-                        count += 1
-                else:
-                    crfdata = self.export_methods_cls.fix_date_format(
-                        crf_data_dict(crf_obj=crf_obj))
-                    for e_fields in exclude_fields:
-                        try:
-                            del crfdata[e_fields]
-                        except KeyError:
-                            pass
-                    mergered_data.append(crfdata)
-                    count += 1
-
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
             fname = f'{study}_{crf_name}_merged_{mm_field}_{timestamp}.csv'
             final_path = self.export_path + fname
-            df_crf_many2many = pd.DataFrame(mergered_data)
-            df_crf_many2many.to_csv(final_path, encoding='utf-8', index=False)
+            crf_objs = self.crf_queryset(crf_cls, study)
+            parent_rows = self.export_methods_cls.inline_flattener.rows(
+                self.crf_projection(crf_cls, study).dicts(crf_objs), crf_cls)
+            crf_pk = crf_cls._meta.pk.attname
+            explode = ManyToManyExplode(crf_cls, mm_field)
+            columns = self.plan_crf_columns([crf_name], study, {mm_field: None})
+            with self.export_methods_cls.csv_writer(
+                    final_path, crf_cls, export_exclusions(), columns) as mergered_data:
+                for crf_obj in explode.parents(parent_rows):
+                    crfdata = crf_data_dict(crf_obj=crf_obj, model_cls=crf_cls)
+
+                    # Merged many to many and CRF data
+                    mergered_data.extend(explode.rows(crf_obj[crf_pk], crfdata))
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+
+from edc_base.utils import get_utcnow
+
+COMPLETE = 'complete'
+FAILED = 'failed'
+RUNNING = 'running'
+
+
+def file_checksum(path=None):
+    """Return the sha256 hex digest of a file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_state(path=None):
+    """Return the size and modification time of a file.
+    """
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+class ExportManifest:
+    """Checkpoint the models of an export so a retried or restarted export
+    skips the models it already finished.
+
+    Each model has its own JSON entry in the manifest directory, kept
+    outside the zipped export directory, with its status, row count and
+    the checksum, size and modification time of each file it wrote.
+    Entries are written atomically by the job exporting the model, so
+    concurrent jobs never write the same file. A model is complete while
+    its entry is complete and its files still match their checksums; a
+    file with its recorded size and modification time is not hashed
+    again.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    def entry_path(self, model=None):
+        return os.path.join(self.path, f'{model}.json')
+
+    def entry(self, model=None):
+        try:
+            with open(self.entry_path(model)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def entries(self):
+        if not os.path.isdir(self.path):
+            return {}
+        models = [name[:-5] for name in os.listdir(self.path) if name.endswith('.json')]
+        return {model: self.entry(model) for model in models}
+
+    def write(self, model=None, **entry):
+        os.makedirs(self.path, exist_ok=True)
+        path = self.entry_path(model)
+        with open(f'{path}.part', 'w') as f:
+            json.dump({'model': model, 'updated': get_utcnow().isoformat(), **entry}, f)
+        os.replace(f'{path}.part', path)
+
+    def is_complete(self, model=None):
+        entry = self.entry(model)
+        if not entry or entry.get('status') != COMPLETE:
+            return False
+        return all(self.file_matches(path, recorded)
+                   for path, recorded in entry.get('files', {}).items())
+
+    def file_matches(self, path=None, recorded=None):
+        """Return True if the file still matches its recorded checksum.
+        """
+        if not os.path.exists(path):
+            return False
+        if isinstance(recorded, str):
+            # Entries recorded before the file size and modification time
+            return file_checksum(path) == recorded
+        state = file_state(path)
+        if state['size'] != recorded['size']:
+            return False
+        if state['mtime_ns'] == recorded['mtime_ns']:
+            return True
+        return file_checksum(path) == recorded['checksum']
+
+    def start(self, model=None):
+        self.write(model, status=RUNNING)
+
+    def complete(self, model=None, rows=None, files=None):
+        self.write(model, status=COMPLETE, rows=rows,
+                   files={path: {'checksum': file_checksum(path), **file_state(path)}
+                          for path in files or []})
+
+    def fail(self, model=None, error=None):
+        self.write(model, status=FAILED, error=error)
@@ -1,19 +1,26 @@
 import datetime
-import re
+import logging
 from unittest import result
-from pytz import timezone
 
+import pandas as pd
 from django.apps import apps as django_apps
 from django.core.exceptions import ValidationError
-from django_crypto_fields.fields import (
-    EncryptedCharField, EncryptedDecimalField, EncryptedIntegerField,
-    EncryptedTextField, FirstnameField, IdentityField, LastnameField)
+from django.db.models import Exists, OuterRef, Subquery
 
-from .export_model_lists import exclude_inline_fields
+from .choice_catalog import choice_catalog
+from .cryptor_cache import CryptorCache
+from .csv_writer import StreamingCsvWriter
+from .date_formatter import (
+    DateColumnFormatter, date_format, export_timezone, split_column_names,
+    time_format)
+from .encryption import CiphertextPassthrough, encrypted_fields, encryption_plan
+from .exclusions import inline_exclusions
+from .inline_flattener import InlineFlattener
+from .m2m_encoder import ManyToManyEncoder
+from .schema_planner import ExportSchemaPlanner
+from .subject_lookup import RegisteredSubjectLookup
 
-encrypted_fields = [
-    EncryptedCharField, EncryptedDecimalField, EncryptedIntegerField,
-    EncryptedTextField, FirstnameField, IdentityField, LastnameField]
+logger = logging.getLogger(__name__)
 
 
 class ExportMethods:
@@ -23,6 +30,38 @@ class ExportMethods:
     caregiver_offstudy_model = 'flourish_prn.caregiveroffstudy'
     child_offstudy_model = 'flourish_prn.childoffstudy'
 
+    # Queryset annotation carrying the off study status of the visit subject
+    offstudy_annotation = '_is_offstudy'
+
+    ON_STUDY = 'On Study'
+    OFF_STUDY = 'Off Study'
+
+    # Queryset annotations carrying the latest subject consent values
+    consent_annotation_prefix = '_consent_'
+    consent_fields = ['dob', 'gender', 'screening_identifier']
+
+    # Rows formatted and written to an export file at a time
+    batch_size = 5000
+
+    # CRF row column: visit or appointment field the value is read from
+    crf_visit_columns = {
+        'visit_datetime': 'report_datetime',
+        'last_alive_date': 'last_alive_date',
+        'reason': 'reason',
+        'survival_status': 'survival_status',
+        'visit_code': 'visit_code',
+        'visit_code_sequence': 'visit_code_sequence',
+        'study_status': 'study_status',
+        'appt_status': 'appointment__appt_status',
+        'appt_datetime': 'appointment__appt_datetime'}
+
+    # Visit and appointment values added to CRF rows
+    visit_fields = ['subject_identifier'] + list(crf_visit_columns.values())
+
+    # Registered subject values added to CRF rows
+    crf_subject_columns = ['screening_age_in_years', 'registration_status', 'dob',
+                           'gender', 'subject_type', 'registration_datetime']
+
     @property
     def caregiver_offstudy_cls(self):
         return django_apps.get_model(self.caregiver_offstudy_model)
@@ -31,19 +70,51 @@ class ExportMethods:
     def child_offstudy_cls(self):
         return django_apps.get_model(self.child_offstudy_model)
 
-    def __init__(self):
+    def __init__(self, subject_lookup=None, cryptor_cache=None,
+                 ciphertext_passthrough=False):
         self.rs_cls = django_apps.get_model('edc_registration.registeredsubject')
         self.subject_consent_csl = django_apps.get_model('flourish_caregiver.subjectconsent')
+        self.subject_lookup = subject_lookup or RegisteredSubjectLookup()
+        self.cryptor_cache = cryptor_cache or CryptorCache()
+        self.date_formatter = DateColumnFormatter()
+        self.m2m_encoder = ManyToManyEncoder()
+        self.inline_flattener = InlineFlattener()
+        self.schema_planner = ExportSchemaPlanner(self)
+        self.ciphertext_passthrough = (
+            CiphertextPassthrough() if ciphertext_passthrough else None)
+
+    def clear_caches(self):
+        """Log the export scoped cache statistics and release the caches once
+        the export finishes.
+        """
+        logger.info('Export cache stats, cryptor cache: %s, registered subjects: %s, '
+                    'inline flattener: %s', self.cryptor_cache.stats,
+                    self.subject_lookup.stats, self.inline_flattener.stats)
+        self.cryptor_cache.clear()
+        self.subject_lookup.clear()
+        self.m2m_encoder.clear()
+        self.inline_flattener.clear()
+
+    def prepare_queryset(self, queryset=None):
+        """Return the queryset to read export rows from. In ciphertext
+        passthrough mode encrypted columns are read as stored.
+        """
+        if self.ciphertext_passthrough:
+            return self.ciphertext_passthrough.prepare(queryset)
+        return queryset
 
     def encrypt_values(self, obj_dict=None, obj_cls=None):
         """Ecrypt values for fields that are encypted.
         """
         result_dict_obj = {**obj_dict}
-        for key, value in obj_dict.items():
-            for f in obj_cls._meta.get_fields():
-                if key == f.name and type(f) in encrypted_fields:
-                    new_value = f.field_cryptor.encrypt(value)
-                    result_dict_obj[key] = new_value
+        if self.ciphertext_passthrough:
+            result_dict_obj = self.ciphertext_passthrough.restore(
+                result_dict_obj, obj_cls)
+        for key, field_cryptor in encryption_plan(obj_cls).items():
+            # Values restored from the stored ciphertext are not in obj_dict
+            if key in obj_dict:
+                result_dict_obj[key] = self.cryptor_cache.encrypt(
+                    field_cryptor, obj_dict[key])
         return result_dict_obj
 
     def onstudy_value(self, subject_identifier, is_caregiver):
@@ -60,8 +131,8 @@ class ExportMethods:
                 'is_caregiver cannot be null, value should either be True or False')
 
         # Value constants
-        ON_STUDY = 'On Study'
-        OFF_STUDY = 'Off Study'
+        ON_STUDY = self.ON_STUDY
+        OFF_STUDY = self.OFF_STUDY
 
         # when an exception is thrown it means the caregiver / child is offstudy
         # or inversly they are both onstudy
@@ -82,6 +153,48 @@ class ExportMethods:
 
         return result
 
+    def annotate_onstudy(self, queryset=None, visit_attr=None, is_caregiver=None):
+        """Annotate a CRF queryset with whether the visit subject is off study,
+        so the status is computed in the database with the row.
+        """
+        offstudy_cls = (
+            self.caregiver_offstudy_cls if is_caregiver else self.child_offstudy_cls)
+        offstudy = offstudy_cls.objects.filter(
+            subject_identifier=OuterRef(f'{visit_attr}__subject_identifier'))
+        return queryset.annotate(**{self.offstudy_annotation: Exists(offstudy)})
+
+    def study_status(self, data=None, subject_identifier=None, is_caregiver=None):
+        """Return the on/off study status using the queryset annotation on
+        the row, falling back to `onstudy_value` for un-annotated objects.
+        """
+        is_offstudy = data.pop(self.offstudy_annotation, None)
+        if is_offstudy is None:
+            return self.onstudy_value(
+                subject_identifier=subject_identifier, is_caregiver=is_caregiver)
+        return self.OFF_STUDY if is_offstudy else self.ON_STUDY
+
+    def offstudy_identifiers(self, is_caregiver=None):
+        """Return the set of identifiers of the subjects off study.
+        """
+        offstudy_cls = (
+            self.caregiver_offstudy_cls if is_caregiver else self.child_offstudy_cls)
+        return set(offstudy_cls.objects.values_list('subject_identifier', flat=True))
+
+    def refresh_subject_data(self, data=None, is_caregiver=None, offstudy=None):
+        """Update the study status and registered subject values of an export
+        row built earlier, see `caregiver_crf_data_dict` and `child_crf_data`,
+        from the current off study identifiers and registered subjects.
+        """
+        subject_identifier = data.get(
+            'caregiver_subject_identifier' if is_caregiver else 'child_subject_identifier')
+        data['status'] = self.OFF_STUDY if subject_identifier in offstudy else self.ON_STUDY
+        rs = self.subject_lookup.get(subject_identifier)
+        if rs is not None:
+            data.update(self.crf_subject_data(rs))
+            if not is_caregiver:
+                data['caregiver_identifier'] = rs.relative_identifier
+        return data
+
     def fix_date_format(self, obj_dict=None):
         """Change all dates into a format for the export
         and split the time into a separate value.
@@ -92,167 +205,227 @@ class ExportMethods:
         result_dict_obj = {}
         for key, value in obj_dict.items():
             if isinstance(value, datetime.datetime):
-                value = value.astimezone(timezone('Africa/Gaborone'))
-                time_value = value.time().strftime('%H:%M:%S.%f')
-                time_variable = None
-                if 'datetime' in key:
-                    time_variable = re.sub('datetime', 'time', key)
-                else:
-                    time_variable = key + '_time'
-                value = value.strftime('%m/%d/%Y')
-                new_key = re.sub('time', '', key)
-                result_dict_obj[new_key] = value
+                value = value.astimezone(export_timezone)
+                time_value = value.time().strftime(time_format)
+                new_key, time_variable = split_column_names(key)
+                result_dict_obj[new_key] = value.strftime(date_format)
                 result_dict_obj[time_variable] = time_value
                 continue
             elif isinstance(value, datetime.date):
-                value = value.strftime('%m/%d/%Y')
+                value = value.strftime(date_format)
                 result_dict_obj[key] = value
                 continue
             result_dict_obj[key] = value
         return result_dict_obj
 
-    def caregiver_crf_data_dict(self, crf_obj=None):
+    def export_frame(self, rows=None, model_cls=None, exclude=None, dtype=None,
+                     rename=None):
+        """Return the export data frame for rows of unformatted data, with
+        the date columns formatted once for the frame, the `rename` columns
+        renamed in place and the excluded columns removed.
+        """
+        df = self.date_formatter.format(
+            pd.DataFrame(rows, dtype=dtype), model_cls, rows=rows)
+        if rename:
+            df = df.rename(columns=rename)
+        exclude_columns = [column for column in exclude or [] if column in df.columns]
+        return df.drop(columns=exclude_columns)
+
+    def obj_data(self, obj=None, model_cls=None):
+        """Return the encrypted export data and the model class for a model
+        instance or a projected row dictionary, see `RowProjection`.
+        """
+        if isinstance(obj, dict):
+            return self.encrypt_values(obj_dict=obj, obj_cls=model_cls), model_cls
+        return self.encrypt_values(obj_dict=obj.__dict__, obj_cls=obj.__class__), obj.__class__
+
+    def obj_pk(self, obj=None, model_cls=None):
+        if isinstance(obj, dict):
+            return obj[model_cls._meta.pk.attname]
+        return obj.pk
+
+    def visit_lookups(self, visit_attr=None):
+        """Return the visit and appointment lookups projected with CRF rows.
+        """
+        return [f'{visit_attr}__{name}' for name in self.visit_fields]
+
+    def visit_values(self, data=None, crf_obj=None, visit_attr=None):
+        """Return a dictionary of visit field: value for the CRF row, taken,
+        and removed, from the projected visit lookups of a row dictionary
+        or read from the visit of a model instance.
+        """
+        if isinstance(crf_obj, dict):
+            return {name: data.pop(f'{visit_attr}__{name}')
+                    for name in self.visit_fields}
+        visit = getattr(crf_obj, visit_attr)
+        values = {}
+        for name in self.visit_fields:
+            value = visit
+            for attr in name.split('__'):
+                value = getattr(value, attr)
+            values[name] = value
+        return values
+
+    def csv_writer(self, path=None, model_cls=None, exclude=None, columns=None,
+                   rename=None):
+        """Return a streaming CSV writer for the export rows of the model.
+        """
+        return StreamingCsvWriter(
+            path=path, export_methods=self, model_cls=model_cls, exclude=exclude,
+            columns=columns, batch_size=self.batch_size, rename=rename)
+
+    def crf_visit_data(self, visit=None):
+        return {column: visit[name] for column, name in self.crf_visit_columns.items()}
+
+    def crf_subject_data(self, rs=None):
+        return {name: getattr(rs, name) for name in self.crf_subject_columns}
+
+    def caregiver_crf_data_dict(self, crf_obj=None, model_cls=None):
         """Return a crf obj dict adding extra required fields.
         """
 
-        data = crf_obj.__dict__
-        data = self.encrypt_values(obj_dict=data, obj_cls=crf_obj.__class__)
+        data, model_cls = self.obj_data(crf_obj, model_cls)
+        visit = self.visit_values(data, crf_obj, 'maternal_visit')
         data.update(
-            caregiver_subject_identifier=crf_obj.maternal_visit.subject_identifier,
-            visit_datetime=crf_obj.maternal_visit.report_datetime,
-            last_alive_date=crf_obj.maternal_visit.last_alive_date,
-            reason=crf_obj.maternal_visit.reason,
-            survival_status=crf_obj.maternal_visit.survival_status,
-            visit_code=crf_obj.maternal_visit.visit_code,
-            visit_code_sequence=crf_obj.maternal_visit.visit_code_sequence,
-            study_status=crf_obj.maternal_visit.study_status,
-            appt_status=crf_obj.maternal_visit.appointment.appt_status,
-            appt_datetime=crf_obj.maternal_visit.appointment.appt_datetime,
-            status=self.onstudy_value(
-                subject_identifier=crf_obj.maternal_visit.subject_identifier,
+            caregiver_subject_identifier=visit['subject_identifier'],
+            **self.crf_visit_data(visit),
+            status=self.study_status(
+                data=data,
+                subject_identifier=visit['subject_identifier'],
                 is_caregiver=True,
             )
         )
-        try:
-            rs = self.rs_cls.objects.get(
-                subject_identifier=crf_obj.maternal_visit.subject_identifier)
-        except self.rs_cls.DoesNotExist:
+        rs = self.subject_lookup.get(visit['subject_identifier'])
+        if rs is None:
             raise ValidationError('RegisteredSubject can not be missing')
         else:
-            data.update(
-                screening_age_in_years=rs.screening_age_in_years,
-                registration_status=rs.registration_status,
-                dob=rs.dob,
-                gender=rs.gender,
-                subject_type=rs.subject_type,
-                registration_datetime=rs.registration_datetime,
-            )
-        data.update(self.m2m_data_dict(crf_obj))
-        data.update(self.inline_data_dict(crf_obj))
+            data.update(self.crf_subject_data(rs))
+        data.update(self.m2m_data_dict(crf_obj, model_cls=model_cls))
+        data.update(self.inline_data_dict(crf_obj, model_cls=model_cls))
         return data
 
-    def m2m_data_dict(self, model_obj=None, inline_count=None):
+    def m2m_data_dict(self, model_obj=None, inline_count=None, model_cls=None):
         data = {}
-        m2m_fields = model_obj._meta.many_to_many
+        model_cls = model_cls or model_obj.__class__
+        pk = self.obj_pk(model_obj, model_cls)
+        m2m_fields = model_cls._meta.many_to_many
         for field in m2m_fields:
-            model_cls = field.related_model
-            choices = self.m2m_list_data(model_cls=model_cls)
-            key_manager = getattr(model_obj, field.name)
-            for choice in choices:
+            for choice, selected in self.m2m_encoder.encode(field, pk):
                 field_name = f'{field.name}__{choice}'
                 field_name = f'{field_name}__{inline_count}' if inline_count else field_name
-                data[field_name] = 0
-                try:
-                    key_manager.get(short_name=choice)
-                except model_cls.DoesNotExist:
-                    continue
-                else:
-                    data[field_name] = 1
+                data[field_name] = selected
         return data
 
-    def inline_data_dict(self, model_obj):
+    def related_objs(self, model_obj=None, relation=None, model_cls=None):
+        """Return the inline objects of a relation not covered by the inline
+        flattener.
+        """
+        if isinstance(model_obj, dict):
+            if not relation.one_to_many:
+                return []
+            return relation.related_model._default_manager.filter(
+                **{f'{relation.field.name}__pk': self.obj_pk(model_obj, model_cls)})
+        key_manager = getattr(model_obj, f'{relation.name}_set',
+                              getattr(model_obj, f'{relation.related_name}', None))
+        return key_manager.all() if key_manager else []
+
+    def inline_data_dict(self, model_obj=None, model_cls=None):
         data = {}
-        inline_fields = model_obj._meta.related_objects
+        model_cls = model_cls or model_obj.__class__
+        exclude = inline_exclusions(model_cls)
+        inline_fields = model_cls._meta.related_objects
         for field in inline_fields:
-            key_manager = getattr(model_obj, f'{field.name}_set',
-                                  getattr(model_obj, f'{field.related_name}', None))
-            field_id = field.field.attname
-            exclude_inline_fields.append(field_id)
-            if key_manager:
-                inline_values = key_manager.all()
+            inline_values = self.inline_flattener.children(model_obj, field, model_cls)
+            if inline_values is None:
+                inline_values = self.related_objs(model_obj, field, model_cls)
+            if inline_values:
                 for count, obj in enumerate(inline_values):
                     inline_data = obj.__dict__
                     inline_data = {f'{key}__{count}': value for key,
-                                   value in inline_data.items() if key not in exclude_inline_fields}
+                                   value in inline_data.items() if key not in exclude}
                     inline_data.update(self.m2m_data_dict(obj, str(count)))
                     data.update(inline_data)
         return data
 
-    def child_crf_data(self, crf_obj=None):
+    def child_crf_data(self, crf_obj=None, model_cls=None):
         """Return a dictionary for a crf object with additional participant information.
         """
 
-        data = crf_obj.__dict__
-        data = self.encrypt_values(obj_dict=data, obj_cls=crf_obj.__class__)
+        data, model_cls = self.obj_data(crf_obj, model_cls)
+        visit = self.visit_values(data, crf_obj, 'child_visit')
         data.update(
-            child_subject_identifier=crf_obj.child_visit.subject_identifier,
-            visit_datetime=crf_obj.child_visit.report_datetime,
-            last_alive_date=crf_obj.child_visit.last_alive_date,
-            reason=crf_obj.child_visit.reason,
-            survival_status=crf_obj.child_visit.survival_status,
-            visit_code=crf_obj.child_visit.visit_code,
-            visit_code_sequence=crf_obj.child_visit.visit_code_sequence,
-            study_status=crf_obj.child_visit.study_status,
-            appt_status=crf_obj.child_visit.appointment.appt_status,
-            appt_datetime=crf_obj.child_visit.appointment.appt_datetime,
-            status=self.onstudy_value(
-                subject_identifier=crf_obj.child_visit.subject_identifier,
+            child_subject_identifier=visit['subject_identifier'],
+            **self.crf_visit_data(visit),
+            status=self.study_status(
+                data=data,
+                subject_identifier=visit['subject_identifier'],
                 is_caregiver=False,
             )
         )
 
-        try:
-            rs = self.rs_cls.objects.get(
-                subject_identifier=crf_obj.child_visit.subject_identifier)
-        except self.rs_cls.DoesNotExist:
-
+        rs = self.subject_lookup.get(visit['subject_identifier'])
+        if rs is None:
             raise ValidationError('RegisteredSubject can not be missing')
         else:
             data.update(
-                screening_age_in_years=rs.screening_age_in_years,
-                registration_status=rs.registration_status,
-                dob=rs.dob,
-                gender=rs.gender,
-                subject_type=rs.subject_type,
-                registration_datetime=rs.registration_datetime,
+                self.crf_subject_data(rs),
                 caregiver_identifier=rs.relative_identifier
             )
-        data.update(self.m2m_data_dict(crf_obj))
-        data.update(self.inline_data_dict(crf_obj))
+        data.update(self.m2m_data_dict(crf_obj, model_cls=model_cls))
+        data.update(self.inline_data_dict(crf_obj, model_cls=model_cls))
         return data
 
-    def non_crf_obj_dict(self, obj=None):
+    def annotate_consent(self, queryset=None):
+        """Annotate a non crf queryset with the latest subject consent, by
+        created, of the row subject so it is read with the row.
+        """
+        field_names = [f.attname for f in queryset.model._meta.concrete_fields]
+        if 'subject_identifier' not in field_names:
+            return queryset
+        consents = self.subject_consent_csl.objects.filter(
+            subject_identifier=OuterRef('subject_identifier')).order_by('-created')
+        annotations = {
+            f'{self.consent_annotation_prefix}{name}': Subquery(consents.values(name)[:1])
+            for name in ['id'] + self.consent_fields}
+        return queryset.annotate(**annotations)
+
+    def latest_consent(self, data=None):
+        """Return a dictionary of the latest subject consent values for the
+        row, or None if the subject has no consent. Values are taken, and
+        removed, from the queryset annotations on the row, or queried for
+        objects that were not annotated.
+        """
+        prefix = self.consent_annotation_prefix
+        if f'{prefix}id' in data:
+            consent = {name: data.pop(f'{prefix}{name}')
+                       for name in ['id'] + self.consent_fields}
+            return consent if consent.pop('id') is not None else None
+        if 'subject_identifier' not in data:
+            return None
+        subject_consent = self.subject_consent_csl.objects.filter(
+            subject_identifier=data['subject_identifier']).order_by('created').last()
+        if not subject_consent:
+            return None
+        return {name: getattr(subject_consent, name) for name in self.consent_fields}
+
+    def non_crf_obj_dict(self, obj=None, model_cls=None):
         """Return a dictionary of non crf object.
         """
 
-        data = obj.__dict__
-        data = self.encrypt_values(obj_dict=data, obj_cls=obj.__class__)
+        data, model_cls = self.obj_data(obj, model_cls)
+        subject_consent = self.latest_consent(data)
         if 'subject_identifier' in data:
-            subject_consent = self.subject_consent_csl.objects.filter(
-                subject_identifier=obj.subject_identifier).last()
-
             if subject_consent:
                 if 'dob' not in data:
-                    data.update(dob=subject_consent.dob)
+                    data.update(dob=subject_consent['dob'])
                 if 'gender' in data:
-                    data.update(gender=subject_consent.gender)
+                    data.update(gender=subject_consent['gender'])
                 if 'screening_identifier' not in data:
-                    data.update(screening_identifier=subject_consent.screening_identifier)
+                    data.update(screening_identifier=subject_consent['screening_identifier'])
 
             if 'registration_datetime' not in data:
-                try:
-                    rs = self.rs_cls.objects.get(subject_identifier=obj.subject_identifier)
-                except self.rs_cls.DoesNotExist:
+                rs = self.subject_lookup.get(data['subject_identifier'])
+                if rs is None:
                     data.update(
                         registration_datetime=None,
                         screening_datetime=None
@@ -271,18 +444,15 @@ class ExportMethods:
                 gender=None,
 
             )
-        data.update(self.m2m_data_dict(obj))
-        data.update(self.inline_data_dict(obj))
+        data.update(self.m2m_data_dict(obj, model_cls=model_cls))
+        data.update(self.inline_data_dict(obj, model_cls=model_cls))
         return data
 
-    def follow_data_dict(self, model_obj=None):
-        data = model_obj.__dict__
-        data = self.encrypt_values(obj_dict=data, obj_cls=model_obj.__class__)
-        data.update(self.m2m_data_dict(model_obj))
-        data.update(self.inline_data_dict(model_obj))
+    def follow_data_dict(self, model_obj=None, model_cls=None):
+        data, model_cls = self.obj_data(model_obj, model_cls)
+        data.update(self.m2m_data_dict(model_obj, model_cls=model_cls))
+        data.update(self.inline_data_dict(model_obj, model_cls=model_cls))
         return data
 
     def m2m_list_data(self, model_cls=None):
-        qs = model_cls.objects.order_by(
-            'created').values_list('short_name', flat=True)
-        return list(qs)
+        return choice_catalog.short_names(model_cls)
@@ -1,26 +1,53 @@
 from django.apps import apps as django_apps
 from django.core.exceptions import ValidationError
-import pandas as pd
 import datetime
 import os
 
 from .export_methods import ExportMethods
-from .export_model_lists import exclude_fields, exclude_m2m_fields
+from .exclusions import export_exclusions, m2m_exclusions
+from .m2m_explode import ManyToManyExplode
+from .row_projection import RowProjection
 
 
 class ExportNonCrfData:
     """Export data.
     """
 
-    def __init__(self, export_path=None):
+    def __init__(self, export_path=None, export_methods_cls=None,
+                 ciphertext_passthrough=False):
         self.export_path = export_path or django_apps.get_app_config(
             'flourish_export').non_crf_path
         if not os.path.exists(self.export_path):
             os.makedirs(self.export_path)
-        self.export_methods_cls = ExportMethods()
+        if (export_methods_cls and ciphertext_passthrough
+                and not export_methods_cls.ciphertext_passthrough):
+            raise ValueError(
+                'ciphertext_passthrough is set on the export methods, not with '
+                'an export_methods_cls.')
+        self.export_methods_cls = export_methods_cls or ExportMethods(
+            ciphertext_passthrough=ciphertext_passthrough)
         self.rs_cls = django_apps.get_model('edc_registration.registeredsubject')
         self.appointment_cls = django_apps.get_model('edc_appointment.appointment')
 
+    @property
+    def subject_lookup(self):
+        return self.export_methods_cls.subject_lookup
+
+    def projection(self, model_cls=None, exclude=None):
+        """Return the row projection of a non crf export.
+        """
+        return RowProjection(
+            model_cls, exclude=export_exclusions(exclude),
+            passthrough=self.export_methods_cls.ciphertext_passthrough)
+
+    def remove_m2m_exclude_fields(self, data={}):
+        """Remove the fields only excluded from rows merged with a many to
+        many value, the common excluded fields are removed per data frame.
+        """
+        for e_field in m2m_exclusions.intersection(data):
+            del data[e_field]
+        return data
+
     def caregiver_non_crfs(self, caregiver_model_list=None, exclude=None, study=None):
         """E.
         """
@@ -31,99 +58,56 @@ class ExportNonCrfData:
                 model_cls = self.appointment_cls
             else:
                 model_cls = django_apps.get_model(study, model_name)
-            objs = model_cls.objects.all()
-            count = 0
-            models_data = []
-
-            for obj in objs:
-                data = self.export_methods_cls.fix_date_format(
-                    self.export_methods_cls.non_crf_obj_dict(obj=obj))
-                if exclude:
-                    exclude_fields.append(exclude)
-
-                for e_fields in exclude_fields:
-                    try:
-                        del data[e_fields]
-                    except KeyError:
-                        pass
-                models_data.append(data)
-                count += 1
+            objs = self.export_methods_cls.prepare_queryset(model_cls.objects.all())
+            objs = self.export_methods_cls.annotate_consent(objs)
+            parent_rows = self.export_methods_cls.inline_flattener.rows(
+                self.projection(model_cls, exclude).dicts(objs), model_cls)
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
             fname = f'{study}_' + model_name + '_' + timestamp + '.csv'
             final_path = self.export_path + fname
-            df_crf = pd.DataFrame(models_data)
-            df_crf.rename(columns={'subject_identifier':
-                                   'subject_identifier'}, inplace=True)
-            df_crf.to_csv(final_path, encoding='utf-8', index=False)
+            with self.export_methods_cls.csv_writer(
+                    final_path, model_cls, export_exclusions(exclude)) as models_data:
+                for row in parent_rows:
+                    models_data.append(self.export_methods_cls.non_crf_obj_dict(
+                        obj=row, model_cls=model_cls))
 
     def follow_models(self, follow_model_list=None, exclude=None, study=None):
         for model_name in follow_model_list:
             model_cls = django_apps.get_model(study, model_name)
-            objs = model_cls.objects.all()
-            count = 0
-            models_data = []
-
-            for obj in objs:
-                data = self.export_methods_cls.fix_date_format(
-                    self.export_methods_cls.follow_data_dict(model_obj=obj))
-                if exclude:
-                    exclude_fields.append(exclude)
-
-                for e_fields in exclude_fields:
-                    try:
-                        del data[e_fields]
-                    except KeyError:
-                        pass
-                models_data.append(data)
-                count += 1
+            objs = self.export_methods_cls.prepare_queryset(model_cls.objects.all())
+            parent_rows = self.export_methods_cls.inline_flattener.rows(
+                self.projection(model_cls, exclude).dicts(objs), model_cls)
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
             fname = f'{study}_' + model_name + '_' + timestamp + '.csv'
             final_path = self.export_path + fname
-            df_crf = pd.DataFrame(models_data)
-            df_crf.to_csv(final_path, encoding='utf-8', index=False)
+            with self.export_methods_cls.csv_writer(
+                    final_path, model_cls, export_exclusions(exclude)) as models_data:
+                for row in parent_rows:
+                    models_data.append(self.export_methods_cls.follow_data_dict(
+                        model_obj=row, model_cls=model_cls))
 
     def follow_m2m(self, many_to_many_models=None, study=None):
         for follow_model_info in many_to_many_models:
             model_name, mm_field, _ = follow_model_info
             model_cls = django_apps.get_model(study, model_name)
-            count = 0
-            mergered_data = []
-            model_objs = model_cls.objects.all()
-            for model_obj in model_objs:
-                mm_objs = getattr(model_obj, mm_field).all()
-                if mm_objs:
-                    for mm_obj in mm_objs:
-                        mm_data = {mm_field: mm_obj.short_name}
-
-                        model_data = self.export_methods_cls.follow_data_dict(
-                            model_obj=model_obj)
-
-                        # Merged many to many and CRF data
-                        data = self.export_methods_cls.fix_date_format(
-                            {**model_data, **mm_data})
-                        for e_fields in exclude_m2m_fields:
-                            try:
-                                del data[e_fields]
-                            except KeyError:
-                                pass
-                        mergered_data.append(data)
-                        count += 1
-                else:
-                    model_data = self.export_methods_cls.fix_date_format(
-                        self.export_methods_cls.follow_data_dict(model_obj=model_obj))
-                    for e_fields in exclude_fields:
-                        try:
-                            del model_data[e_fields]
-                        except KeyError:
-                            pass
-                    mergered_data.append(model_data)
-                    count += 1
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
             fname = f'{study}_' + model_name + '_' + \
                 'merged' '_' + mm_field + '_' + timestamp + '.csv'
             final_path = self.export_path + fname
-            df_crf_many2many = pd.DataFrame(mergered_data)
-            df_crf_many2many.to_csv(final_path, encoding='utf-8', index=False)
+            model_objs = self.export_methods_cls.prepare_queryset(model_cls.objects.all())
+            parent_rows = self.export_methods_cls.inline_flattener.rows(
+                self.projection(model_cls).dicts(model_objs), model_cls)
+            explode = ManyToManyExplode(model_cls, mm_field)
+            pk = model_cls._meta.pk.attname
+            with self.export_methods_cls.csv_writer(
+                    final_path, model_cls, export_exclusions()) as mergered_data:
+                for model_obj in explode.parents(parent_rows):
+                    model_data = self.export_methods_cls.follow_data_dict(
+                        model_obj=model_obj, model_cls=model_cls)
+
+                    # Merged many to many and CRF data
+                    mergered_data.extend(explode.rows(
+                        model_obj[pk], model_data, clean=self.remove_m2m_exclude_fields))
 
     def caregiver_m2m_non_crf(self, caregiver_many_to_many_non_crf=None, study=None):
         """.
@@ -132,91 +116,63 @@ class ExportNonCrfData:
         for crf_infor in caregiver_many_to_many_non_crf:
             crf_name, mm_field = crf_infor
             crf_cls = django_apps.get_model(study, crf_name)
-            count = 0
-            mergered_data = []
-            crf_objs = crf_cls.objects.all()
-            for crf_obj in crf_objs:
-                mm_objs = getattr(crf_obj, mm_field).all()
-                if mm_objs:
-                    for mm_obj in mm_objs:
-                        mm_data = {mm_field: mm_obj.short_name}
-
-                        crfdata = self.export_methods_cls.non_crf_obj_dict(obj=crf_obj)
-
-                        # Merged many to many and CRF data
-                        data = self.export_methods_cls.fix_date_format({**crfdata, **mm_data})
-                        for e_fields in exclude_m2m_fields:
-                            try:
-                                del data[e_fields]
-                            except KeyError:
-                                pass
-                        mergered_data.append(data)
-                        count += 1
-                else:
-                    crfdata = self.export_methods_cls.fix_date_format(
-                        self.export_methods_cls.non_crf_obj_dict(obj=crf_obj))
-                    for e_fields in exclude_fields:
-                        try:
-                            del crfdata[e_fields]
-                        except KeyError:
-                            pass
-                    mergered_data.append(crfdata)
-                    count += 1
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
             fname = f'{study}_' + crf_name + '_' + \
                 'merged' '_' + mm_field + '_' + timestamp + '.csv'
             final_path = self.export_path + fname
-            df_crf_many2many = pd.DataFrame(mergered_data)
-            df_crf_many2many.to_csv(final_path, encoding='utf-8', index=False)
+            crf_objs = self.export_methods_cls.prepare_queryset(crf_cls.objects.all())
+            crf_objs = self.export_methods_cls.annotate_consent(crf_objs)
+            parent_rows = self.export_methods_cls.inline_flattener.rows(
+                self.projection(crf_cls).dicts(crf_objs), crf_cls)
+            explode = ManyToManyExplode(crf_cls, mm_field)
+            pk = crf_cls._meta.pk.attname
+            with self.export_methods_cls.csv_writer(
+                    final_path, crf_cls, export_exclusions()) as mergered_data:
+                for crf_obj in explode.parents(parent_rows):
+                    crfdata = self.export_methods_cls.non_crf_obj_dict(
+                        obj=crf_obj, model_cls=crf_cls)
+
+                    # Merged many to many and CRF data
+                    mergered_data.extend(explode.rows(
+                        crf_obj[pk], crfdata, clean=self.remove_m2m_exclude_fields))
 
     def child_non_crf(self, child_model_list=None):
         """.
         """
         for model_name in child_model_list:
             model_cls = django_apps.get_model('flourish_child', model_name)
-            objs = model_cls.objects.all()
-            count = 0
-            models_data = []
-            for obj in objs:
-                data = obj.__dict__
-                data = self.export_methods_cls.encrypt_values(data, obj.__class__)
-                try:
-                    rs = self.rs_cls.objects.get(subject_identifier=obj.subject_identifier)
-                except self.rs_cls.DoesNotExist:
-                    if not 'dob' in data:
-                        data.update(dob=None)
-                    if not 'gender' in data:
-                        data.update(gender=None)
-                    data.update(
-                        relative_identifier=None,
-                        screening_age_in_years=None,
-                        registration_datetime=None
-                    )
-                else:
-                    if not 'dob' in data:
-                        data.update(dob=rs.dob)
-                    if not 'gender' in data:
-                        data.update(gender=rs.gender)
-                    if not 'screening_identifier' in data:
-                        data.update(screening_identifier=rs.screening_identifier)
-                    data.update(
-                        relative_identifier=rs.relative_identifier,
-                        screening_age_in_years=rs.screening_age_in_years,
-                        registration_datetime=rs.registration_datetime
-                    )
-                last_data = self.export_methods_cls.fix_date_format(data)
-                for e_fields in exclude_fields:
-                    try:
-                        del last_data[e_fields]
-                    except KeyError:
-                        pass
-                models_data.append(last_data)
-                count += 1
+            objs = self.export_methods_cls.prepare_queryset(model_cls.objects.all())
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
             fname = 'flourish_child_' + model_name + '_' + timestamp + '.csv'
             final_path = self.export_path + fname
-            df_crf = pd.DataFrame(models_data)
-            df_crf.to_csv(final_path, encoding='utf-8', index=False)
+            with self.export_methods_cls.csv_writer(
+                    final_path, model_cls, export_exclusions()) as models_data:
+                for row in self.projection(model_cls).dicts(objs):
+                    data = self.export_methods_cls.encrypt_values(row, model_cls)
+                    rs = self.subject_lookup.get(data['subject_identifier'])
+                    if rs is None:
+                        if not 'dob' in data:
+                            data.update(dob=None)
+                        if not 'gender' in data:
+                            data.update(gender=None)
+                        data.update(
+                            relative_identifier=None,
+                            screening_age_in_years=None,
+                            registration_datetime=None
+                        )
+                    else:
+                        if not 'dob' in data:
+                            data.update(dob=rs.dob)
+                        if not 'gender' in data:
+                            data.update(gender=rs.gender)
+                        if not 'screening_identifier' in data:
+                            data.update(screening_identifier=rs.screening_identifier)
+                        data.update(
+                            relative_identifier=rs.relative_identifier,
+                            screening_age_in_years=rs.screening_age_in_years,
+                            registration_datetime=rs.registration_datetime
+                        )
+                    models_data.append(data)
 
     def offstudy(self, offstudy_prn_model_list=None):
         """Export off study forms.
@@ -224,117 +180,78 @@ class ExportNonCrfData:
 
         for model_name in offstudy_prn_model_list:
             model_cls = django_apps.get_model('flourish_prn', model_name)
-            objs = model_cls.objects.all()
-            count = 0
-            models_data = []
-            for obj in objs:
-                data = obj.__dict__
-                data = self.export_methods_cls.encrypt_values(data, obj.__class__)
-                try:
-                    rs = self.rs_cls.objects.get(subject_identifier=obj.subject_identifier)
-                except self.rs_cls.DoesNotExist:
-                    raise ValidationError('Registered subject can not be missing')
-                else:
-                    if not 'dob' in data:
-                        data.update(dob=rs.dob)
-                    if not 'gender' in data:
-                        data.update(gender=rs.gender)
-                    if not 'screening_identifier' in data:
-                        data.update(screening_identifier=rs.screening_identifier)
-                    data.update(
-                        relative_identifier=rs.relative_identifier,
-                        screening_age_in_years=rs.screening_age_in_years,
-                        registration_datetime=rs.registration_datetime
-                    )
-                last_data = self.export_methods_cls.fix_date_format(data)
-                for e_fields in exclude_fields:
-                    try:
-                        del last_data[e_fields]
-                    except KeyError:
-                        pass
-                models_data.append(last_data)
-                count += 1
+            objs = self.export_methods_cls.prepare_queryset(model_cls.objects.all())
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
             fname = 'flourish_prn_' + model_name + '_' + timestamp + '.csv'
             final_path = self.export_path + fname
-            df_crf = pd.DataFrame(models_data)
-            df_crf.to_csv(final_path, encoding='utf-8', index=False)
+            with self.export_methods_cls.csv_writer(
+                    final_path, model_cls, export_exclusions()) as models_data:
+                for row in self.projection(model_cls).dicts(objs):
+                    data = self.export_methods_cls.encrypt_values(row, model_cls)
+                    rs = self.subject_lookup.get(data['subject_identifier'])
+                    if rs is None:
+                        raise ValidationError('Registered subject can not be missing')
+                    else:
+                        if not 'dob' in data:
+                            data.update(dob=rs.dob)
+                        if not 'gender' in data:
+                            data.update(gender=rs.gender)
+                        if not 'screening_identifier' in data:
+                            data.update(screening_identifier=rs.screening_identifier)
+                        data.update(
+                            relative_identifier=rs.relative_identifier,
+                            screening_age_in_years=rs.screening_age_in_years,
+                            registration_datetime=rs.registration_datetime
+                        )
+                    models_data.append(data)
 
     def death_report(self, death_report_prn_model_list=None):
         # Export child Non CRF data
         for model_name in death_report_prn_model_list:
             model_cls = django_apps.get_model('flourish_prn', model_name)
-            objs = model_cls.objects.all()
-            count = 0
-            models_data = []
-            for obj in objs:
-                data = obj.__dict__
-                try:
-                    rs = self.rs_cls.objects.get(subject_identifier=obj.subject_identifier)
-                except self.rs_cls.DoesNotExist:
-                    raise ValidationError('Registered subject can not be missing')
-                else:
-                    if not 'dob' in data:
-                        data.update(dob=rs.dob)
-                    if not 'gender' in data:
-                        data.update(gender=rs.gender)
-                    if not 'screening_identifier' in data:
-                        data.update(screening_identifier=rs.screening_identifier)
-                    data.update(
-                        relative_identifier=rs.relative_identifier,
-                        screening_age_in_years=rs.screening_age_in_years,
-                        registration_datetime=rs.registration_datetime
-                    )
-                data = self.export_methods_cls.encrypt_values(data, obj.__class__)
-                last_data = self.export_methods_cls.fix_date_format(data)
-                for e_fields in exclude_fields:
-                    try:
-                        del last_data[e_fields]
-                    except KeyError:
-                        pass
-                models_data.append(last_data)
-                count += 1
+            objs = self.export_methods_cls.prepare_queryset(model_cls.objects.all())
             timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
             fname = 'flourish_prn_' + model_name + '_' + timestamp + '.csv'
             final_path = self.export_path + fname
-            df_crf = pd.DataFrame(models_data)
-            df_crf.to_csv(final_path, encoding='utf-8', index=False)
+            with self.export_methods_cls.csv_writer(
+                    final_path, model_cls, export_exclusions()) as models_data:
+                for data in self.projection(model_cls).dicts(objs):
+                    rs = self.subject_lookup.get(data['subject_identifier'])
+                    if rs is None:
+                        raise ValidationError('Registered subject can not be missing')
+                    else:
+                        if not 'dob' in data:
+                            data.update(dob=rs.dob)
+                        if not 'gender' in data:
+                            data.update(gender=rs.gender)
+                        if not 'screening_identifier' in data:
+                            data.update(screening_identifier=rs.screening_identifier)
+                        data.update(
+                            relative_identifier=rs.relative_identifier,
+                            screening_age_in_years=rs.screening_age_in_years,
+                            registration_datetime=rs.registration_datetime
+                        )
+                    data = self.export_methods_cls.encrypt_values(data, model_cls)
+                    models_data.append(data)
 
     def caregiver_visit(self):
 
-        caregiver_visits = django_apps.get_model(
-            'flourish_caregiver.maternalvisit').objects.all()
-        data = []
-        for mv in caregiver_visits:
-            d = mv.__dict__
-            d = self.export_methods_cls.fix_date_format(d)
-            for e_fields in exclude_fields:
-                try:
-                    del d[e_fields]
-                except KeyError:
-                    pass
-            data.append(d)
+        visit_cls = django_apps.get_model('flourish_caregiver.maternalvisit')
+        caregiver_visits = visit_cls.objects.all()
         timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
         fname = 'flourish_caregiver_maternal_visit' + '_' + timestamp + '.csv'
         final_path = self.export_path + fname
-        df_crf = pd.DataFrame(data)
-        df_crf.to_csv(final_path, encoding='utf-8', index=False)
+        with self.export_methods_cls.csv_writer(
+                final_path, visit_cls, export_exclusions()) as visit_data:
+            visit_data.extend(self.projection(visit_cls).dicts(caregiver_visits))
 
     def child_visit(self):
 
-        child_visits = django_apps.get_model('flourish_child.childvisit').objects.all()
-        data = []
-        for mv in child_visits:
-            d = mv.__dict__
-            d = self.export_methods_cls.fix_date_format(d)
-            for e_fields in exclude_fields:
-                try:
-                    del d[e_fields]
-                except KeyError:
-                    pass
-            data.append(d)
+        visit_cls = django_apps.get_model('flourish_child.childvisit')
+        child_visits = visit_cls.objects.all()
         timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
         fname = 'flourish_child_child_visit' + '_' + timestamp + '.csv'
         final_path = self.export_path + fname
-        df_crf = pd.DataFrame(data)
-        df_crf.to_csv(final_path, encoding='utf-8', index=False)
+        with self.export_methods_cls.csv_writer(
+                final_path, visit_cls, export_exclusions()) as visit_data:
+            visit_data.extend(self.projection(visit_cls).dicts(child_visits))
@@ -0,0 +1,136 @@
+from collections import defaultdict
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def inline_relations(model_cls):
+    """Return the reverse foreign key (inline) relations of a model class.
+    """
+    return tuple(relation for relation in model_cls._meta.related_objects
+                 if relation.one_to_many)
+
+
+class InlineFlattener:
+    """Prefetch the inline rows of parent objects a chunk at a time.
+
+    Pass the parent rows through `rows` as they are exported, then ask
+    for the children of each parent. Every `chunk_size` parent rows are
+    buffered and every inline relation is read for the buffered parents
+    with one query per relation, the children grouped by parent in
+    memory. Parents iterated elsewhere, such as by the admin export, are
+    covered by binding their queryset, see `bind`. Parents that are not
+    covered return None so callers fall back to the related manager.
+    """
+
+    def __init__(self, chunk_size=1000):
+        self.chunk_size = chunk_size
+        self.queries = 0
+        self.parents = 0
+        self.reset()
+
+    def bind(self, queryset=None):
+        """Bind the flattener to a parent queryset iterated by the caller. A
+        parent not yet loaded loads the chunk of the queryset pks from its
+        position, read once, in the queryset ordering.
+        """
+        self.reset(queryset.model, queryset)
+        return queryset
+
+    def rows(self, rows=None, model_cls=None):
+        """Yield the parent rows, model instances or projected row
+        dictionaries of `model_cls`, loading the children of each chunk of
+        rows before the rows are yielded.
+        """
+        self.reset(model_cls)
+        pk_attname = model_cls._meta.pk.attname
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= self.chunk_size:
+                yield from self.yield_chunk(chunk, pk_attname)
+                chunk = []
+        yield from self.yield_chunk(chunk, pk_attname)
+
+    def yield_chunk(self, chunk=None, pk_attname=None):
+        if not chunk:
+            return
+        self.load([row[pk_attname] if isinstance(row, dict) else row.pk for row in chunk])
+        yield from chunk
+
+    def load(self, parent_ids=None):
+        """Read the children of every inline relation for the parents.
+        """
+        self._children = {}
+        for relation in inline_relations(self.model_cls):
+            fk_attname = relation.field.attname
+            children = defaultdict(list)
+            inline_objs = relation.related_model._default_manager.filter(
+                **{f'{relation.field.name}__pk__in': parent_ids})
+            for inline_obj in inline_objs:
+                children[getattr(inline_obj, fk_attname)].append(inline_obj)
+            self._children[relation] = children
+            self.queries += 1
+        self._chunk_ids = set(parent_ids)
+        self.parents += len(parent_ids)
+
+    def load_position(self, pk=None):
+        """Load the chunk of the bound queryset pks from the parent, or
+        return False if the parent is not in the bound queryset.
+        """
+        if self._queryset is None:
+            return False
+        if self._parent_ids is None:
+            self._parent_ids = list(self._queryset.values_list('pk', flat=True))
+            self._positions = {
+                parent_id: position for position, parent_id in enumerate(self._parent_ids)}
+        position = self._positions.get(pk)
+        if position is None:
+            return False
+        self.load(self._parent_ids[position:position + self.chunk_size])
+        return True
+
+    def children(self, parent=None, relation=None, model_cls=None):
+        """Return the inline objects of the parent for the relation, or None
+        if the parent or relation is not covered by the flattener. The
+        parent is a model instance or a projected row dictionary of
+        `model_cls`.
+        """
+        model_cls = model_cls if isinstance(parent, dict) else parent.__class__
+        if (not relation.one_to_many
+                or model_cls._meta.concrete_model is not self.model_cls):
+            return None
+        if isinstance(parent, dict):
+            pk = parent[model_cls._meta.pk.attname]
+            target = parent.get(relation.field.target_field.attname, pk)
+        else:
+            pk = parent.pk
+            target = getattr(parent, relation.field.target_field.attname)
+        if pk not in self._chunk_ids and not self.load_position(pk):
+            return None
+        children = self._children.get(relation)
+        if children is None:
+            return None
+        return children.get(target, [])
+
+    @property
+    def queries_per_thousand(self):
+        return round(self.queries * 1000 / self.parents, 2) if self.parents else 0.0
+
+    @property
+    def stats(self):
+        return {'queries': self.queries,
+                'parents': self.parents,
+                'queries_per_1000_parents': self.queries_per_thousand}
+
+    def reset(self, model_cls=None, queryset=None):
+        self.model_cls = model_cls._meta.concrete_model if model_cls else None
+        self._queryset = queryset
+        self._parent_ids = None
+        self._positions = {}
+        self._chunk_ids = set()
+        self._children = {}
+
+    def clear(self):
+        self.queries = 0
+        self.parents = 0
+        self.reset()
@@ -0,0 +1,68 @@
+from collections import defaultdict
+
+from .m2m_explode import ManyToManyExplode
+from .row_projection import RowProjection, chunks
+
+
+class InlineMerge:
+    """Merge the rows of an inline model with the rows of its parent.
+
+    The inline rows are read for a chunk of parents at a time, as the
+    parent rows are passed through `parents`, as projected rows grouped
+    by the parent foreign key, keeping the inline model ordering within a
+    parent. A parent row is then merged with each of its inline rows,
+    inline values taking precedence, or passed through if it has none.
+    The names of the selected list model choices of `m2m_fields` are read
+    for the chunk's inline rows with one query per field and added to
+    the inline rows as lists.
+    """
+
+    def __init__(self, inline_cls=None, fk_name=None, exclude=None, m2m_fields=None,
+                 chunk_size=1000):
+        self.inline_cls = inline_cls
+        self.fk_attname = inline_cls._meta.get_field(fk_name).attname
+        self.projection = RowProjection(
+            inline_cls, exclude=exclude, keys=[self.fk_attname])
+        self.m2m_fields = list(m2m_fields or [])
+        self.chunk_size = chunk_size
+        self.inlines = {}
+        self._parent_ids = set()
+
+    def parents(self, rows=None, parent_pk=None):
+        """Yield the parent row dictionaries, keyed by `parent_pk`, loading
+        the inline rows of each chunk of parents before the rows are
+        yielded.
+        """
+        for chunk in chunks(rows, self.chunk_size):
+            self.load([row[parent_pk] for row in chunk])
+            yield from chunk
+
+    def load(self, parent_ids=None):
+        """Read the inline rows of the parents.
+        """
+        pk = self.inline_cls._meta.pk.attname
+        rows = list(self.projection.dicts(self.inline_cls.objects.filter(
+            **{f'{self.fk_attname}__in': parent_ids})))
+        inline_ids = [row[pk] for row in rows]
+        m2m_names = {
+            name: ManyToManyExplode(self.inline_cls, name, 'name').load(inline_ids).selections
+            for name in self.m2m_fields}
+        inlines = defaultdict(list)
+        for row in rows:
+            for name, names in m2m_names.items():
+                row[name] = names.get(row[pk], [])
+            inlines[row[self.fk_attname]].append(row)
+        self.inlines = inlines
+        self._parent_ids = set(parent_ids)
+        return self
+
+    def rows(self, parent_id=None, parent_data=None):
+        """Return the merged rows for a parent row. The inline rows of a
+        parent outside the loaded chunk are read for the parent alone.
+        """
+        if parent_id not in self._parent_ids:
+            self.load([parent_id])
+        inlines = self.inlines.get(parent_id)
+        if not inlines:
+            return [parent_data]
+        return [{**parent_data, **inline} for inline in inlines]
@@ -0,0 +1,81 @@
+from collections import defaultdict
+
+from .choice_catalog import choice_catalog
+from .inline_flattener import inline_relations
+
+
+class ManyToManyEncoder:
+    """One hot encode many to many fields for a whole export.
+
+    The through table of each many to many field is read once, joined to
+    the list model short_name, into a set of selected choices per parent
+    id. Encoding a row is then an in-memory set lookup per choice. The
+    choices come from the process wide `choice_catalog`. Bound to the
+    queryset being exported, see `bind`, only the selections of its
+    objects, or of their inline rows, are read.
+    """
+
+    def __init__(self, chunk_size=2000):
+        self.chunk_size = chunk_size
+        self.queries = 0
+        self._selections = {}
+        self._queryset = None
+
+    def bind(self, queryset=None):
+        """Read the selections of the objects of the queryset only.
+        """
+        self._queryset = queryset
+        self._selections.clear()
+        return queryset
+
+    def parent_filter(self, field=None):
+        """Return the through table filter restricting the selections of the
+        field to the bound queryset objects, or their inline rows.
+        """
+        if self._queryset is None:
+            return {}
+        model_cls = self._queryset.model._meta.concrete_model
+        parents = self._queryset.order_by().values('pk')
+        parent = field.m2m_field_name()
+        if field.model._meta.concrete_model is model_cls:
+            return {f'{parent}__in': parents}
+        for relation in inline_relations(model_cls):
+            if relation.related_model._meta.concrete_model is field.model._meta.concrete_model:
+                return {f'{parent}__{relation.field.name}__in': parents}
+        return {}
+
+    def choices(self, list_model_cls=None):
+        """Return the short names of the list model ordered by created.
+        """
+        return choice_catalog.short_names(list_model_cls)
+
+    def selections(self, field=None):
+        """Return a dictionary of parent id: set of selected short names for
+        the many to many field.
+        """
+        key = (field.model, field.name)
+        if key not in self._selections:
+            through = field.remote_field.through
+            parent_id = f'{field.m2m_field_name()}_id'
+            short_name = f'{field.m2m_reverse_field_name()}__short_name'
+            selected = defaultdict(set)
+            rows = through.objects.filter(**self.parent_filter(field)).order_by().values_list(
+                parent_id, short_name)
+            for pk, choice in rows.iterator(chunk_size=self.chunk_size):
+                selected[pk].add(choice)
+            self._selections[key] = selected
+            self.queries += 1
+        return self._selections[key]
+
+    def encode(self, field=None, parent_id=None):
+        """Return (choice, 0/1) pairs, in choice order, indicating whether each
+        list model choice was selected for the parent.
+        """
+        selected = self.selections(field).get(parent_id, ())
+        return [(choice, int(choice in selected))
+                for choice in self.choices(field.related_model)]
+
+    def clear(self):
+        self._selections.clear()
+        self._queryset = None
+        self.queries = 0
@@ -0,0 +1,60 @@
+from collections import defaultdict
+
+from .row_projection import chunks
+
+
+class ManyToManyExplode:
+    """Explode the selections of a many to many field into one row each.
+
+    The selected list model values of the field are read for a chunk of
+    parents at a time, as the parent rows are passed through `parents`,
+    with one query per chunk, in the list model ordering as read through
+    the parent's related manager. A parent row, built once, is then
+    emitted once per selected value under the field name, or once as is
+    if nothing was selected.
+    """
+
+    def __init__(self, model_cls=None, field_name=None, value_field='short_name',
+                 chunk_size=1000):
+        self.model_cls = model_cls
+        self.field_name = field_name
+        self.value_field = value_field
+        self.chunk_size = chunk_size
+        self.selections = {}
+        self._parent_ids = set()
+
+    def parents(self, rows=None):
+        """Yield the parent row dictionaries, loading the selections of each
+        chunk of parents before the rows are yielded.
+        """
+        pk = self.model_cls._meta.pk.attname
+        for chunk in chunks(rows, self.chunk_size):
+            self.load([row[pk] for row in chunk])
+            yield from chunk
+
+    def load(self, parent_ids=None):
+        """Read the selections of the parents.
+        """
+        field = self.model_cls._meta.get_field(self.field_name)
+        query_name = field.related_query_name()
+        selections = defaultdict(list)
+        values = field.related_model.objects.filter(
+            **{f'{query_name}__in': parent_ids}).values_list(query_name, self.value_field)
+        for pk, value in values:
+            selections[pk].append(value)
+        self.selections = selections
+        self._parent_ids = set(parent_ids)
+        return self
+
+    def rows(self, parent_id=None, parent_data=None, clean=None):
+        """Return the output rows for a parent row, passing each exploded
+        row through `clean` if given. The selections of a parent outside
+        the loaded chunk are read for the parent alone.
+        """
+        if parent_id not in self._parent_ids:
+            self.load([parent_id])
+        values = self.selections.get(parent_id)
+        if not values:
+            return [parent_data]
+        rows = [{**parent_data, self.field_name: value} for value in values]
+        return [clean(row) for row in rows] if clean else rows
@@ -0,0 +1,124 @@
+import logging
+import multiprocessing
+import os
+import traceback
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.apps import apps as django_apps
+from django.db import connections, router
+
+logger = logging.getLogger(__name__)
+
+# An export of one model (or one group of combined models) to its own file.
+# `exporter` is 'crf' or 'non_crf', `method` the exporter method called with
+# `kwargs`, `crf_data_dict` in kwargs names the ExportMethods row builder and
+# `model` ('app_label.model_name') is the table used to schedule the task.
+ExportTask = namedtuple(
+    'ExportTask', ['label', 'exporter', 'method', 'kwargs', 'export_path', 'model'])
+
+# Export methods shared by the tasks run in a worker process
+worker_export_methods = None
+
+
+def estimated_rows(model=None):
+    """Return the estimated number of rows of a model table, read from the
+    database statistics where available.
+    """
+    model_cls = django_apps.get_model(model)
+    connection = connections[router.db_for_read(model_cls)]
+    table = model_cls._meta.db_table
+    queries = {
+        'postgresql': 'SELECT reltuples FROM pg_class WHERE relname = %s',
+        'mysql': ('SELECT table_rows FROM information_schema.tables '
+                  'WHERE table_schema = DATABASE() AND table_name = %s')}
+    estimate = None
+    if connection.vendor in queries:
+        with connection.cursor() as cursor:
+            cursor.execute(queries[connection.vendor], [table])
+            row = cursor.fetchone()
+            estimate = row[0] if row else None
+    if estimate is None or estimate < 0:
+        return model_cls._default_manager.count()
+    return int(estimate)
+
+
+def init_worker(ciphertext_passthrough=False):
+    """Set up Django in the spawned worker, create the export methods shared
+    by its tasks and warm up the list model choice catalog.
+    """
+    from .choice_catalog import choice_catalog
+    from .export_methods import ExportMethods
+
+    global worker_export_methods
+    if not django_apps.ready:
+        django.setup()
+    worker_export_methods = ExportMethods(ciphertext_passthrough=ciphertext_passthrough)
+    choice_catalog.warm_up()
+
+
+def run_export_task(task=None):
+    """Run an export task in a worker and return (label, None), or (label,
+    traceback) if the export failed.
+    """
+    from .export_data_mixin import ExportDataMixin
+    from .export_non_crfs import ExportNonCrfData
+
+    exporter_cls = ExportDataMixin if task.exporter == 'crf' else ExportNonCrfData
+    try:
+        exporter = exporter_cls(
+            export_path=task.export_path, export_methods_cls=worker_export_methods)
+        kwargs = dict(task.kwargs)
+        if 'crf_data_dict' in kwargs:
+            kwargs['crf_data_dict'] = getattr(worker_export_methods, kwargs['crf_data_dict'])
+        getattr(exporter, task.method)(**kwargs)
+    except Exception:
+        return task.label, traceback.format_exc()
+    return task.label, None
+
+
+class ParallelExport:
+    """Run independent model exports in a pool of worker processes.
+
+    Tasks are scheduled largest table first, by estimated row count, so
+    the longest exports start first. Workers are spawned rather than
+    forked, forking a threaded web server process is not safe, and each
+    sets up Django and opens its own database connection. With
+    `ciphertext_passthrough` the workers read encrypted columns as stored.
+    A failed export is logged and collected with its traceback while the
+    other exports carry on.
+    """
+
+    def __init__(self, processes=None, ciphertext_passthrough=False):
+        self.processes = processes or django_apps.get_app_config(
+            'flourish_export').export_processes
+        self.ciphertext_passthrough = ciphertext_passthrough
+
+    def schedule(self, tasks=None):
+        estimates = {model: estimated_rows(model) for model in {t.model for t in tasks}}
+        return sorted(tasks, key=lambda task: estimates[task.model], reverse=True)
+
+    def run(self, tasks=None):
+        """Run the tasks and return a dictionary of label: traceback of the
+        failed exports.
+        """
+        tasks = self.schedule(tasks)
+        for export_path in {task.export_path for task in tasks}:
+            os.makedirs(export_path, exist_ok=True)
+        failures = {}
+        with ProcessPoolExecutor(
+                max_workers=self.processes,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker,
+                initargs=(self.ciphertext_passthrough,)) as pool:
+            futures = {pool.submit(run_export_task, task): task.label for task in tasks}
+            for future in as_completed(futures):
+                try:
+                    label, error = future.result()
+                except Exception:
+                    label, error = futures[future], traceback.format_exc()
+                if error:
+                    logger.error('Export of %s failed:\n%s', label, error)
+                    failures[label] = error
+        return failures
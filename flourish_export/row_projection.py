@@ -0,0 +1,84 @@
+from .date_formatter import model_date_columns, split_column_names
+from .encryption import CiphertextPassthrough
+
+
+class RowProjection:
+    """Stream export rows of a model with `values_list()`.
+
+    Only the model columns that end up in the export are selected: a
+    column is dropped when it, and for datetime columns the date and time
+    columns it is split into, are all excluded. The primary key and any
+    `keys` columns are always selected for the row builders, `lookups`
+    (e.g. `maternal_visit__report_datetime`) are read across joins and the
+    queryset annotations are appended. Rows are streamed from the
+    database cursor `chunk_size` at a time as dictionaries of column:
+    value. Dictionaries read from a queryset
+    prepared for ciphertext passthrough load the secrets of a chunk at a
+    time into `passthrough`, see `CiphertextPassthrough.rows`.
+    """
+
+    def __init__(self, model_cls=None, exclude=None, keys=None, lookups=None,
+                 chunk_size=2000, passthrough=None):
+        self.model_cls = model_cls
+        self.exclude = frozenset(exclude or [])
+        self.keys = list(keys or [])
+        self.lookups = list(lookups or [])
+        self.chunk_size = chunk_size
+        self.passthrough = passthrough
+
+    def survives(self, column=None):
+        """Return True if the column, or a column derived from it when the
+        dates are formatted, is part of the export.
+        """
+        if column not in self.exclude:
+            return True
+        datetime_columns, _ = model_date_columns(self.model_cls)
+        if column in datetime_columns:
+            return any(name not in self.exclude for name in split_column_names(column))
+        return False
+
+    @property
+    def model_columns(self):
+        pk = self.model_cls._meta.pk.attname
+        return [field.attname for field in self.model_cls._meta.concrete_fields
+                if field.attname == pk or field.attname in self.keys
+                or self.survives(field.attname)]
+
+    def columns(self, queryset=None):
+        """Return the selected columns for the queryset, reading the stored
+        ciphertext alias in place of an encrypted column where the
+        queryset was prepared for ciphertext passthrough.
+        """
+        prefix = CiphertextPassthrough.alias_prefix
+        annotations = list(queryset.query.annotations)
+        columns = []
+        for column in self.model_columns:
+            alias = f'{prefix}{column}'
+            columns.append(alias if alias in annotations else column)
+        columns.extend(self.lookups)
+        columns.extend(name for name in annotations
+                       if name not in columns and not name.startswith(prefix))
+        return columns
+
+    def dicts(self, queryset=None):
+        """Yield a dictionary of column: value for each row of the queryset.
+        """
+        columns = self.columns(queryset)
+        rows = (dict(zip(columns, row))
+                for row in queryset.values_list(*columns).iterator(chunk_size=self.chunk_size))
+        if self.passthrough and self.passthrough.is_prepared(queryset):
+            rows = self.passthrough.rows(rows, self.model_cls)
+        yield from rows
+
+
+def chunks(rows=None, chunk_size=None):
+    """Yield lists of `chunk_size` rows, the last one possibly shorter.
+    """
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
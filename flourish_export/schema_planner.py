@@ -0,0 +1,129 @@
+from django.db import models
+from django.db.models import Count, Max
+
+from .date_formatter import split_column_names
+from .exclusions import inline_exclusions
+
+
+def lookup_field(model_cls=None, lookup=None):
+    """Return the field a `__` separated lookup of the model resolves to.
+    """
+    field = None
+    for name in lookup.split('__'):
+        field = model_cls._meta.get_field(name)
+        model_cls = field.related_model
+    return field
+
+
+class ExportSchemaPlanner:
+    """Plan the ordered columns of an export file before any rows are read.
+
+    Columns are planned as a template, a dictionary of row key: the field
+    the value comes from (or None), in the order the row builders add
+    them: the model columns, the values added to the rows, a column per
+    list model choice of each many to many field and the numbered columns
+    of the inlines up to the largest number of inlines of a parent, read
+    with one aggregate per inline model. `columns` then expands the
+    datetime columns into their date and time columns and removes the
+    excluded columns.
+
+    The planned columns are the header a file is opened with. The columns
+    of an export are those of a single data frame of its rows, in first
+    seen order, see `StreamingCsvWriter`. The plan does not know which
+    rows come first, which nullable datetimes are missing or which parents
+    have the most inlines: the date and time columns of a datetime never
+    set are left out, the datetime column of a nullable field is added
+    where first seen, and the columns are reordered when the rows differ
+    from the plan.
+    """
+
+    def __init__(self, export_methods=None):
+        self.export_methods = export_methods
+
+    def model_template(self, model_cls=None, columns=None):
+        columns = columns or [f.attname for f in model_cls._meta.concrete_fields]
+        fields = {f.attname: f for f in model_cls._meta.concrete_fields}
+        return {column: fields.get(column) for column in columns}
+
+    def m2m_template(self, model_cls=None, inline_count=None):
+        """Return the one hot columns of the many to many fields of the model.
+        """
+        template = {}
+        for field in model_cls._meta.many_to_many:
+            for choice in self.export_methods.m2m_encoder.choices(field.related_model):
+                column = f'{field.name}__{choice}'
+                column = f'{column}__{inline_count}' if inline_count else column
+                template[column] = None
+        return template
+
+    def max_inlines(self, relation=None, queryset=None):
+        """Return the largest number of inline objects of a parent in the
+        queryset for the relation.
+        """
+        inlines = relation.related_model._default_manager.filter(
+            **{f'{relation.field.name}__pk__in': queryset.values('pk')})
+        counts = inlines.order_by().values(relation.field.attname).annotate(
+            inline_count=Count('pk'))
+        return counts.aggregate(max_count=Max('inline_count'))['max_count'] or 0
+
+    def inline_template(self, model_cls=None, queryset=None):
+        """Return the numbered inline columns of the model, see
+        `ExportMethods.inline_data_dict`, ordered by count, then by inline
+        model, as first seen across the rows.
+        """
+        template = {}
+        exclude = inline_exclusions(model_cls)
+        relations = [relation for relation in model_cls._meta.related_objects
+                     if relation.one_to_many]
+        max_counts = [self.max_inlines(relation, queryset) for relation in relations]
+        for count in range(max(max_counts, default=0)):
+            for relation, max_count in zip(relations, max_counts):
+                if count >= max_count:
+                    continue
+                inline_cls = relation.related_model
+                template.update({
+                    f'{field.attname}__{count}': field
+                    for field in inline_cls._meta.concrete_fields
+                    if field.attname not in exclude})
+                template.update(self.m2m_template(inline_cls, str(count)))
+        return template
+
+    def crf_template(self, model_cls=None, queryset=None, visit_attr=None,
+                     is_caregiver=None, columns=None):
+        """Return the template of a CRF row, see
+        `ExportMethods.caregiver_crf_data_dict` and `child_crf_data`.
+        """
+        export_methods = self.export_methods
+        visit_cls = model_cls._meta.get_field(visit_attr).related_model
+        template = self.model_template(model_cls, columns)
+        subject_column = (
+            'caregiver_subject_identifier' if is_caregiver else 'child_subject_identifier')
+        template[subject_column] = None
+        template.update({
+            column: lookup_field(visit_cls, name)
+            for column, name in export_methods.crf_visit_columns.items()})
+        template['status'] = None
+        template.update({
+            name: export_methods.rs_cls._meta.get_field(name)
+            for name in export_methods.crf_subject_columns})
+        if not is_caregiver:
+            template['caregiver_identifier'] = None
+        template.update(self.m2m_template(model_cls))
+        template.update(self.inline_template(model_cls, queryset))
+        return template
+
+    def columns(self, template=None, exclude=None):
+        """Return the ordered export columns for the template, with the date
+        and time columns of each datetime field in place of its column.
+        """
+        exclude = exclude or frozenset()
+        columns = {}
+        for column, field in template.items():
+            if isinstance(field, models.DateTimeField):
+                names = split_column_names(column)
+            else:
+                names = (column, )
+            for name in names:
+                if name not in exclude:
+                    columns.setdefault(name, None)
+        return list(columns)
@@ -0,0 +1,23 @@
+from celery.signals import worker_process_init
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from edc_base.model_mixins import ListModelMixin
+
+from .choice_catalog import choice_catalog
+
+
+@receiver(post_save, weak=False, dispatch_uid='list_model_on_post_save')
+def list_model_on_post_save(sender, instance, raw, created, **kwargs):
+    if issubclass(sender, ListModelMixin):
+        choice_catalog.invalidate(sender)
+
+
+@receiver(post_delete, weak=False, dispatch_uid='list_model_on_post_delete')
+def list_model_on_post_delete(sender, instance, **kwargs):
+    if issubclass(sender, ListModelMixin):
+        choice_catalog.invalidate(sender)
+
+
+@worker_process_init.connect(weak=False)
+def choice_catalog_on_worker_process_init(**kwargs):
+    choice_catalog.warm_up()
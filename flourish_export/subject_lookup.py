@@ -0,0 +1,68 @@
+from django.apps import apps as django_apps
+
+
+class RegisteredSubjectLookup:
+    """Per-export lookup of registered subject details keyed by
+    subject identifier.
+
+    The registered subject table is read once, in pages of `chunk_size`
+    rows, keeping only the columns the export row builders use.
+    """
+
+    rs_model = 'edc_registration.registeredsubject'
+
+    lookup_fields = [
+        'subject_identifier', 'screening_identifier', 'screening_age_in_years',
+        'screening_datetime', 'registration_status', 'registration_datetime',
+        'relative_identifier', 'dob', 'gender', 'subject_type']
+
+    def __init__(self, chunk_size=2000):
+        self.chunk_size = chunk_size
+        self.hits = 0
+        self.misses = 0
+        self._subjects = None
+
+    @property
+    def rs_cls(self):
+        return django_apps.get_model(self.rs_model)
+
+    @property
+    def subjects(self):
+        """Return a dictionary of subject_identifier: registered subject row,
+        loading it on first access.
+        """
+        if self._subjects is None:
+            self._subjects = {}
+            rows = self.rs_cls.objects.order_by().values_list(
+                *self.lookup_fields, named=True)
+            for row in rows.iterator(chunk_size=self.chunk_size):
+                self._subjects[row.subject_identifier] = row
+        return self._subjects
+
+    def get(self, subject_identifier):
+        """Return the registered subject row for the subject identifier, or
+        None if the subject is not registered.
+        """
+        row = self.subjects.get(subject_identifier)
+        if row is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return row
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return round(self.hits / lookups, 4) if lookups else 0.0
+
+    @property
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hit_rate,
+                'size': len(self._subjects or {})}
+
+    def clear(self):
+        self._subjects = None
+        self.hits = 0
+        self.misses = 0
@@ -1,12 +1,16 @@
 import shutil
 import os
+from contextlib import nullcontext
 
+import json
 import logging
+import openpyxl
 import pandas as pd
-import redis
 import re
 import django_rq
 from rq import Retry
+from rq.exceptions import NoSuchJobError
+from rq.job import Dependency, Job, JobStatus
 
 from celery import shared_task, group, chain
 from celery.exceptions import SoftTimeLimitExceeded
@@ -22,12 +26,17 @@ from flourish_child.admin_site import flourish_child_admin
 from flourish_facet.admin_site import flourish_facet_admin
 from flourish_prn.admin_site import flourish_prn_admin
 
+from io import BytesIO
+
 from .admin_export_helper import AdminExportHelper
+from .choice_catalog import choice_catalog
+from .chunked_export import concatenate_parts, planned_ranges, range_queryset
+from .delta_export import DeltaExport, choices_signature
+from .encryption import CiphertextPassthrough
+from .export_manifest import ExportManifest
 from .models import ExportFile
 
 
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
-
 admin_export_helper_cls = AdminExportHelper()
 logger = logging.getLogger('celery_progress')
 
@@ -37,11 +46,16 @@ admin_site_map = {'flourish_child': flourish_child_admin,
                   'flourish_facet': flourish_facet_admin}
 
 
-def run_exports(model_cls, app_label, export_date, full_export=False):
+def run_exports(model_cls, app_label, export_date, full_export=False,
+                ciphertext_passthrough=False, incremental=False, export_identifier=None):
     """ Executes the csv model export method from admin export action(s) and writes response
         content to an excel file.
         @param model_cls: Specific model class definition
         @param app_label: Specific app label for the model class
+        @param ciphertext_passthrough: read encrypted columns as stored ciphertext
+        @param incremental: merge the rows changed since the last export of the
+               export file description into its snapshot, see `export_delta`
+        @param export_identifier: identifier of the export file being generated
     """
 
     model_cls = django_apps.get_model(model_cls)
@@ -49,6 +63,14 @@ def run_exports(model_cls, app_label, export_date, full_export=False):
 
     model_admin_cls = app_admin_site._registry.get(model_cls, None)
 
+    file_path = export_file_path(app_label, export_date, full_export)
+
+    label_lower = model_cls._meta.label_lower
+    manifest = ExportManifest(f'{file_path}_manifest')
+    if manifest.is_complete(label_lower):
+        print(f'Export already complete for {model_cls._meta.verbose_name}')
+        return
+
     queryset = model_cls.objects.all()
 
     if not model_admin_cls:
@@ -56,44 +78,236 @@ def run_exports(model_cls, app_label, export_date, full_export=False):
         return
     elif not queryset.exists():
         print(f'Empty queryset returned for {model_cls._meta.verbose_name}')
+        manifest.complete(label_lower, rows=0)
         return
 
-    file_path = f'media/admin_exports/{app_label}_{export_date}'
-
-    if full_export:
-        file_path = f'media/admin_exports/flourish_{export_date}'
-
     if hasattr(model_admin_cls, 'export_as_csv'):
         """
             Can be used to exclude some models not needed in the exports
             by excluding the mixin from the model admin of interest
         """
 
-        response = model_admin_cls.export_as_csv(
-            request=None, queryset=queryset)
+        if ciphertext_passthrough:
+            queryset = CiphertextPassthrough().prepare(queryset)
 
-        if response:
-            if response.status_code == 200:
-                filename = f'{file_path}/{model_admin_cls.get_export_filename()}'
-                save_csv_to_file(response, filename)
-            else:
-                response.raise_for_status()
+        filename = f'{file_path}/{model_admin_cls.get_export_filename()}'
+        manifest.start(label_lower)
+        try:
+            export_file = export_model(
+                model_admin_cls, queryset, filename, ciphertext_passthrough,
+                incremental, export_identifier)
+        except Exception as e:
+            manifest.fail(label_lower, str(e))
+            raise
+        if export_file:
+            manifest.complete(label_lower, rows=queryset.count(), files=[export_file])
         else:
-            print(f'Empty response for batch in {model_cls._meta.verbose_name}')
+            manifest.complete(label_lower, rows=0)
     else:
         print(f'No export method available for {model_cls._meta.verbose_name}')
 
 
+def run_export_part(model_cls, app_label, export_date, part, start, end,
+                    full_export=False, ciphertext_passthrough=False):
+    """ Export the objects of a model in a primary key range to a part file, see
+        `enqueue_model_export`.
+        @param part: index of the part in the model export
+        @param start: first pk of the range, or None
+        @param end: pk ending the range, excluded, or None
+    """
+    model_cls = django_apps.get_model(model_cls)
+    model_admin_cls = admin_site_map.get(app_label)._registry.get(model_cls, None)
+    file_path = export_file_path(app_label, export_date, full_export)
+    part_label = f'{model_cls._meta.label_lower}.part{part}'
+    manifest = ExportManifest(f'{file_path}_manifest')
+    if manifest.is_complete(part_label):
+        print(f'Export already complete for {part_label}')
+        return
+
+    queryset = range_queryset(model_cls.objects.all(), start, end)
+    if ciphertext_passthrough:
+        queryset = CiphertextPassthrough().prepare(queryset)
+
+    manifest.start(part_label)
+    try:
+        export_file = None
+        if queryset.exists():
+            export_file = export_model(
+                model_admin_cls, queryset,
+                part_filename(file_path, model_cls._meta.label_lower, part))
+    except Exception as e:
+        manifest.fail(part_label, str(e))
+        raise
+    manifest.complete(
+        part_label, rows=queryset.count() if export_file else 0,
+        files=[export_file] if export_file else [])
+
+
+def concatenate_export_parts(model_cls, app_label, export_date, parts, full_export=False):
+    """ Concatenate the part files of a model exported in primary key ranges, in
+        order, into the model export file and remove the parts. A model with parts
+        that failed or are incomplete is recorded as failed in the manifest, and
+        reported by `zip_and_send_email`, instead of raising, so the job is not
+        retried for parts a retry cannot complete.
+        @param parts: number of parts of the model export
+    """
+    model_cls = django_apps.get_model(model_cls)
+    model_admin_cls = admin_site_map.get(app_label)._registry.get(model_cls, None)
+    file_path = export_file_path(app_label, export_date, full_export)
+    label_lower = model_cls._meta.label_lower
+    manifest = ExportManifest(f'{file_path}_manifest')
+    if manifest.is_complete(label_lower):
+        return
+
+    part_labels = [f'{label_lower}.part{part}' for part in range(parts)]
+    incomplete = [label for label in part_labels if not manifest.is_complete(label)]
+    if incomplete:
+        fail_export_parts(
+            manifest, label_lower, f'Export parts are not complete: {", ".join(incomplete)}')
+        return
+
+    # The part files recorded by each part job, in part order
+    entries = [manifest.entry(label) for label in part_labels]
+    part_files = [path for entry in entries for path in entry.get('files', {})]
+    not_csv = [path for path in part_files if not path.endswith('.csv')]
+    if not_csv:
+        fail_export_parts(
+            manifest, label_lower, f'Export parts are not csv files: {", ".join(not_csv)}')
+        return
+
+    export_file = f'{file_path}/{model_admin_cls.get_export_filename()}.csv'
+    rows = sum(entry['rows'] for entry in entries)
+    if part_files:
+        concatenate_parts(part_files, export_file)
+    manifest.complete(label_lower, rows=rows, files=[export_file] if part_files else [])
+    shutil.rmtree(os.path.dirname(part_filename(file_path, label_lower, 0)),
+                  ignore_errors=True)
+
+
+def fail_export_parts(manifest, label_lower, error):
+    """ Record the model export as failed for its parts.
+    """
+    print(f'Export of {label_lower} failed: {error}')
+    manifest.fail(label_lower, error)
+
+
+def export_file_path(app_label, export_date, full_export=False):
+    """ Return the directory of the admin exports of an app, or of a full export.
+    """
+    if full_export:
+        return f'media/admin_exports/flourish_{export_date}'
+    return f'media/admin_exports/{app_label}_{export_date}'
+
+
+def part_filename(file_path, label_lower, part):
+    """ Return the part file name, without the extension, of a model export part,
+        kept outside the export directory so the parts are not zipped.
+    """
+    return f'{file_path}_parts/{label_lower}/{part:05d}'
+
+
+def export_model(model_admin_cls, queryset, filename, ciphertext_passthrough=False,
+                 incremental=False, export_identifier=None):
+    """ Write the admin export of the queryset to the export file, see `run_exports`.
+        @param filename: export file name, without the extension
+        @return: path of the file written, or None if there was nothing to write
+    """
+    model_cls = queryset.model
+    if incremental and export_identifier:
+        description = ExportFile.objects.get(
+            export_identifier=export_identifier).description
+        delta = DeltaExport(description, export_identifier)
+        key = model_cls._meta.label_lower
+        key = f'{key}.ciphertext' if ciphertext_passthrough else key
+        export_file = export_delta(model_admin_cls, queryset, delta, filename, key)
+        if export_file:
+            return export_file
+
+    response = admin_export_response(model_admin_cls, queryset)
+
+    if response:
+        if response.status_code == 200:
+            return save_csv_to_file(response, filename)
+        else:
+            response.raise_for_status()
+    else:
+        print(f'Empty response for batch in {model_cls._meta.verbose_name}')
+    return None
+
+
+def admin_export_response(model_admin_cls, queryset):
+    """ Return the response of the admin csv export of the queryset.
+    """
+    export_scope = getattr(model_admin_cls, 'export_scope', None)
+    with export_scope(queryset) if export_scope else nullcontext():
+        return model_admin_cls.export_as_csv(request=None, queryset=queryset)
+
+
+def export_delta(model_admin_cls, queryset, delta, filename, key):
+    """ Export the objects changed since the last export of the delta description,
+        merge their rows into the snapshot of that export by primary key and write
+        the merged rows to the csv file. The changed rows are exported with their
+        id column, see `AdminExportHelper.primary_key_scope`, which is dropped
+        before the file is written. The snapshot is merged and written a chunk at
+        a time.
+        @param delta: `DeltaExport` of the export
+        @param filename: export file name, without the extension
+        @param key: key of the snapshot of the file
+        @return: path of the file written, or None if it has to be exported in full
+    """
+    signature = choices_signature(queryset.model)
+    snapshot = delta.load(key, signature)
+    changed_qs = queryset if snapshot is None else delta.changed(queryset)
+
+    changed = pd.DataFrame()
+    if changed_qs.exists():
+        primary_key_scope = getattr(model_admin_cls, 'primary_key_scope', None)
+        if not primary_key_scope:
+            return None
+        with primary_key_scope():
+            response = admin_export_response(model_admin_cls, changed_qs)
+        content_type = response._headers.get('content-type', ('', ''))[1] if response else ''
+        if (not response or response.status_code != 200
+                or content_type != admin_export_helper_cls.csv_content_type):
+            return None
+        changed = pd.read_csv(BytesIO(response.content), dtype=str, keep_default_na=False)
+        if 'id' not in changed.columns or not changed['id'].is_unique:
+            print(f'Rows do not carry unique ids for {key}, exporting in full')
+            return None
+        changed = changed.set_index('id')
+
+    ids = {str(pk) for pk in delta.ids(queryset)}
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    columns = delta.frame_columns(snapshot, changed)
+    with delta.writer(key, signature, columns) as saved, open(
+            f'{filename}.csv.part', 'w', encoding='utf-8', newline='') as f:
+        pd.DataFrame(columns=columns).to_csv(f, index=False)
+        for merged in delta.merge_frames(snapshot, changed, ids):
+            saved.append_frame(merged)
+            merged.to_csv(f, header=False, index=False)
+    os.replace(f'{filename}.csv.part', f'{filename}.csv')
+    return f'{filename}.csv'
+
+
 @shared_task()
 def run_metadata_exports(label_lower, filename, app_label):
+    """ Write the metadata records of a model to its own records file, the app
+        workbook is written once from the records, see `write_metadata_workbooks`.
+        @param label_lower: model label
+        @param filename: path of the app metadata workbook
+        @param app_label: app label of the model admin site
+    """
     app_admin_site = admin_site_map.get(app_label, None)
 
     if not label_lower and not filename:
         return
 
-    sheet_name = label_lower.split('.')[1]
-    sheet_name = re.sub(r'[\\/*?:"<>|]', '_', sheet_name)
-    sheet_name = sheet_name[:30]
+    manifest = ExportManifest(f'{os.path.dirname(filename)}_manifest')
+    if manifest.is_complete(label_lower):
+        print(f'Metadata export already complete for {label_lower}')
+        return
+
     records = []
 
     model_cls = django_apps.get_model(label_lower)
@@ -123,42 +337,69 @@ def run_metadata_exports(label_lower, filename, app_label):
     for field in audit_fields:
         append_field_details(records, field, custom_form_labels)
 
-    # Ensure directory exists, or create it
-    directory = os.path.dirname(filename)
-    if not os.path.exists(directory):
-        os.makedirs(directory)
+    # Cell values as written to the workbook, other values as their text
+    records = [{key: value if isinstance(value, (str, int, float, bool, type(None)))
+                else str(value) for key, value in record.items()} for record in records]
 
-    df = pd.DataFrame(records)
+    records_file = metadata_records_file(filename, label_lower)
+    os.makedirs(os.path.dirname(records_file), exist_ok=True)
+    with open(f'{records_file}.part', 'w') as f:
+        json.dump(records, f)
+    os.replace(f'{records_file}.part', records_file)
+    manifest.complete(label_lower, rows=len(records), files=[records_file])
 
-    lock = r.lock(f'{filename}_lock', timeout=30)
-    if lock.acquire(blocking=True):
-        try:
-            # Check if the file exists
-            if not os.path.exists(filename):
-                # If the file doesn't exist, create it and write the DataFrame to a new sheet
-                with pd.ExcelWriter(filename, engine='openpyxl') as writer:
-                    df.to_excel(writer, sheet_name=sheet_name, index=False)
-            else:
-                # Write data to excel file
-                with pd.ExcelWriter(filename, engine='openpyxl', mode='a', if_sheet_exists='overlay') as writer:
-                    if sheet_name in writer.sheets:
-                        df.to_excel(writer, sheet_name=sheet_name, index=False, header=False,
-                                    startrow=writer.sheets[sheet_name].max_row)
-                    else:
-                        df.to_excel(writer, sheet_name=sheet_name, index=False)
-        finally:
-            lock.release()
-    else:
-        print('Could not acquire lock for the file.')
+
+@shared_task()
+def write_metadata_workbooks(workbooks):
+    """ Write each app metadata workbook once, in write only mode, from the metadata
+        records of its models. Models are written in app order, a sheet per model, the
+        records of models with the same sheet name on the same sheet.
+        @param workbooks: dictionary of workbook path: list of model labels
+    """
+    for filename, labels in workbooks.items():
+        sheets = {}
+        for label_lower in labels:
+            records_file = metadata_records_file(filename, label_lower)
+            if not os.path.exists(records_file):
+                continue
+            with open(records_file) as f:
+                sheets.setdefault(metadata_sheet_name(label_lower), []).extend(json.load(f))
+        if not sheets:
+            continue
+
+        workbook = openpyxl.Workbook(write_only=True)
+        for sheet_name, records in sheets.items():
+            worksheet = workbook.create_sheet(title=sheet_name)
+            columns = list(dict.fromkeys(key for record in records for key in record))
+            if columns:
+                worksheet.append(columns)
+            for record in records:
+                worksheet.append([record.get(column) for column in columns])
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        workbook.save(f'{filename}.part')
+        os.replace(f'{filename}.part', filename)
+
+
+def metadata_records_file(filename, label_lower):
+    """ Return the records file of a model for an app metadata workbook, kept outside
+        the exported directory so the records are not zipped.
+    """
+    directory, workbook = os.path.split(filename)
+    return f'{directory}_records/{os.path.splitext(workbook)[0]}/{label_lower}.json'
+
+
+def metadata_sheet_name(label_lower):
+    sheet_name = label_lower.split('.')[1]
+    sheet_name = re.sub(r'[\\/*?:"<>|]', '_', sheet_name)
+    return sheet_name[:30]
 
 
 def append_field_details(records, field, custom_form_labels):
     choices = None
 
     if isinstance(field, ManyToManyField):
-        related_model_cls = field.related_model
-        _qs = related_model_cls.objects.all()
-        choices = [(qs.short_name, qs.name) for qs in _qs]
+        choices = choice_catalog.choices(field.related_model)
 
     custom_field_label = ''
     for custom_label in custom_form_labels:
@@ -186,34 +427,42 @@ def append_field_details(records, field, custom_form_labels):
 
 def generate_exports(app_list, create_zip=False, full_export=False,
                      flat_exports=None, user_emails=[], export_identifier=None,
-                     queue_name='exports'):
+                     queue_name='exports', ciphertext_passthrough=False,
+                     incremental=None):
 
     app_labels = set()
     _queue = django_rq.get_queue(queue_name)
-    # Create a list to store the group of export tasks
+    # Jobs finishing the export of each model, the zip job depends on all of them
     export_tasks = []
+    # Manifest of each model exported, the zip job reports the incomplete models
+    export_models = {}
+
+    # A retried export keeps the directory and checkpoint manifest of its export file
+    export_file = ExportFile.objects.filter(export_identifier=export_identifier).first()
+    export_started = export_file.datetime_started if export_file else get_utcnow()
+    export_date = export_started.strftime('%Y-%m-%d_%H-%M-%S')
 
-    export_date = get_utcnow().strftime('%Y-%m-%d_%H-%M-%S')
+    if incremental is None:
+        incremental = django_apps.get_app_config('flourish_export').incremental_exports
 
     for model_cls in app_list.values():
         app_label = model_cls.split('.')[0]
         app_labels.add(app_label)
         if not flat_exports:
-            # Chunking logic for large exports
-            _job = _queue.enqueue(
-                run_exports,
-                model_cls,
-                app_label,
-                export_date,
-                full_export,
-                retry=Retry(max=3)
-            )
-            export_tasks.append(_job)
+            model_jobs = enqueue_model_export(
+                _queue, model_cls, app_label, export_date, full_export,
+                ciphertext_passthrough, incremental, export_identifier)
+            export_tasks += model_jobs[-1:]
+            if model_jobs:
+                label_lower = django_apps.get_model(model_cls)._meta.label_lower
+                export_models[label_lower] = (
+                    f'{export_file_path(app_label, export_date, full_export)}_manifest')
 
     # Change app_labels to list for serialization
     app_labels = list(app_labels) if not full_export else ['flourish', ]
 
-    # Wait for all export tasks to complete
+    # The post-export job is enqueued by RQ once every export job has finished or
+    # failed, no worker is held waiting on the exports
     if flat_exports:
         _task = _queue.enqueue(
             generate_flat_exports,
@@ -222,46 +471,156 @@ def generate_exports(app_list, create_zip=False, full_export=False,
             export_date,
             create_zip,
         )
-        _task.result  # Blocks until the task is completed
-
-    else:
-        for task in export_tasks:
-            task.result
+        export_tasks = [_task]
 
     # Handle post-export operations (i.e. zip and send email notification)
     if create_zip:
-        _queue.enqueue(
+        enqueue_once(
+            _queue,
+            export_job_id(export_date, full_export, 'zip', export_identifier or ''),
             zip_and_send_email,
             app_labels,
             user_emails,
             export_identifier,
-            export_date
+            export_date,
+            export_models=export_models,
+            depends_on=export_dependency(export_tasks)
         )
 
 
+def enqueue_model_export(queue, model_cls, app_label, export_date, full_export=False,
+                         ciphertext_passthrough=False, incremental=False,
+                         export_identifier=None):
+    """ Enqueue the export jobs of a model. A model with more rows than its chunk size
+        is exported in primary key ranges, a job per range writing a part file, and the
+        parts concatenated by a job depending on them. Incremental exports only read
+        the changed rows and are not chunked.
+        @return: list of the jobs enqueued
+    """
+    _model_cls = django_apps.get_model(model_cls)
+    manifest = ExportManifest(
+        f'{export_file_path(app_label, export_date, full_export)}_manifest')
+    if manifest.is_complete(_model_cls._meta.label_lower):
+        return []
+
+    # Only models exported from their model admin are enqueued, see `run_exports`
+    model_admin_cls = admin_site_map.get(app_label)._registry.get(_model_cls, None)
+    if not model_admin_cls:
+        print(f'Model class not registered {_model_cls._meta.verbose_name}')
+        return []
+    elif not hasattr(model_admin_cls, 'export_as_csv'):
+        print(f'No export method available for {_model_cls._meta.verbose_name}')
+        return []
+
+    label_lower = _model_cls._meta.label_lower
+    ranges = [(None, None)] if incremental else planned_ranges(manifest, _model_cls)
+    if len(ranges) == 1:
+        return [enqueue_once(
+            queue,
+            export_job_id(export_date, full_export, label_lower),
+            run_exports,
+            model_cls,
+            app_label,
+            export_date,
+            full_export,
+            ciphertext_passthrough,
+            incremental,
+            export_identifier,
+            retry=Retry(max=3)
+        )]
+
+    part_jobs = [
+        enqueue_once(
+            queue,
+            export_job_id(export_date, full_export, label_lower, f'part{part}'),
+            run_export_part,
+            model_cls,
+            app_label,
+            export_date,
+            part,
+            start,
+            end,
+            full_export,
+            ciphertext_passthrough,
+            retry=Retry(max=3)
+        ) for part, (start, end) in enumerate(ranges)]
+    concatenate_job = enqueue_once(
+        queue,
+        export_job_id(export_date, full_export, label_lower, 'concatenate'),
+        concatenate_export_parts,
+        model_cls,
+        app_label,
+        export_date,
+        len(ranges),
+        full_export,
+        depends_on=export_dependency(part_jobs),
+        retry=Retry(max=3)
+    )
+    return part_jobs + [concatenate_job]
+
+
+def export_dependency(jobs):
+    """ Return the dependency of a job on the export jobs, met once every job has
+        finished or failed, so a failed export never leaves the dependent job deferred.
+    """
+    return Dependency(jobs=jobs, allow_failure=True) if jobs else None
+
+
+def export_job_id(export_date, full_export, *names):
+    """ Return the RQ job id of an export job, the same for every attempt of the export.
+    """
+    job_id = '-'.join(['flourish' if full_export else 'export', export_date, *names])
+    return re.sub(r'[^\w-]', '_', job_id)
+
+
+def enqueue_once(queue, job_id, func, *args, **kwargs):
+    """ Enqueue the job unless a job with the same id is already waiting or running,
+        so a retried export does not run a job of the previous attempt twice.
+        @return: the job enqueued, or the job already waiting or running
+    """
+    try:
+        job = Job.fetch(job_id, connection=queue.connection)
+    except NoSuchJobError:
+        job = None
+    if job and job.get_status() in (JobStatus.QUEUED, JobStatus.STARTED,
+                                    JobStatus.DEFERRED, JobStatus.SCHEDULED):
+        return job
+    return queue.enqueue(func, *args, job_id=job_id, **kwargs)
+
+
 @shared_task(bind=True, soft_time_limit=21000, time_limit=21600)
 def generate_metadata(self, app_labels, user_emails, export_identifier):
     export_tasks = []
+    workbooks = {}
     file_path = f'media/admin_exports/flourish_metadata_{get_utcnow().date()}'
 
-    # Check directory already exists and remove along with its contents
-    remove_existing_dir(file_path)
+    # Check directory already exists and remove along with its contents, a retry
+    # keeps the metadata already exported, see `run_metadata_exports`
+    if not self.request.retries:
+        remove_existing_dir(file_path)
+        remove_existing_dir(f'{file_path}_manifest')
+        remove_existing_dir(f'{file_path}_records')
 
     try:
         for app_label in app_labels:
             filename = f'{file_path}/{app_label}.xlsx'
+            workbooks[filename] = []
             app_models = admin_export_helper_cls.get_app_list(app_label).values()
             for model_cls in app_models:
                 _exclude = admin_export_helper_cls.exclude_rel_models(model_cls)
                 if _exclude:
                     continue
                 label_lower = model_cls._meta.label_lower
+                workbooks[filename].append(label_lower)
                 export_tasks.append(
                     run_metadata_exports.si(label_lower, filename, app_label))
         export_group = group(export_tasks)
 
-        final_chain = chain(export_group, zip_and_send_email_task.si(
-            ['flourish_metadata', ], user_emails, export_identifier))
+        final_chain = chain(
+            export_group,
+            write_metadata_workbooks.si(workbooks),
+            zip_and_send_email_task.si(
+                ['flourish_metadata', ], user_emails, export_identifier))
 
         final_chain.delay()
     except SoftTimeLimitExceeded:
@@ -331,14 +690,32 @@ def zip_and_send_email_task(app_labels, user_emails, export_identifier, flat_exp
 
 
 def zip_and_send_email(app_labels, user_emails, export_identifier,
-                       export_date, flat_exports=None):
+                       export_date, flat_exports=None, export_models=None):
+    """ Zip the exports, email the users and mark the export file complete, once all
+        the export jobs have finished or failed. The models the manifests do not show
+        as complete are listed in the email, with the error of those that failed.
+        @param export_models: dictionary of model label: manifest path of the models
+               exported
+    """
+    # A finalizer run again, on a retried export, does not send the export twice
+    if ExportFile.objects.filter(
+            export_identifier=export_identifier, download_complete=True).exists():
+        print(f'{export_identifier} has already been completed')
+        return
+    incomplete = []
+    for label_lower, manifest_path in (export_models or {}).items():
+        manifest = ExportManifest(manifest_path)
+        if not manifest.is_complete(label_lower):
+            error = (manifest.entry(label_lower) or {}).get('error')
+            incomplete.append(f'{label_lower} ({error})' if error else label_lower)
     for app_label in app_labels:
         create_zip_and_email(
-            app_label, export_identifier, user_emails, export_date, flat_exports)
+            app_label, export_identifier, user_emails, export_date, flat_exports,
+            incomplete)
 
 
 def create_zip_and_email(app_label, export_identifier,
-                         user_emails, export_date, flat_exports=None):
+                         user_emails, export_date, flat_exports=None, incomplete=None):
     if flat_exports:
         zip_folder = f'admin_exports/{app_label}_flat_{export_date}'
     else:
@@ -348,7 +725,7 @@ def create_zip_and_email(app_label, export_identifier,
     archive_name = f'{dir_to_zip}_{export_identifier}'
 
     # Zip the exported files
-    if not os.path.isfile(dir_to_zip):
+    if os.path.isdir(dir_to_zip):
         shutil.make_archive(archive_name, 'zip', dir_to_zip)
 
     try:
@@ -361,6 +738,11 @@ def create_zip_and_email(app_label, export_identifier,
         subject = f'{export_identifier} {description}'
         message = (f'{export_identifier} {description} have been successfully '
                    'generated and ready for download. This is an automated message.')
+        if incomplete:
+            message = (f'{export_identifier} {description} have been generated, but the '
+                       'exports of the following models failed or are incomplete: '
+                       f'{", ".join(incomplete)}. The other exports are ready for '
+                       'download. This is an automated message.')
 
         try:
             send_mail(subject=subject,
@@ -383,8 +765,11 @@ def save_csv_to_file(response, filename):
     file_ext = 'csv' if content_type == admin_export_helper_cls.csv_content_type else 'xlsx'
     if not os.path.exists(os.path.dirname(filename)):
         os.makedirs(os.path.dirname(filename))
-    with open(f'{filename}.{file_ext}', 'wb') as file:
+    # Written in place in one step, a file is never seen half written
+    with open(f'{filename}.{file_ext}.part', 'wb') as file:
         file.write(response.content)
+    os.replace(f'{filename}.{file_ext}.part', f'{filename}.{file_ext}')
+    return f'{filename}.{file_ext}'
 
 
 def remove_duplicate_fields(records, suffix_list):
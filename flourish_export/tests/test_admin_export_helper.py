@@ -0,0 +1,41 @@
+import threading
+
+from django.test import SimpleTestCase, tag
+
+from ..admin_export_helper import AdminExportHelper
+
+
+@tag('admin_export_helper')
+class TestExportContext(SimpleTestCase):
+
+    def setUp(self):
+        self.helper = AdminExportHelper()
+
+    def test_scopes_set_and_release_context(self):
+        with self.helper.primary_key_scope():
+            with self.helper.export_scope() as context:
+                self.assertIs(self.helper.export_context, context)
+                self.assertTrue(context.keep_pk)
+                self.assertIsNotNone(context.m2m_encoder)
+            self.assertIsNone(self.helper.export_context.m2m_encoder)
+        self.assertFalse(self.helper.export_context.keep_pk)
+
+    def test_keep_pk_not_shared_across_threads(self):
+        entered, done = threading.Event(), threading.Event()
+        seen = {}
+
+        def export():
+            with self.helper.primary_key_scope():
+                entered.set()
+                done.wait(5)
+                data = self.helper.remove_exclude_fields({'id': 1, 'name': 'a'})
+                seen['primary_key'] = data
+
+        thread = threading.Thread(target=export)
+        thread.start()
+        entered.wait(5)
+        seen['other'] = self.helper.remove_exclude_fields({'id': 2, 'name': 'b'})
+        done.set()
+        thread.join()
+        self.assertEqual(seen['primary_key'], {'id': 1, 'name': 'a'})
+        self.assertEqual(seen['other'], {'name': 'b'})
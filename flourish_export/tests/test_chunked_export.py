@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase, tag
+
+from ..chunked_export import concatenate_parts
+
+
+@tag('chunked_export')
+class TestConcatenateParts(SimpleTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def part(self, name=None, content=None):
+        path = os.path.join(self.path, 'parts', name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(content)
+        return path
+
+    def concatenate(self, part_files=None):
+        path = os.path.join(self.path, 'export', 'model.csv')
+        self.assertEqual(concatenate_parts(part_files, path), path)
+        self.assertFalse(os.path.exists(f'{path}.part'))
+        with open(path) as f:
+            return f.read()
+
+    def test_single_header(self):
+        parts = [self.part('00000.csv', 'a,b\n1,2\n'),
+                 self.part('00001.csv', 'a,b\n3,4\n')]
+        self.assertEqual(self.concatenate(parts), 'a,b\n1,2\n3,4\n')
+
+    def test_parts_in_order(self):
+        parts = [self.part('00001.csv', 'a\n2\n'), self.part('00000.csv', 'a\n1\n')]
+        self.assertEqual(self.concatenate(parts), 'a\n2\n1\n')
+
+    def test_empty_part(self):
+        parts = [self.part('00000.csv', 'a,b\n1,2\n'), self.part('00001.csv', 'a,b\n')]
+        self.assertEqual(self.concatenate(parts), 'a,b\n1,2\n')
+
+    def test_parts_with_other_columns(self):
+        parts = [self.part('00000.csv', 'a,b\n1,2\n'),
+                 self.part('00001.csv', 'a,c,b\n3,x,4\n')]
+        self.assertEqual(self.concatenate(parts), 'a,b,c\n1,2,\n3,4,x\n')
+
+    def test_values_kept_as_written(self):
+        parts = [self.part('00000.csv', 'a,b\n01,NA\n'),
+                 self.part('00001.csv', 'b,a\n1.0,\n')]
+        self.assertEqual(self.concatenate(parts), 'a,b\n01,NA\n,1.0\n')
+
+    def test_missing_part(self):
+        parts = [self.part('00000.csv', 'a\n1\n'), os.path.join(self.path, 'missing.csv')]
+        with self.assertRaises(FileNotFoundError):
+            concatenate_parts(parts, os.path.join(self.path, 'export', 'model.csv'))
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'export', 'model.csv')))
@@ -0,0 +1,86 @@
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, tag
+from django_crypto_fields.constants import CIPHER_PREFIX
+
+from ..encryption import CiphertextPassthrough
+
+
+class CipherQuerySet(list):
+
+    def values_list(self, *fields):
+        return self
+
+
+class CipherManager:
+
+    def __init__(self, secrets=None):
+        self.secrets = secrets
+        self.queries = []
+
+    def filter(self, hash__in=None, algorithm=None, mode=None):
+        self.queries.append(sorted(hash__in))
+        return CipherQuerySet(
+            (hash_value, self.secrets[hash_value]) for hash_value in hash__in)
+
+
+class FieldCryptor:
+    """Field cryptor reading secrets from an in memory crypt store.
+    """
+
+    algorithm = 'aes'
+    mode = 'local'
+
+    def __init__(self, secrets=None):
+        self.cipher_model = type('Crypt', (), {'objects': CipherManager(secrets)})
+        self.fetched = []
+
+    def get_hash(self, hash_with_prefix=None):
+        return hash_with_prefix[len('enc1:::'):].encode('utf-8')
+
+    def fetch_secret(self, hash_with_prefix=None):
+        self.fetched.append(hash_with_prefix)
+        return self.cipher_model.objects.secrets[self.get_hash(hash_with_prefix).decode()]
+
+
+@tag('ciphertext_passthrough')
+class TestCiphertextPassthrough(SimpleTestCase):
+
+    def setUp(self):
+        self.cryptor = FieldCryptor({f'h{i}': f's{i}'.encode() for i in range(5)})
+        plan = patch('flourish_export.encryption.encryption_plan',
+                     return_value={'first_name': self.cryptor})
+        order = patch('flourish_export.encryption.field_order',
+                      return_value=('id', 'first_name'))
+        plan.start()
+        order.start()
+        self.addCleanup(plan.stop)
+        self.addCleanup(order.stop)
+        self.passthrough = CiphertextPassthrough(chunk_size=2)
+
+    def ciphertext(self, i):
+        return f'enc1:::h{i}{CIPHER_PREFIX}s{i}'.encode()
+
+    def row(self, i):
+        return {'id': i, '_ciphertext_first_name': f'enc1:::h{i}'}
+
+    def test_secrets_loaded_per_chunk(self):
+        rows = [self.passthrough.restore(row, None)
+                for row in self.passthrough.rows(map(self.row, range(5)), None)]
+        self.assertEqual(
+            self.cryptor.cipher_model.objects.queries,
+            [['h0', 'h1'], ['h2', 'h3'], ['h4']])
+        self.assertEqual(self.cryptor.fetched, [])
+        self.assertEqual(rows[3], {'id': 3, 'first_name': self.ciphertext(3)})
+
+    def test_value_outside_chunk_fetched(self):
+        list(self.passthrough.rows([self.row(0)], None))
+        restored = self.passthrough.restore(self.row(4), None)
+        self.assertEqual(self.cryptor.fetched, ['enc1:::h4'])
+        self.assertEqual(restored['first_name'], self.ciphertext(4))
+
+    def test_restore_returns_copy(self):
+        row = self.row(1)
+        restored = self.passthrough.restore(row, None)
+        self.assertEqual(row, {'id': 1, '_ciphertext_first_name': 'enc1:::h1'})
+        self.assertNotIn('_ciphertext_first_name', restored)
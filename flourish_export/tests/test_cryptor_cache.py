@@ -0,0 +1,65 @@
+from django.test import SimpleTestCase, tag
+
+from ..cryptor_cache import CryptorCache
+
+
+class FieldCryptor:
+
+    algorithm = 'aes'
+    mode = 'local'
+
+    def __init__(self):
+        self.calls = 0
+
+    def encrypt(self, value=None):
+        self.calls += 1
+        return None if value is None else f'enc:{value}'
+
+
+@tag('cryptor_cache')
+class TestCryptorCache(SimpleTestCase):
+
+    def setUp(self):
+        self.field_cryptor = FieldCryptor()
+        self.cryptor_cache = CryptorCache(maxsize=2)
+
+    def test_encrypts_value_once(self):
+        for _ in range(3):
+            self.assertEqual(
+                self.cryptor_cache.encrypt(self.field_cryptor, 'value'), 'enc:value')
+        self.assertEqual(self.field_cryptor.calls, 1)
+        self.assertEqual(self.cryptor_cache.hits, 2)
+        self.assertEqual(self.cryptor_cache.misses, 1)
+
+    def test_evicts_least_recently_used(self):
+        self.cryptor_cache.encrypt(self.field_cryptor, 'a')
+        self.cryptor_cache.encrypt(self.field_cryptor, 'b')
+        self.cryptor_cache.encrypt(self.field_cryptor, 'a')
+        self.cryptor_cache.encrypt(self.field_cryptor, 'c')
+        self.assertEqual(self.cryptor_cache.evictions, 1)
+        self.assertEqual(self.cryptor_cache.stats['size'], 2)
+
+        # 'b' was evicted, 'a' was used after it and is still cached
+        calls = self.field_cryptor.calls
+        self.cryptor_cache.encrypt(self.field_cryptor, 'a')
+        self.assertEqual(self.field_cryptor.calls, calls)
+        self.cryptor_cache.encrypt(self.field_cryptor, 'b')
+        self.assertEqual(self.field_cryptor.calls, calls + 1)
+
+    def test_values_of_other_types_are_not_shared(self):
+        self.cryptor_cache.encrypt(self.field_cryptor, 1)
+        self.cryptor_cache.encrypt(self.field_cryptor, '1')
+        self.assertEqual(self.field_cryptor.calls, 2)
+
+    def test_none_is_not_cached(self):
+        self.cryptor_cache.encrypt(self.field_cryptor, None)
+        self.cryptor_cache.encrypt(self.field_cryptor, None)
+        self.assertEqual(self.field_cryptor.calls, 2)
+        self.assertEqual(self.cryptor_cache.stats['size'], 0)
+
+    def test_clear(self):
+        self.cryptor_cache.encrypt(self.field_cryptor, 'a')
+        self.cryptor_cache.clear()
+        self.assertEqual(self.cryptor_cache.stats,
+                         {'hits': 0, 'misses': 0, 'evictions': 0,
+                          'hit_rate': 0.0, 'size': 0})
@@ -0,0 +1,141 @@
+import datetime
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase, tag
+from pytz import utc
+
+from ..csv_writer import StreamingCsvWriter
+from ..date_formatter import DateColumnFormatter
+from ..export_methods import ExportMethods
+
+
+class FrameMethods:
+    """The data frame formatting of `ExportMethods`.
+    """
+
+    date_formatter = DateColumnFormatter()
+    export_frame = ExportMethods.export_frame
+
+
+@tag('csv_writer')
+class TestStreamingCsvWriter(SimpleTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.export_methods = FrameMethods()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def write(self, rows=None, batch_size=None, **options):
+        path = os.path.join(self.path, f'export_{batch_size}.csv')
+        with StreamingCsvWriter(path=path, export_methods=self.export_methods,
+                                batch_size=batch_size, **options) as writer:
+            writer.extend(dict(row) for row in rows)
+        self.writer = writer
+        self.assertFalse(os.path.exists(f'{path}.part'))
+        with open(path) as f:
+            return f.read()
+
+    def frame_csv(self, rows=None, exclude=None):
+        return self.export_methods.export_frame(
+            [dict(row) for row in rows], None, exclude).to_csv(index=False)
+
+    def assertMatchesFrame(self, rows=None, exclude=None):
+        for batch_size in [1, 2, 3, len(rows) + 1]:
+            with self.subTest(batch_size=batch_size):
+                self.assertEqual(
+                    self.write(rows, batch_size, exclude=exclude),
+                    self.frame_csv(rows, exclude))
+
+    def test_matches_single_frame(self):
+        rows = [{'id': i, 'name': f'name {i}',
+                 'report_datetime': datetime.datetime(2023, 1, i + 1, tzinfo=utc)}
+                for i in range(5)]
+        self.assertMatchesFrame(rows)
+
+    def test_integers_with_missing_values_written_as_floats(self):
+        rows = [{'id': 1, 'count': 1}, {'id': 2, 'count': None}, {'id': 3, 'count': 3}]
+        self.assertMatchesFrame(rows)
+        self.assertIn('1.0', self.write(rows, batch_size=1))
+
+    def test_integers_with_float_values_written_as_floats(self):
+        rows = [{'id': 1, 'weight': 70}, {'id': 2, 'weight': 70.5}]
+        self.assertMatchesFrame(rows)
+
+    def test_integers_missing_from_rows_written_as_floats(self):
+        rows = [{'id': 1}, {'id': 2, 'count': 2}, {'id': 3}]
+        self.assertMatchesFrame(rows)
+
+    def test_columns_in_first_seen_order(self):
+        rows = [{'a': 1}, {'b': 'x', 'a': 2}, {'c': 'y'}]
+        self.assertMatchesFrame(rows)
+
+    def test_missing_datetimes(self):
+        rows = [{'id': 1, 'report_datetime': None},
+                {'id': 2, 'report_datetime': datetime.datetime(2023, 1, 2, tzinfo=utc)}]
+        self.assertMatchesFrame(rows)
+
+    def test_excluded_columns(self):
+        rows = [{'id': 1, 'hostname_created': 'host', 'name': 'a'}]
+        self.assertMatchesFrame(rows, exclude=['hostname_created'])
+
+    def test_no_rows_writes_header(self):
+        csv = self.write([], batch_size=10, columns=['a', 'b'])
+        self.assertEqual(csv.splitlines(), ['a,b'])
+
+    def test_planned_header_written_in_one_pass(self):
+        rows = [{'id': i, 'name': f'name {i}'} for i in range(5)]
+        self.assertEqual(self.write(rows, batch_size=2, columns=['id', 'name']),
+                         self.frame_csv(rows))
+        self.assertFalse(self.writer.rewritten)
+
+    def test_rows_appended_as_batches_are_formatted(self):
+        path = os.path.join(self.path, 'export.csv')
+        with StreamingCsvWriter(path=path, export_methods=self.export_methods,
+                                columns=['id'], batch_size=2) as writer:
+            writer.extend({'id': i} for i in range(3))
+            writer._file.flush()
+            with open(f'{path}.part') as f:
+                self.assertEqual(f.read(), 'id\n0\n1\n')
+        with open(path) as f:
+            self.assertEqual(f.read(), 'id\n0\n1\n2\n')
+
+    def test_planned_column_not_seen_is_dropped(self):
+        rows = [{'id': 1, 'report_datetime': None}]
+        csv = self.write(rows, batch_size=1,
+                         columns=['id', 'report_date', 'report_time'])
+        self.assertEqual(csv, self.frame_csv(rows))
+        self.assertTrue(self.writer.rewritten)
+
+    def test_unplanned_column_in_first_seen_order(self):
+        rows = [{'id': 1, 'report_datetime': None, 'name': 'a'},
+                {'id': 2, 'report_datetime': datetime.datetime(2023, 1, 2, tzinfo=utc),
+                 'name': 'b'}]
+        csv = self.write(rows, batch_size=1,
+                         columns=['id', 'report_date', 'report_time', 'name'])
+        self.assertEqual(csv, self.frame_csv(rows))
+
+    def test_later_missing_value_casts_earlier_batches(self):
+        rows = [{'id': 1, 'count': 1}, {'id': 2, 'count': 2}, {'id': 3}]
+        self.assertEqual(self.write(rows, batch_size=2, columns=['id', 'count']),
+                         self.frame_csv(rows))
+        self.assertTrue(self.writer.rewritten)
+
+    def test_renamed_columns_keep_position(self):
+        rows = [{'id': i, 'q1': i, 'name': f'name {i}'} for i in range(3)]
+        csv = self.write(rows, batch_size=2, columns=['id', '1', 'name'],
+                         rename={'q1': '1'})
+        self.assertEqual(csv.splitlines()[:2], ['id,1,name', '0,0,name 0'])
+        self.assertFalse(self.writer.rewritten)
+
+    def test_failed_export_leaves_no_file(self):
+        path = os.path.join(self.path, 'export.csv')
+        with self.assertRaises(ValueError):
+            with StreamingCsvWriter(path=path, export_methods=self.export_methods,
+                                    batch_size=1) as writer:
+                writer.append({'id': 1})
+                raise ValueError
+        self.assertEqual(os.listdir(self.path), [])
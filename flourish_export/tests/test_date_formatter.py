@@ -0,0 +1,60 @@
+import datetime
+
+import pandas as pd
+from django.test import SimpleTestCase, tag
+from pytz import utc
+
+from ..date_formatter import DateColumnFormatter
+from ..export_methods import ExportMethods
+
+
+class RowFormatter:
+    """The row by row date formatting of `ExportMethods`.
+    """
+
+    fix_date_format = ExportMethods.fix_date_format
+
+
+@tag('date_formatter')
+class TestDateColumnFormatter(SimpleTestCase):
+
+    def setUp(self):
+        self.formatter = DateColumnFormatter()
+
+    def row_csv(self, rows=None):
+        return pd.DataFrame(
+            [RowFormatter().fix_date_format(row) for row in rows]).to_csv(index=False)
+
+    def frame_csv(self, rows=None):
+        return self.formatter.format(pd.DataFrame(rows), None, rows=rows).to_csv(index=False)
+
+    def test_matches_row_formatting(self):
+        rows = [
+            {'id': 1, 'report_datetime': datetime.datetime(2023, 1, 2, 22, 30, tzinfo=utc),
+             'dob': datetime.date(2000, 1, 1), 'count': 1},
+            {'id': 2, 'report_datetime': datetime.datetime(2023, 5, 2, 1, 0, tzinfo=utc),
+             'dob': datetime.date(1999, 2, 3), 'count': 3}]
+        self.assertEqual(self.frame_csv(rows), self.row_csv(rows))
+
+    def test_converts_to_export_timezone(self):
+        rows = [{'report_datetime': datetime.datetime(2023, 1, 2, 22, 30, tzinfo=utc)}]
+        df = self.formatter.format(pd.DataFrame(rows), None, rows=rows)
+        self.assertEqual(list(df.columns), ['report_date', 'report_time'])
+        self.assertEqual(df.loc[0, 'report_date'], '01/03/2023')
+        self.assertEqual(df.loc[0, 'report_time'], '00:30:00.000000')
+
+    def test_missing_datetime_keeps_column(self):
+        rows = [
+            {'id': 1, 'report_datetime': None, 'dob': None},
+            {'id': 2, 'report_datetime': datetime.datetime(2023, 1, 2, tzinfo=utc),
+             'dob': datetime.date(2000, 1, 1)},
+            {'id': 3, 'report_datetime': None, 'dob': None, 'added': 'a'}]
+        self.assertEqual(self.frame_csv(rows), self.row_csv(rows))
+
+    def test_column_without_datetime_suffix(self):
+        rows = [{'consent_time': datetime.datetime(2023, 1, 2, 8, tzinfo=utc)}]
+        self.assertEqual(self.frame_csv(rows), self.row_csv(rows))
+
+    def test_frame_without_dates(self):
+        df = pd.DataFrame([{'id': 1, 'name': 'a'}])
+        self.assertIs(self.formatter.format(df), df)
@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+
+import pandas as pd
+from django.test import SimpleTestCase, tag
+
+from .. import delta_export
+from ..delta_export import DeltaExport
+
+
+@tag('delta_export')
+class TestDeltaExport(SimpleTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def previous(self, export_identifier=None):
+        return SimpleNamespace(export_identifier=export_identifier, datetime_started=None)
+
+    def delta(self, export_identifier=None, previous=None):
+        with mock.patch.object(delta_export, 'ExportFile') as export_file:
+            (export_file.objects.filter.return_value.exclude.return_value
+             .order_by.return_value.last.return_value) = previous
+            return DeltaExport('Export', export_identifier, snapshot_path=self.path)
+
+    def save(self, delta=None, key=None, rows=None, signature=None):
+        with delta.writer(key, signature) as saved:
+            for pk, row in rows.items():
+                saved.append(pk, row)
+
+    def save_frames(self, delta=None, key=None, frames=None):
+        with delta.writer(key, None, list(frames[0].columns)) as saved:
+            for frame in frames:
+                saved.append_frame(frame)
+        return self.delta('E2', self.previous('E1')).load(key)
+
+    def test_merge(self):
+        snapshot = [(1, {'a': 'x'}), (2, {'a': 'y'}), (3, {'a': 'z'})]
+        changed = {2: {'a': 'Y'}, 4: {'a': 'w'}}
+        rows = self.delta('E1').merge(snapshot, changed, {1, 2, 4})
+        self.assertEqual(list(rows),
+                         [(1, {'a': 'x'}), (2, {'a': 'Y'}), (4, {'a': 'w'})])
+
+    def test_merge_without_snapshot(self):
+        changed = {1: {'a': 'x'}}
+        self.assertEqual(list(self.delta('E1').merge(None, changed, {1})), [(1, {'a': 'x'})])
+
+    def test_merge_frames(self):
+        snapshot = self.save_frames(self.delta('E1'), 'crf', [
+            pd.DataFrame({'a': ['x', 'y']}, index=['1', '2']),
+            pd.DataFrame({'a': ['z']}, index=['3'])])
+        changed = pd.DataFrame({'a': ['Y', 'w'], 'b': ['1', '2']}, index=['2', '4'])
+        delta = self.delta('E2', self.previous('E1'))
+        frame = pd.concat(delta.merge_frames(snapshot, changed, {'1', '2', '4'}))
+        self.assertEqual(list(frame.index), ['1', '2', '4'])
+        self.assertEqual(frame.to_dict('records'),
+                         [{'a': 'x', 'b': ''}, {'a': 'Y', 'b': '1'}, {'a': 'w', 'b': '2'}])
+
+    def test_merge_frames_without_changes(self):
+        snapshot = self.save_frames(
+            self.delta('E1'), 'crf', [pd.DataFrame({'a': ['x', 'y']}, index=['1', '2'])])
+        delta = self.delta('E2', self.previous('E1'))
+        frame = pd.concat(delta.merge_frames(snapshot, pd.DataFrame(), {'2'}))
+        self.assertEqual(frame.to_dict('records'), [{'a': 'y'}])
+
+    def test_merge_frames_without_snapshot(self):
+        changed = pd.DataFrame({'a': ['x']}, index=['1'])
+        self.assertIs(next(self.delta('E1').merge_frames(None, changed, {'1'})), changed)
+
+    def test_load_saved_snapshot(self):
+        self.save(self.delta('E1'), 'crf', {1: {'a': 'x'}, 2: {'a': 'y'}}, ('choices', ))
+        delta = self.delta('E2', self.previous('E1'))
+        self.assertEqual(list(delta.load('crf', ('choices', ))),
+                         [(1, {'a': 'x'}), (2, {'a': 'y'})])
+        self.assertIsNone(delta.load('other'))
+
+    def test_snapshot_saved_in_chunks(self):
+        delta = self.delta('E1')
+        with delta.writer('crf') as saved:
+            saved.chunk_size = 2
+            for pk in range(5):
+                saved.append(pk, {'a': pk})
+        snapshot = self.delta('E2', self.previous('E1')).load('crf')
+        self.assertEqual([len(chunk) for chunk in snapshot.chunks()], [2, 2, 1])
+
+    def test_failed_save_keeps_no_snapshot(self):
+        delta = self.delta('E1')
+        with self.assertRaises(ValueError):
+            with delta.writer('crf') as saved:
+                saved.append(1, {'a': 'x'})
+                raise ValueError
+        self.assertEqual(os.listdir(os.path.join(self.path, 'E1')), [])
+
+    def test_load_snapshot_of_other_choices(self):
+        self.save(self.delta('E1'), 'crf', {1: {'a': 'x'}}, ('choices', ))
+        delta = self.delta('E2', self.previous('E1'))
+        self.assertIsNone(delta.load('crf', ('other choices', )))
+
+    def test_load_without_previous_export(self):
+        self.save(self.delta('E1'), 'crf', {1: {'a': 'x'}})
+        self.assertIsNone(self.delta('E2').load('crf'))
+
+    def test_prune_keeps_previous_snapshots(self):
+        for export_identifier in ['E1', 'E2']:
+            self.save(self.delta(export_identifier), 'crf', {})
+        delta = self.delta('E3', self.previous('E2'))
+        self.save(delta, 'crf', {})
+        self.assertEqual(sorted(os.listdir(self.path)), ['E2', 'E3'])
@@ -0,0 +1,70 @@
+import timeit
+from types import SimpleNamespace
+
+from django.test import SimpleTestCase, tag
+
+from ..cryptor_cache import CryptorCache
+from ..encryption import encrypted_fields
+from ..export_methods import ExportMethods
+
+
+class FieldCryptor:
+
+    algorithm = 'aes'
+    mode = 'local'
+
+    def encrypt(self, value=None):
+        return None if value is None else f'enc:{value}'
+
+
+def field(field_cls=None, name=None):
+    """Return a field of the class without running its constructor.
+    """
+    instance = field_cls.__new__(field_cls)
+    instance.name = name
+    instance.field_cryptor = FieldCryptor()
+    return instance
+
+
+def reflection_encrypt_values(obj_dict=None, obj_cls=None):
+    """`ExportMethods.encrypt_values` before the encryption plan.
+    """
+    result_dict_obj = {**obj_dict}
+    for key, value in obj_dict.items():
+        for f in obj_cls._meta.get_fields():
+            if key == f.name and type(f) in encrypted_fields:
+                new_value = f.field_cryptor.encrypt(value)
+                result_dict_obj[key] = new_value
+    return result_dict_obj
+
+
+@tag('encryption_plan')
+class TestEncryptionPlan(SimpleTestCase):
+    """Compare encrypting a row with the encryption plan to the reflection
+    loop it replaced, for a model of 80 fields, 4 of them encrypted.
+    """
+
+    def setUp(self):
+        fields = [field(SimpleNamespace, f'field_{i}') for i in range(76)]
+        fields += [field(encrypted_fields[i], f'encrypted_{i}') for i in range(4)]
+        self.model_cls = type(
+            'Model', (), {'_meta': SimpleNamespace(get_fields=lambda: fields)})
+        self.row = {f.name: f'value {f.name}' for f in fields}
+        self.export_methods = ExportMethods.__new__(ExportMethods)
+        self.export_methods.cryptor_cache = CryptorCache()
+        self.export_methods.ciphertext_passthrough = None
+
+    def encrypt_values(self):
+        return self.export_methods.encrypt_values(self.row, self.model_cls)
+
+    def test_same_values(self):
+        self.assertEqual(self.encrypt_values(),
+                         reflection_encrypt_values(self.row, self.model_cls))
+        self.assertEqual(self.encrypt_values()['encrypted_0'], 'enc:value encrypted_0')
+
+    def test_faster_than_reflection(self):
+        plan = min(timeit.repeat(self.encrypt_values, number=200, repeat=3))
+        reflection = min(timeit.repeat(
+            lambda: reflection_encrypt_values(self.row, self.model_cls),
+            number=200, repeat=3))
+        self.assertLess(plan, reflection)
@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase, tag
+
+from .. import export_manifest
+from ..export_manifest import ExportManifest, file_checksum
+
+
+@tag('export_manifest')
+class TestExportManifest(SimpleTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.manifest = ExportManifest(os.path.join(self.path, 'manifest'))
+        self.export_file = os.path.join(self.path, 'model.csv')
+        with open(self.export_file, 'w') as f:
+            f.write('a,b\n1,2\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_complete_model_is_skipped(self):
+        self.manifest.start('app.model')
+        self.assertFalse(self.manifest.is_complete('app.model'))
+        self.manifest.complete('app.model', rows=1, files=[self.export_file])
+        self.assertTrue(self.manifest.is_complete('app.model'))
+        entry = self.manifest.entry('app.model')
+        self.assertEqual(entry['rows'], 1)
+        stat = os.stat(self.export_file)
+        self.assertEqual(entry['files'], {self.export_file: {
+            'checksum': file_checksum(self.export_file), 'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns}})
+
+    def test_unchanged_file_is_not_hashed(self):
+        self.manifest.complete('app.model', rows=1, files=[self.export_file])
+        with mock.patch.object(export_manifest, 'file_checksum') as checksum:
+            self.assertTrue(self.manifest.is_complete('app.model'))
+        checksum.assert_not_called()
+
+    def test_touched_file_is_hashed(self):
+        self.manifest.complete('app.model', rows=1, files=[self.export_file])
+        stat = os.stat(self.export_file)
+        os.utime(self.export_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertTrue(self.manifest.is_complete('app.model'))
+        with open(self.export_file, 'w') as f:
+            f.write('a,b\n1,3\n')
+        os.utime(self.export_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertFalse(self.manifest.is_complete('app.model'))
+
+    def test_entry_with_checksum_only(self):
+        self.manifest.write('app.model', status='complete', rows=1,
+                            files={self.export_file: file_checksum(self.export_file)})
+        self.assertTrue(self.manifest.is_complete('app.model'))
+
+    def test_changed_file_is_exported_again(self):
+        self.manifest.complete('app.model', rows=1, files=[self.export_file])
+        with open(self.export_file, 'a') as f:
+            f.write('3,4\n')
+        self.assertFalse(self.manifest.is_complete('app.model'))
+
+    def test_missing_file_is_exported_again(self):
+        self.manifest.complete('app.model', rows=1, files=[self.export_file])
+        os.remove(self.export_file)
+        self.assertFalse(self.manifest.is_complete('app.model'))
+
+    def test_failed_model_is_exported_again(self):
+        self.manifest.fail('app.model', error='error')
+        self.assertFalse(self.manifest.is_complete('app.model'))
+        self.assertEqual(self.manifest.entry('app.model')['error'], 'error')
+
+    def test_unknown_model(self):
+        self.assertIsNone(self.manifest.entry('app.model'))
+        self.assertFalse(self.manifest.is_complete('app.model'))
+
+    def test_entries(self):
+        self.assertEqual(self.manifest.entries(), {})
+        self.manifest.complete('app.model', rows=0)
+        self.manifest.start('app.other')
+        self.assertEqual(
+            {model: entry['status'] for model, entry in self.manifest.entries().items()},
+            {'app.model': 'complete', 'app.other': 'running'})
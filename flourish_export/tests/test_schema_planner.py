@@ -0,0 +1,158 @@
+import datetime
+import os
+import re
+import shutil
+import tempfile
+
+import pandas as pd
+from django.db import models
+from django.test import SimpleTestCase, tag
+from pytz import timezone, utc
+
+from ..csv_writer import StreamingCsvWriter
+from ..date_formatter import DateColumnFormatter
+from ..exclusions import export_exclusions
+from ..export_methods import ExportMethods
+from ..schema_planner import ExportSchemaPlanner
+
+
+def baseline_fix_date_format(obj_dict=None):
+    """`ExportMethods.fix_date_format` of the row by row export.
+    """
+    result_dict_obj = {}
+    for key, value in obj_dict.items():
+        if isinstance(value, datetime.datetime):
+            value = value.astimezone(timezone('Africa/Gaborone'))
+            time_value = value.time().strftime('%H:%M:%S.%f')
+            time_variable = None
+            if 'datetime' in key:
+                time_variable = re.sub('datetime', 'time', key)
+            else:
+                time_variable = key + '_time'
+            value = value.strftime('%m/%d/%Y')
+            new_key = re.sub('time', '', key)
+            result_dict_obj[new_key] = value
+            result_dict_obj[time_variable] = time_value
+            continue
+        elif isinstance(value, datetime.date):
+            value = value.strftime('%m/%d/%Y')
+            result_dict_obj[key] = value
+            continue
+        result_dict_obj[key] = value
+    return result_dict_obj
+
+
+def baseline_csv(rows=None):
+    """Return the CSV the row by row export writes for the rows.
+    """
+    data = []
+    for row in rows:
+        row = baseline_fix_date_format(dict(row))
+        for e_field in export_exclusions():
+            row.pop(e_field, None)
+        data.append(row)
+    return pd.DataFrame(data).to_csv(index=False)
+
+
+class FrameMethods:
+    """The data frame formatting of `ExportMethods`.
+    """
+
+    date_formatter = DateColumnFormatter()
+    export_frame = ExportMethods.export_frame
+
+
+@tag('schema_planner')
+class TestPlannedExport(SimpleTestCase):
+    """Export rows under the planned header and compare the file with the
+    one of the row by row export.
+    """
+
+    template = {
+        'id': models.IntegerField(),
+        'report_datetime': models.DateTimeField(),
+        'other_datetime': models.DateTimeField(null=True),
+        'weight': models.IntegerField(null=True),
+        'dob': models.DateField(),
+        'registration_datetime': models.DateTimeField(null=True),
+        'symptoms__cough': None,
+        'symptoms__fever': None,
+        'med__0': models.CharField(),
+        'start_date__0': models.DateField(),
+        'med__1': models.CharField(),
+        'start_date__1': models.DateField(),
+    }
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def row(self, pk=None, other_datetime=None, weight=None, inlines=1):
+        row = {
+            'id': pk,
+            'report_datetime': datetime.datetime(2023, 1, pk, 8, tzinfo=utc),
+            'other_datetime': other_datetime,
+            'weight': weight,
+            'dob': datetime.date(2000, 1, pk),
+            'registration_datetime': None,
+            'symptoms__cough': 1,
+            'symptoms__fever': 0,
+        }
+        for count in range(inlines):
+            row.update({f'med__{count}': f'med {pk}',
+                        f'start_date__{count}': datetime.date(2022, 12, pk)})
+        return row
+
+    def export_csv(self, rows=None, template=None, batch_size=None):
+        columns = ExportSchemaPlanner().columns(template, export_exclusions())
+        path = os.path.join(self.path, f'export_{batch_size}.csv')
+        with StreamingCsvWriter(path=path, export_methods=FrameMethods(),
+                                exclude=export_exclusions(), columns=columns,
+                                batch_size=batch_size) as writer:
+            writer.extend(dict(row) for row in rows)
+        with open(path) as f:
+            return f.read()
+
+    def assertMatchesBaseline(self, rows=None, template=None):
+        for batch_size in [1, 2, len(rows)]:
+            with self.subTest(batch_size=batch_size):
+                self.assertEqual(
+                    self.export_csv(rows, template or self.template, batch_size),
+                    baseline_csv(rows))
+
+    def test_datetime_set_in_every_row(self):
+        rows = [self.row(pk, datetime.datetime(2023, 2, pk, tzinfo=utc), pk, 2)
+                for pk in range(1, 4)]
+        self.assertMatchesBaseline(rows)
+
+    def test_datetime_never_set(self):
+        rows = [self.row(pk, weight=pk, inlines=2) for pk in range(1, 4)]
+        self.assertMatchesBaseline(rows)
+
+    def test_datetime_missing_in_first_row(self):
+        rows = [self.row(1, inlines=2)] + [
+            self.row(pk, datetime.datetime(2023, 2, pk, tzinfo=utc), pk, 2)
+            for pk in range(2, 4)]
+        self.assertMatchesBaseline(rows)
+
+    def test_integer_missing_in_later_row(self):
+        rows = [self.row(pk, weight=pk, inlines=2) for pk in range(1, 4)]
+        rows[-1]['weight'] = None
+        self.assertMatchesBaseline(rows)
+
+    def test_fewer_inlines_in_first_row(self):
+        rows = [self.row(1, inlines=1), self.row(2, inlines=2), self.row(3, inlines=0)]
+        self.assertMatchesBaseline(rows)
+
+    def test_merged_inline_rows(self):
+        template = dict(self.template, test_crf_id=models.IntegerField(),
+                        med=models.CharField(), start_date=models.DateField())
+        rows = []
+        for pk, inlines in [(1, 1), (2, 2)]:
+            for count in range(inlines):
+                rows.append(dict(self.row(pk, inlines=inlines), test_crf_id=pk,
+                                 med=f'med {pk} {count}',
+                                 start_date=datetime.date(2022, 11, count + 1)))
+        self.assertMatchesBaseline(rows, template)
@@ -0,0 +1,34 @@
+from django.test import SimpleTestCase, tag
+
+from ..cryptor_cache import CryptorCache
+from ..export_methods import ExportMethods
+from ..inline_flattener import InlineFlattener
+from ..m2m_encoder import ManyToManyEncoder
+from ..subject_lookup import RegisteredSubjectLookup
+
+
+@tag('subject_lookup')
+class TestRegisteredSubjectLookup(SimpleTestCase):
+
+    def setUp(self):
+        self.subject_lookup = RegisteredSubjectLookup()
+        self.subject_lookup._subjects = {'B142-1': 'registered subject'}
+
+    def test_hit_rate(self):
+        for subject_identifier in ['B142-1', 'B142-1', 'B142-1', 'B142-2']:
+            self.subject_lookup.get(subject_identifier)
+        self.assertEqual(self.subject_lookup.stats,
+                         {'hits': 3, 'misses': 1, 'hit_rate': 0.75, 'size': 1})
+
+    def test_stats_logged_when_caches_cleared(self):
+        export_methods = ExportMethods.__new__(ExportMethods)
+        export_methods.subject_lookup = self.subject_lookup
+        export_methods.cryptor_cache = CryptorCache()
+        export_methods.m2m_encoder = ManyToManyEncoder()
+        export_methods.inline_flattener = InlineFlattener()
+        self.subject_lookup.get('B142-1')
+        with self.assertLogs('flourish_export.export_methods', 'INFO') as logs:
+            export_methods.clear_caches()
+        self.assertIn("registered subjects: {'hits': 1, 'misses': 0, 'hit_rate': 1.0",
+                      logs.output[0])
+        self.assertEqual(self.subject_lookup.hits, 0)
@@ -4,12 +4,14 @@ import shutil
 import threading
 import time
 
+from django.apps import apps as django_apps
 from django.conf import settings
 from django.contrib import messages
 from django.core.exceptions import ValidationError
 from django.core.mail import send_mail
 from edc_base.utils import get_utcnow
 
+from ..delta_export import DeltaExport
 from ..export_data_mixin import ExportDataMixin
 from ..export_methods import ExportMethods
 from ..export_model_lists import (
@@ -18,32 +20,38 @@ from ..export_model_lists import (
 from ..export_model_lists import follow_model_list
 from ..export_non_crfs import ExportNonCrfData
 from ..models import ExportFile
+from ..parallel_export import ExportTask, ParallelExport
 
 
 class ListBoardViewMixin:
 
-    def export_caregiver_data(self, export_path=None):
+    def export_caregiver_data(self, export_path=None, export_methods_cls=None, delta=None):
         """Export all caregiver CRF data.
         """
-        export_crf_data = ExportDataMixin(export_path=export_path)
+        export_crf_data = ExportDataMixin(
+            export_path=export_path, export_methods_cls=export_methods_cls)
         export_crf_data.export_crfs(
             crf_list=caregiver_crfs_list,
-            crf_data_dict=ExportMethods().caregiver_crf_data_dict,
-            study='flourish_caregiver')
+            crf_data_dict=export_crf_data.export_methods_cls.caregiver_crf_data_dict,
+            study='flourish_caregiver',
+            delta=delta)
 
-    def export_child_data(self, export_path=None):
+    def export_child_data(self, export_path=None, export_methods_cls=None, delta=None):
         """Export child data.
         """
-        export_crf_data = ExportDataMixin(export_path=export_path)
+        export_crf_data = ExportDataMixin(
+            export_path=export_path, export_methods_cls=export_methods_cls)
         export_crf_data.export_crfs(
             crf_list=child_crf_list,
-            crf_data_dict=ExportMethods().child_crf_data,
-            study='flourish_child')
+            crf_data_dict=export_crf_data.export_methods_cls.child_crf_data,
+            study='flourish_child',
+            delta=delta)
 
-    def export_non_crf_data(self, export_path=None):
+    def export_non_crf_data(self, export_path=None, export_methods_cls=None):
         """Export both child and caregiver non CFR data.
         """
-        non_crf_data = ExportNonCrfData(export_path=export_path)
+        non_crf_data = ExportNonCrfData(
+            export_path=export_path, export_methods_cls=export_methods_cls)
 
         non_crf_data.child_non_crf(child_model_list=child_model_list)
         non_crf_data.death_report(death_report_prn_model_list=death_report_prn_model_list)
@@ -60,6 +68,106 @@ class ListBoardViewMixin:
 
         non_crf_data.offstudy(offstudy_prn_model_list=offstudy_prn_model_list)
 
+    def crf_export_tasks(self, export_path=None, crf_list=None, crf_data_dict=None,
+                         study=None, delta=None):
+        """Return an export task per CRF, or group of combined CRFs.
+        """
+        tasks = []
+        for crf_name in crf_list:
+            if isinstance(crf_name, dict):
+                label = list(crf_name)[-1]
+                model_name = crf_name[label][0]
+            else:
+                label = model_name = crf_name
+            tasks.append(ExportTask(
+                label=f'{study}.{label}', exporter='crf', method='export_crfs',
+                kwargs={'crf_list': [crf_name], 'crf_data_dict': crf_data_dict,
+                        'study': study, 'delta': delta},
+                export_path=export_path, model=f'{study}.{model_name}'))
+        return tasks
+
+    def non_crf_export_tasks(self, export_path=None):
+        """Return an export task per non CRF model, see `export_non_crf_data`.
+        """
+        special_models = {'registeredsubject': 'edc_registration.registeredsubject',
+                          'appointment': 'edc_appointment.appointment'}
+        exports = [
+            ('child_non_crf', 'child_model_list', child_model_list, 'flourish_child', {}),
+            ('death_report', 'death_report_prn_model_list', death_report_prn_model_list,
+             'flourish_prn', {}),
+            ('caregiver_non_crfs', 'caregiver_model_list', caregiver_model_list,
+             'flourish_caregiver', {'study': 'flourish_caregiver'}),
+            ('follow_models', 'follow_model_list', follow_model_list,
+             'flourish_follow', {'study': 'flourish_follow'}),
+            ('offstudy', 'offstudy_prn_model_list', offstudy_prn_model_list,
+             'flourish_prn', {})]
+        tasks = []
+        for method, list_name, model_list, app_label, kwargs in exports:
+            for model_name in model_list:
+                tasks.append(ExportTask(
+                    label=f'{app_label}.{model_name}', exporter='non_crf', method=method,
+                    kwargs={list_name: [model_name], **kwargs}, export_path=export_path,
+                    model=special_models.get(model_name, f'{app_label}.{model_name}')))
+        for method, model in [('child_visit', 'flourish_child.childvisit'),
+                              ('caregiver_visit', 'flourish_caregiver.maternalvisit')]:
+            tasks.append(ExportTask(
+                label=model, exporter='non_crf', method=method, kwargs={},
+                export_path=export_path, model=model))
+        return tasks
+
+    def export_data(self, dir_to_zip=None, export_methods_cls=None, caregiver=False,
+                    child=False, non_crf=False, delta=None):
+        """Export the caregiver CRF, child CRF and non CRF data into the
+        export directory and return a dictionary of label: traceback of the
+        exports that failed. With more than one export process configured
+        the models are exported in parallel, the failed exports are also
+        listed in failed_exports.txt. With a `DeltaExport` the CRF files
+        are merged from the rows changed since the last export.
+        """
+        processes = django_apps.get_app_config('flourish_export').export_processes
+        if processes <= 1:
+            if caregiver:
+                self.export_caregiver_data(
+                    export_path=dir_to_zip + '/caregiver/',
+                    export_methods_cls=export_methods_cls, delta=delta)
+            if child:
+                self.export_child_data(
+                    export_path=dir_to_zip + '/child/',
+                    export_methods_cls=export_methods_cls, delta=delta)
+            if non_crf:
+                self.export_non_crf_data(
+                    export_path=dir_to_zip + '/non_crf/',
+                    export_methods_cls=export_methods_cls)
+            return {}
+
+        tasks = []
+        if caregiver:
+            tasks += self.crf_export_tasks(
+                dir_to_zip + '/caregiver/', caregiver_crfs_list,
+                'caregiver_crf_data_dict', 'flourish_caregiver', delta)
+        if child:
+            tasks += self.crf_export_tasks(
+                dir_to_zip + '/child/', child_crf_list, 'child_crf_data', 'flourish_child',
+                delta)
+        if non_crf:
+            tasks += self.non_crf_export_tasks(dir_to_zip + '/non_crf/')
+        ciphertext_passthrough = bool(
+            export_methods_cls and export_methods_cls.ciphertext_passthrough)
+        failures = ParallelExport(processes, ciphertext_passthrough).run(tasks)
+        if failures:
+            with open(os.path.join(dir_to_zip, 'failed_exports.txt'), 'w') as f:
+                for label, error in failures.items():
+                    f.write(f'{label}\n{error}\n')
+        return failures
+
+    def delta_export(self, description=None, export_identifier=None):
+        """Return the `DeltaExport` of the export if incremental exports are
+        enabled, otherwise None.
+        """
+        if django_apps.get_app_config('flourish_export').incremental_exports:
+            return DeltaExport(description, export_identifier)
+        return None
+
     def export_requisitions(self, caregiver_export_path=None, child_export_path=None):
         """Export child and caregiver requisitions.
         """
@@ -86,6 +194,9 @@ class ListBoardViewMixin:
             'download_time': download_time
         }
         doc = ExportFile.objects.create(**options)
+
+        # Export scoped lookups and caches shared across the whole run
+        export_methods_cls = ExportMethods()
         try:
             start = time.perf_counter()
             today_date = datetime.datetime.now().strftime('%Y%m%d')
@@ -95,13 +206,10 @@ class ListBoardViewMixin:
             dir_to_zip = settings.MEDIA_ROOT + '/documents/' + \
                 export_identifier + '_flourish_all_export_' + today_date
 
-            export_path = dir_to_zip + '/caregiver/'
-            self.export_caregiver_data(export_path=export_path)
-            export_path = dir_to_zip + '/child/'
-            self.export_child_data(export_path=export_path)
-
-            export_path = dir_to_zip + '/non_crf/'
-            self.export_non_crf_data(export_path=export_path)
+            failures = self.export_data(
+                dir_to_zip=dir_to_zip, export_methods_cls=export_methods_cls,
+                caregiver=True, child=True, non_crf=True,
+                delta=self.delta_export(doc.description, export_identifier))
 
             # caregiver_export_path = dir_to_zip + '/caregiver/'
             # child_export_path = dir_to_zip + '/child/'
@@ -119,9 +227,11 @@ class ListBoardViewMixin:
                 thread_name=thread_name,
                 dir_to_zip=dir_to_zip, start=start,
                 export_identifier=export_identifier,
-                doc=doc)
+                doc=doc, failures=failures)
         except Exception as e:
             raise e
+        finally:
+            export_methods_cls.clear_caches()
 
     def download_child_data(self):
         """Export all data.
@@ -144,6 +254,9 @@ class ListBoardViewMixin:
             'download_time': download_time
         }
         doc = ExportFile.objects.create(**options)
+
+        # Export scoped lookups and caches shared across the whole run
+        export_methods_cls = ExportMethods()
         try:
             start = time.perf_counter()
             today_date = datetime.datetime.now().strftime('%Y%m%d')
@@ -152,8 +265,9 @@ class ListBoardViewMixin:
             dir_to_zip = settings.MEDIA_ROOT + \
                 f'/documents/{export_identifier}_flourish_child_export_{today_date}'
 
-            export_path = dir_to_zip + '/child/'
-            self.export_child_data(export_path=export_path)
+            failures = self.export_data(
+                dir_to_zip=dir_to_zip, export_methods_cls=export_methods_cls, child=True,
+                delta=self.delta_export(doc.description, export_identifier))
 
             doc.document = zipped_file_path
             doc.save()
@@ -164,9 +278,11 @@ class ListBoardViewMixin:
                 thread_name=thread_name,
                 dir_to_zip=dir_to_zip, start=start,
                 export_identifier=export_identifier,
-                doc=doc)
+                doc=doc, failures=failures)
         except Exception as e:
             raise e
+        finally:
+            export_methods_cls.clear_caches()
 
     def download_caregiver_data(self):
         """Export caregiver data.
@@ -189,6 +305,9 @@ class ListBoardViewMixin:
             'download_time': download_time
         }
         doc = ExportFile.objects.create(**options)
+
+        # Export scoped lookups and caches shared across the whole run
+        export_methods_cls = ExportMethods()
         try:
             start = time.perf_counter()
             today_date = datetime.datetime.now().strftime('%Y%m%d')
@@ -197,8 +316,10 @@ class ListBoardViewMixin:
             dir_to_zip = settings.MEDIA_ROOT + \
                 f'/documents/{export_identifier}_flourish_caregiver_export_{today_date}'
 
-            export_path = dir_to_zip + '/caregiver/'
-            self.export_caregiver_data(export_path=export_path)
+            failures = self.export_data(
+                dir_to_zip=dir_to_zip, export_methods_cls=export_methods_cls,
+                caregiver=True,
+                delta=self.delta_export(doc.description, export_identifier))
 
             doc.document = zipped_file_path
             doc.save()
@@ -209,9 +330,11 @@ class ListBoardViewMixin:
                 thread_name=thread_name,
                 dir_to_zip=dir_to_zip, start=start,
                 export_identifier=export_identifier,
-                doc=doc)
+                doc=doc, failures=failures)
         except Exception as e:
             raise e
+        finally:
+            export_methods_cls.clear_caches()
 
     def download_non_crf_data(self):
         """Export all data.
@@ -234,6 +357,9 @@ class ListBoardViewMixin:
             'download_time': download_time
         }
         doc = ExportFile.objects.create(**options)
+
+        # Export scoped lookups and caches shared across the whole run
+        export_methods_cls = ExportMethods()
         try:
             start = time.perf_counter()
             today_date = datetime.datetime.now().strftime('%Y%m%d')
@@ -242,8 +368,9 @@ class ListBoardViewMixin:
             dir_to_zip = settings.MEDIA_ROOT + \
                 f'/documents/{export_identifier}_flourish_non_crf_export_{today_date}'
 
-            export_path = dir_to_zip + '/non_crf/'
-            self.export_non_crf_data(export_path=export_path)
+            failures = self.export_data(
+                dir_to_zip=dir_to_zip, export_methods_cls=export_methods_cls,
+                non_crf=True)
 
             doc.document = zipped_file_path
             doc.save()
@@ -254,18 +381,21 @@ class ListBoardViewMixin:
                 thread_name=thread_name,
                 dir_to_zip=dir_to_zip, start=start,
                 export_identifier=export_identifier,
-                doc=doc)
+                doc=doc, failures=failures)
         except Exception as e:
             raise e
+        finally:
+            export_methods_cls.clear_caches()
 
     def zipfile(
             self, thread_name=None, dir_to_zip=None, start=None,
-            export_identifier=None, doc=None):
-        """Zip file.
+            export_identifier=None, doc=None, failures=None):
+        """Zip file. An export with `failures` is not marked complete and
+        the failed exports are listed in the email.
         """
         # Zip the file
 
-        doc.download_complete = True
+        doc.download_complete = not failures
         doc.save()
 
         if not os.path.isfile(dir_to_zip):
@@ -286,9 +416,17 @@ class ListBoardViewMixin:
 
             # Notify user the download is done
             subject = export_identifier + ' ' + doc.description
-            message = (export_identifier + doc.description
-                       + ' export files have been successfully generated and '
-                       'ready for download. This is an automated message.')
+            if failures:
+                subject += ' (incomplete)'
+                message = (export_identifier + doc.description
+                           + ' export files have been generated, but the exports '
+                           'of the following models failed and are missing: '
+                           + ', '.join(sorted(failures))
+                           + '. This is an automated message.')
+            else:
+                message = (export_identifier + doc.description
+                           + ' export files have been successfully generated and '
+                           'ready for download. This is an automated message.')
             send_mail(
                 subject=subject,
                 message=message,